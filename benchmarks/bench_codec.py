@@ -0,0 +1,108 @@
+"""Сравнение record_codec с JSON на реалистичных записях.
+
+Запуск: python benchmarks/bench_codec.py [--users N] [--repeat R]
+
+Записи: состояние пользователя, месячные партиции дневника (food/train/metrics),
+итоги дней и результаты поиска питания. Для каждого формата — суммарный размер,
+время кодирования и разбора. «json indent=2» — прежний путь LocalDB._save,
+«json» — то, что пишут SQLite-хранилища без кодека.
+"""
+
+import argparse
+import json
+import random
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+import record_codec  # noqa: E402
+
+FOODS = ["Овсянка на молоке", "Куриная грудка с рисом", "Творог 5%", "Яблоко", "Борщ", "Гречка с котлетой",
+         "Греческий йогурт", "Банан", "Омлет из 2 яиц", "Салат цезарь", "Protein bar Nutrend 60 g"]
+
+
+def _ts(rng, month, day):
+    return f"2026-{month:02d}-{day:02d} {rng.randrange(7, 23):02d}:{rng.randrange(60):02d}:{rng.randrange(60):02d}"
+
+
+def make_records(users: int, seed: int = 1):
+    rng = random.Random(seed)
+    records = []
+    for uid in range(users):
+        state = {
+            "profile": {"gender": "Женский", "age": rng.randrange(18, 60), "height_cm": rng.randrange(150, 195),
+                        "weight_kg": round(rng.uniform(50, 110), 1), "activity": "Умеренная", "goal": "Похудеть",
+                        "allergies": "", "conditions": "", "injuries": "",
+                        "preferences": {"menu_notes": "", "workout_notes": ""}},
+            "awards": {f"2026-10-{d:02d}": {"log_food": True} for d in range(1, 16)},
+            "points": rng.randrange(500), "access_level": "basic", "current_role": "nutri",
+            "awaiting": None, "tmp": {}, "_v": rng.randrange(1, 300),
+        }
+        records.append(state)
+        for month in (9, 10):
+            food = []
+            for day in range(1, 29):
+                for _ in range(rng.randrange(2, 5)):
+                    food.append({"ts": _ts(rng, month, day), "text": rng.choice(FOODS), "kcal": rng.randrange(80, 700),
+                                 "p": round(rng.uniform(0, 40), 1), "f": round(rng.uniform(0, 30), 1),
+                                 "c": round(rng.uniform(0, 90), 1)})
+            records.append({"entries": food, "_v": len(food)})
+            train = [{"ts": _ts(rng, month, d), "text": "Бег 30 мин", "type": "бег", "avg_hr": rng.randrange(120, 170),
+                      "kcal": rng.randrange(150, 500)} for d in range(1, 29, 3)]
+            records.append({"entries": train, "_v": len(train)})
+            days = {f"2026-{month:02d}-{d:02d}": {"kcal": float(rng.randrange(1200, 2600)), "p": 80.5, "f": 60.0,
+                                                    "c": 210.3, "train_kcal": 0, "food_n": 3, "train_n": 0, "metrics_n": 0}
+                    for d in range(1, 29)}
+            records.append({"days": days, "_v": 28})
+        records.append({"kcal_100g": 389.0, "protein_100g": 16.9, "fat_100g": 6.9, "carbs_100g": 66.3,
+                        "kcal_100ml": None, "protein_100ml": None, "fat_100ml": None, "carbs_100ml": None,
+                        "kcal_portion": 233.4, "protein_portion": 10.14, "fat_portion": 4.14, "carbs_portion": 39.78,
+                        "portion_g": 60.0, "portion_ml": None, "name": rng.choice(FOODS), "brand": "Nutrend",
+                        "source": "fatsecret", "url": "https://www.fatsecret.com/calories-nutrition/generic/oats"})
+    return records
+
+
+def bench(name, enc, dec, records, repeat):
+    blobs = [enc(r) for r in records]
+    size = sum(len(b) for b in blobs)
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        for r in records:
+            enc(r)
+    t_enc = (time.perf_counter() - t0) / repeat
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        for b in blobs:
+            dec(b)
+    t_dec = (time.perf_counter() - t0) / repeat
+    for r, b in zip(records, blobs):
+        assert dec(b) == r, f"{name}: round-trip mismatch"
+    return name, size, t_enc, t_dec
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--users", type=int, default=200)
+    ap.add_argument("--repeat", type=int, default=3)
+    args = ap.parse_args()
+    records = make_records(args.users)
+    rows = [
+        bench("json indent=2", lambda r: json.dumps(r, ensure_ascii=False, indent=2).encode("utf-8"),
+              lambda b: json.loads(b), records, args.repeat),
+        bench("json", lambda r: json.dumps(r, ensure_ascii=False).encode("utf-8"),
+              lambda b: json.loads(b), records, args.repeat),
+        bench("record_codec", record_codec.encode, record_codec.decode, records, args.repeat),
+    ]
+    base = rows[0][1]
+    print(f"{len(records)} records ({args.users} users), avg of {args.repeat} runs")
+    print(f"{'format':<16}{'bytes':>12}{'vs indent':>11}{'encode ms':>12}{'decode ms':>12}")
+    for name, size, t_enc, t_dec in rows:
+        print(f"{name:<16}{size:>12}{size / base:>10.0%}{t_enc * 1000:>12.1f}{t_dec * 1000:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
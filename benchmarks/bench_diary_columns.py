@@ -0,0 +1,115 @@
+"""Список словарей против DiaryColumns: память и время выборок по дням/неделям.
+
+Запуск: python benchmarks/bench_diary_columns.py [--days N] [--per-day M] [--queries Q]
+
+Дневник — N дней по M записей еды плюс тренировка через день. Запросы — итоги
+каждого из последних Q дней и недель: у списка — сравнение ts[:10] по всем записям,
+у колонок — два bisect и суммирование только своих строк.
+"""
+
+import argparse
+import random
+import sys
+import time
+import tracemalloc
+from datetime import date, timedelta
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+from diary_columns import DiaryColumns, day_start  # noqa: E402
+
+FOODS = ["Овсянка на молоке", "Куриная грудка с рисом", "Творог 5%", "Яблоко", "Борщ", "Гречка с котлетой"]
+
+
+def make_entries(days: int, per_day: int, seed: int = 3):
+    rng = random.Random(seed)
+    start = date(2025, 1, 1)
+    food, train = [], []
+    for n in range(days):
+        d = (start + timedelta(days=n)).isoformat()
+        for h in sorted(rng.sample(range(7, 23), per_day)):
+            food.append({"ts": f"{d} {h:02d}:{rng.randrange(60):02d}:00", "text": rng.choice(FOODS),
+                         "kcal": rng.randrange(80, 700), "p": round(rng.uniform(0, 40), 1),
+                         "f": round(rng.uniform(0, 30), 1), "c": round(rng.uniform(0, 90), 1)})
+        if n % 2:
+            train.append({"ts": f"{d} 19:00:00", "text": "Бег 30 мин", "type": "бег",
+                          "avg_hr": 140, "kcal": rng.randrange(200, 450)})
+    return food, train, [(start + timedelta(days=n)).isoformat() for n in range(days)]
+
+
+def measure(build):
+    tracemalloc.start()
+    obj = build()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return obj, size
+
+
+def list_day_totals(food, day):
+    out = {"kcal": 0.0, "p": 0.0, "f": 0.0, "c": 0.0, "n": 0}
+    for e in food:
+        if e["ts"][:10] == day:
+            out["n"] += 1
+            for k in ("kcal", "p", "f", "c"):
+                out[k] += e.get(k) or 0
+    return out
+
+
+def list_week_totals(food, days):
+    week = set(days)
+    out = {"kcal": 0.0, "n": 0}
+    for e in food:
+        if e["ts"][:10] in week:
+            out["n"] += 1
+            out["kcal"] += e.get("kcal") or 0
+    return out
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--days", type=int, default=365)
+    ap.add_argument("--per-day", type=int, default=4)
+    ap.add_argument("--queries", type=int, default=30)
+    args = ap.parse_args()
+    food_src, train_src, days = make_entries(args.days, args.per_day)
+    # копии строим под tracemalloc, чтобы мерить только сами структуры
+    (food, train), list_bytes = measure(lambda: ([dict(e) for e in food_src], [dict(e) for e in train_src]))
+    def build():
+        c = DiaryColumns.from_entries(food, "food")
+        c.extend(train, "train")
+        return c
+
+    cols, cols_bytes = measure(build)
+    t0 = time.perf_counter()
+    build()
+    t_convert = time.perf_counter() - t0
+    assert cols.to_entries(kind="food") == food and cols.to_entries(kind="train") == train
+
+    recent = days[-args.queries:]
+    t0 = time.perf_counter()
+    list_days = [list_day_totals(food, d) for d in recent]
+    list_weeks = [list_week_totals(food, days[max(0, i - 6):i + 1]) for i in range(len(days) - args.queries, len(days))]
+    t_list = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    col_days = [cols.totals(*cols.day(d)) for d in recent]
+    col_weeks = [cols.totals(*cols.span(day_start(days[max(0, i - 6)]), day_start(days[i]) + 86400))
+                 for i in range(len(days) - args.queries, len(days))]
+    t_cols = time.perf_counter() - t0
+    for a, b in zip(list_days, col_days):
+        assert a["n"] == b["n"] and abs(a["kcal"] - b["kcal"]) < 1e-6
+    for a, b in zip(list_weeks, col_weeks):
+        assert a["n"] == b["n"] and abs(a["kcal"] - b["kcal"]) < 1e-6
+
+    print(f"{len(food)} food + {len(train)} train entries, {args.queries} day + {args.queries} week queries")
+    print(f"{'layout':<16}{'memory KB':>12}{'queries ms':>12}")
+    print(f"{'list of dicts':<16}{list_bytes / 1024:>12.0f}{t_list * 1000:>12.2f}")
+    print(f"{'DiaryColumns':<16}{cols_bytes / 1024:>12.0f}{t_cols * 1000:>12.2f}")
+    print(f"conversion from dicts: {t_convert * 1000:.1f} ms; DiaryColumns.nbytes() = {cols.nbytes() // 1024} KB")
+
+
+if __name__ == "__main__":
+    main()
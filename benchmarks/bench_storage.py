@@ -0,0 +1,115 @@
+"""Сравнение хранилищ (storage.py) на синтетической нагрузке «N пользователей записывают еду».
+
+Запуск: python benchmarks/bench_storage.py [--users N] [--meals M] [--concurrency C] [--backends memory,json,sqlite]
+
+Один приём пищи повторяет путь бота: чтение состояния и индекса дневника, условная
+запись месячной партиции, индекса, итогов дня и состояния (баллы) по версии _v.
+Перед этим — старт: put_many состояний, scan_prefix и get_many (как загрузка рейтинга).
+Выводятся пропускная способность и p50/p99 задержки отдельной операции.
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+from storage import AsyncStorage, open_store  # noqa: E402
+
+FOODS = ["Овсянка", "Куриная грудка с рисом", "Творог 5%", "Яблоко", "Борщ", "Гречка с котлетой"]
+
+
+class Recorder:
+    def __init__(self):
+        self.lat = []
+
+    async def __call__(self, coro):
+        t0 = time.perf_counter()
+        result = await coro
+        self.lat.append(time.perf_counter() - t0)
+        return result
+
+    def pct(self, q: float) -> float:
+        if not self.lat:
+            return 0.0
+        data = sorted(self.lat)
+        return data[min(len(data) - 1, int(q * len(data)))] * 1000
+
+
+async def cas_update(db: AsyncStorage, rec: Recorder, key: str, fn):
+    while True:
+        cur = await rec(db.get(key)) or {}
+        expected = int(cur.get("_v", 0))
+        fn(cur)
+        if await rec(db.put_if_version(key, expected, cur)):
+            return
+
+
+async def log_meal(db: AsyncStorage, rec: Recorder, uid: int, rng: random.Random):
+    day = f"2026-10-{rng.randrange(1, 29):02d}"
+    entry = {"ts": f"{day} {rng.randrange(7, 23):02d}:00:00", "text": rng.choice(FOODS),
+             "kcal": rng.randrange(80, 700), "p": round(rng.uniform(0, 40), 1)}
+    await rec(db.get(f"user:{uid}"))
+    await rec(db.get(f"diary:{uid}:index"))
+    await cas_update(db, rec, f"diary:{uid}:food:2026-10", lambda r: r.setdefault("entries", []).append(entry))
+    await cas_update(db, rec, f"diary:{uid}:index",
+                     lambda r: r.setdefault("food", {}).__setitem__("2026-10", r.get("food", {}).get("2026-10", 0) + 1))
+
+    def bump_day(r):
+        row = r.setdefault("days", {}).setdefault(day, {"kcal": 0, "food_n": 0})
+        row["kcal"] += entry["kcal"]
+        row["food_n"] += 1
+    await cas_update(db, rec, f"diary:{uid}:days:2026-10", bump_day)
+    await cas_update(db, rec, f"user:{uid}", lambda r: r.__setitem__("points", r.get("points", 0) + 1))
+
+
+async def run_backend(kind: str, users: int, meals: int, concurrency: int, workdir: str):
+    store = open_store(kind, json_path=os.path.join(workdir, f"{kind}.json"),
+                       sqlite_path=os.path.join(workdir, f"{kind}.db"))
+    db = AsyncStorage(store)
+    rec = Recorder()
+    t0 = time.perf_counter()
+    await rec(db.put_many({f"user:{u}": {"points": 0, "profile": {"age": 30}, "_v": 1} for u in range(users)}))
+    keys = await rec(db.scan_prefix("user:"))
+    await rec(db.get_many(keys))
+    sem = asyncio.Semaphore(concurrency)
+
+    async def user(uid: int):
+        rng = random.Random(uid)
+        async with sem:
+            for _ in range(meals):
+                await log_meal(db, rec, uid, rng)
+
+    await asyncio.gather(*(user(u) for u in range(users)))
+    await db.flush()
+    elapsed = time.perf_counter() - t0
+    check = await db.get(f"user:{users - 1}")
+    assert check["points"] == meals, f"{kind}: lost updates"
+    await db.close()
+    return kind, users * meals / elapsed, len(rec.lat) / elapsed, rec.pct(0.5), rec.pct(0.99), elapsed
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--users", type=int, default=200)
+    ap.add_argument("--meals", type=int, default=20)
+    ap.add_argument("--concurrency", type=int, default=50)
+    ap.add_argument("--backends", default="memory,json,sqlite")
+    args = ap.parse_args()
+    print(f"{args.users} users x {args.meals} meals, concurrency {args.concurrency}")
+    print(f"{'backend':<10}{'meals/s':>10}{'ops/s':>10}{'p50 ms':>9}{'p99 ms':>9}{'total s':>9}")
+    with tempfile.TemporaryDirectory() as workdir:
+        for kind in args.backends.split(","):
+            row = asyncio.run(run_backend(kind.strip(), args.users, args.meals, args.concurrency, workdir))
+            print(f"{row[0]:<10}{row[1]:>10.0f}{row[2]:>10.0f}{row[3]:>9.3f}{row[4]:>9.3f}{row[5]:>9.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+"""Колоночное представление дневника: параллельные массивы вместо списка словарей.
+
+Время — секунды от эпохи (строка ts читается как есть, без часового пояса) в array('d'),
+отсортированном по возрастанию, поэтому выборка за день/неделю — два bisect, а не
+сравнение ts[:10] по всему списку. kcal/p/f/c — array('d') (NaN — поля не было),
+вид записи (food/train/metrics) и тип тренировки — коды в array('b')/array('i'),
+тексты — в отдельном списке, прочие поля — в словаре по номеру строки.
+
+DiaryColumns.from_entries / to_entries переводят из текущих словарей и обратно
+без потерь, так что обработчики можно переводить по одному.
+"""
+
+import calendar
+import sys
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from datetime import date, timedelta
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+KINDS = ("food", "train", "metrics")
+NUM_FIELDS = ("kcal", "p", "f", "c")
+_KIND_CODE = {k: i for i, k in enumerate(KINDS)}
+_CORE = ("ts", "text", "type") + NUM_FIELDS
+_TS_FORMAT = "%Y-%m-%d %H:%M:%S"
+_NAN = float("nan")
+
+
+class _Missing:
+    __slots__ = ()
+
+    def __repr__(self):
+        return "<missing>"
+
+
+_MISSING = _Missing()  # поля не было в записи (в отличие от значения None)
+
+
+def parse_ts(ts) -> Optional[float]:
+    """'YYYY-MM-DD HH:MM:SS' → секунды; None, если строка не такая."""
+    if not isinstance(ts, str) or len(ts) != 19 or ts[4] != "-" or ts[7] != "-" or ts[10] != " " \
+            or ts[13] != ":" or ts[16] != ":":
+        return None
+    try:
+        y, mo, d = int(ts[0:4]), int(ts[5:7]), int(ts[8:10])
+        h, mi, s = int(ts[11:13]), int(ts[14:16]), int(ts[17:19])
+    except ValueError:
+        return None
+    if not (1 <= mo <= 12 and 1 <= d <= calendar.monthrange(y, mo)[1] and h < 24 and mi < 60 and s < 60) \
+            or y < 1 or min(h, mi, s) < 0:
+        return None
+    return float(calendar.timegm((y, mo, d, h, mi, s)))
+
+
+def day_start(day: str) -> float:
+    y, m, d = int(day[0:4]), int(day[5:7]), int(day[8:10])
+    return float(calendar.timegm((y, m, d, 0, 0, 0)))
+
+
+def format_ts(epoch: float) -> str:
+    return time.strftime(_TS_FORMAT, time.gmtime(epoch))
+
+
+class DiaryColumns:
+    __slots__ = ("ts", "kind", "type", "kcal", "p", "f", "c", "int_mask", "texts", "types", "_type_code", "extra")
+
+    def __init__(self):
+        self.ts = array("d")
+        self.kind = array("b")
+        self.type = array("i")       # -1 — поля type нет
+        self.kcal = array("d")
+        self.p = array("d")
+        self.f = array("d")
+        self.c = array("d")
+        self.int_mask = array("b")   # бит i — NUM_FIELDS[i] был int (для точного обратного перевода)
+        self.texts: List[Optional[str]] = []
+        self.types: List[Any] = []   # таблица значений type
+        self._type_code: Dict[Any, int] = {}
+        self.extra: Dict[int, Dict[str, Any]] = {}
+
+    def __len__(self) -> int:
+        return len(self.ts)
+
+    @classmethod
+    def from_entries(cls, entries: Iterable[Dict[str, Any]], kind: str = "food") -> "DiaryColumns":
+        cols = cls()
+        cols.extend(entries, kind)
+        return cols
+
+    def _code_for(self, value) -> int:
+        code = self._type_code.get(value)
+        if code is None:
+            code = self._type_code[value] = len(self.types)
+            self.types.append(value)
+        return code
+
+    def extend(self, entries: Iterable[Dict[str, Any]], kind: str = "food"):
+        rows = sorted(
+            ((parse_ts(e.get("ts")), i, e) for i, e in enumerate(entries) if isinstance(e, dict)),
+            key=lambda r: (r[0] or 0.0, r[1]),
+        )
+        for epoch, _, e in rows:
+            self._insert(e, kind, epoch)
+
+    def _insert(self, e: Dict[str, Any], kind: str, epoch: Optional[float]):
+        extra = {k: v for k, v in e.items() if k not in _CORE}
+        if epoch is None:
+            # нестандартное или отсутствующее время храним как есть, строка встаёт в начало
+            epoch = 0.0
+            extra["ts"] = e["ts"] if "ts" in e else _MISSING
+        pos = bisect_right(self.ts, epoch)
+        if pos != len(self.ts):
+            # запись не в хвост — сдвигаем номера строк в extra
+            self.extra = {(i + 1 if i >= pos else i): v for i, v in self.extra.items()}
+        mask = 0
+        nums = []
+        for bit, name in enumerate(NUM_FIELDS):
+            v = e.get(name)
+            if isinstance(v, bool) or not isinstance(v, (int, float)):
+                if name in e:
+                    extra[name] = v
+                nums.append(_NAN)
+                continue
+            if isinstance(v, int):
+                mask |= 1 << bit
+            nums.append(float(v))
+        self.ts.insert(pos, epoch)
+        self.kind.insert(pos, _KIND_CODE[kind])
+        kind_type = e.get("type", _MISSING)
+        if kind_type is not _MISSING and not isinstance(kind_type, str):
+            extra["type"] = kind_type  # в таблицу типов — только строки
+            kind_type = _MISSING
+        self.type.insert(pos, -1 if kind_type is _MISSING else self._code_for(kind_type))
+        for col, v in zip((self.kcal, self.p, self.f, self.c), nums):
+            col.insert(pos, v)
+        self.int_mask.insert(pos, mask)
+        self.texts.insert(pos, e.get("text") if "text" in e else _MISSING)
+        if extra:
+            self.extra[pos] = extra
+
+    def entry(self, i: int) -> Dict[str, Any]:
+        e: Dict[str, Any] = {}
+        extra = self.extra.get(i, {})
+        ts = extra.get("ts", self.ts[i])
+        if ts is not _MISSING:
+            e["ts"] = format_ts(ts) if isinstance(ts, float) else ts
+        if self.texts[i] is not _MISSING:
+            e["text"] = self.texts[i]
+        if self.type[i] >= 0:
+            e["type"] = self.types[self.type[i]]
+        mask = self.int_mask[i]
+        for bit, (name, col) in enumerate(zip(NUM_FIELDS, (self.kcal, self.p, self.f, self.c))):
+            v = col[i]
+            if v == v:
+                e[name] = int(v) if mask >> bit & 1 else v
+        for k, v in extra.items():
+            if k != "ts":
+                e[k] = v
+        return e
+
+    def to_entries(self, lo: int = 0, hi: Optional[int] = None, kind: Optional[str] = None) -> List[Dict[str, Any]]:
+        hi = len(self) if hi is None else hi
+        code = None if kind is None else _KIND_CODE[kind]
+        return [self.entry(i) for i in range(lo, hi) if code is None or self.kind[i] == code]
+
+    # --- выборки по времени ---
+
+    def span(self, start: float, end: float) -> Tuple[int, int]:
+        """Строки с start <= ts < end."""
+        return bisect_left(self.ts, start), bisect_left(self.ts, end)
+
+    def day(self, day: str) -> Tuple[int, int]:
+        t0 = day_start(day)
+        return self.span(t0, t0 + 86400)
+
+    def week(self, day: str) -> Tuple[int, int]:
+        """Неделя (пн–вс), в которую попадает day."""
+        d = date(int(day[0:4]), int(day[5:7]), int(day[8:10]))
+        monday = d - timedelta(days=d.weekday())
+        t0 = day_start(monday.isoformat())
+        return self.span(t0, t0 + 7 * 86400)
+
+    def totals(self, lo: int, hi: int, kind: str = "food") -> Dict[str, float]:
+        """Суммы kcal/p/f/c и число записей вида kind в строках [lo, hi)."""
+        code = _KIND_CODE[kind]
+        out = dict.fromkeys(NUM_FIELDS, 0.0)
+        n = 0
+        cols = (self.kcal, self.p, self.f, self.c)
+        for i in range(lo, hi):
+            if self.kind[i] != code:
+                continue
+            n += 1
+            for name, col in zip(NUM_FIELDS, cols):
+                v = col[i]
+                if v == v:
+                    out[name] += v
+        out["n"] = n
+        return out
+
+    def nbytes(self) -> int:
+        """Примерный объём: массивы + строки текстов/типов + словари extra."""
+        size = sum(col.itemsize * len(col) for col in (self.ts, self.kind, self.type, self.kcal, self.p,
+                                                       self.f, self.c, self.int_mask))
+        size += sys.getsizeof(self.texts) + sum(sys.getsizeof(t) for t in self.texts if isinstance(t, str))
+        size += sum(sys.getsizeof(t) for t in self.types)
+        size += sum(sys.getsizeof(v) for v in self.extra.values())
+        return size
+
@@ -0,0 +1,73 @@
+"""Потоковая выгрузка дневников в CSV или JSONL.
+
+Записи приходят генератором (месяц за месяцем, по одному разделу в памяти; в боте —
+копии DiaryStore.month_rows, снятые в event loop), превращаются в строки и пишутся в файл кусками по CHUNK_ROWS
+строк. Память не зависит от длины истории: ни весь дневник, ни весь файл целиком
+в ней не собираются.
+"""
+
+import csv
+import io
+import json
+from typing import Any, Dict, Iterable, Iterator, Tuple
+
+FORMATS = ("csv", "jsonl")
+COLUMNS = ("kind", "ts", "text", "kcal", "p", "f", "c", "type", "extra")
+CHUNK_ROWS = 500
+
+Row = Tuple[str, Dict[str, Any]]
+
+
+def _split(entry: Dict[str, Any]) -> Tuple[list, Dict[str, Any]]:
+    core = [entry.get(k) for k in COLUMNS[1:-1]]
+    extra = {k: v for k, v in entry.items() if k not in COLUMNS}
+    return core, extra
+
+
+def csv_chunks(rows: Iterable[Row], chunk_rows: int = CHUNK_ROWS) -> Iterator[str]:
+    buf = io.StringIO()
+    w = csv.writer(buf)
+    w.writerow(COLUMNS)
+    n = 0
+    for kind, entry in rows:
+        core, extra = _split(entry)
+        w.writerow([kind, *("" if v is None else v for v in core),
+                    json.dumps(extra, ensure_ascii=False, default=str) if extra else ""])
+        n += 1
+        if n % chunk_rows == 0:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+    if buf.tell():
+        yield buf.getvalue()
+
+
+def jsonl_chunks(rows: Iterable[Row], chunk_rows: int = CHUNK_ROWS) -> Iterator[str]:
+    lines = []
+    for kind, entry in rows:
+        lines.append(json.dumps(dict(entry, kind=kind), ensure_ascii=False, default=str))
+        if len(lines) >= chunk_rows:
+            yield "\n".join(lines) + "\n"
+            lines = []
+    if lines:
+        yield "\n".join(lines) + "\n"
+
+
+def write_export(rows: Iterable[Row], fmt: str, path: str) -> int:
+    """Пишет выгрузку в path, возвращает число записей. Вызывать в потоке (to_thread)."""
+    if fmt not in FORMATS:
+        raise ValueError(f"unknown export format: {fmt}")
+    count = 0
+
+    def counted():
+        nonlocal count
+        for row in rows:
+            count += 1
+            yield row
+
+    chunks = csv_chunks(counted()) if fmt == "csv" else jsonl_chunks(counted())
+    # BOM — чтобы Excel открыл CSV с кириллицей без мастера импорта
+    with open(path, "w", encoding="utf-8-sig" if fmt == "csv" else "utf-8", newline="") as f:
+        for chunk in chunks:
+            f.write(chunk)
+    return count
@@ -4,6 +4,12 @@ from flask import Flask, jsonify
 
 app = Flask(__name__)
 
+# имя → функция без аргументов, возвращающая словарь; регистрирует main.py
+_metrics = {}
+
+def register_metrics(name, fn):
+    _metrics[name] = fn
+
 @app.get("/")
 def index():
     return "OK", 200
@@ -12,6 +18,16 @@ def index():
 def health():
     return jsonify({"ok": True}), 200
 
+@app.get("/metrics")
+def metrics():
+    out = {}
+    for name, fn in list(_metrics.items()):
+        try:
+            out[name] = fn()
+        except Exception as e:
+            out[name] = {"error": str(e)}
+    return jsonify(out), 200
+
 def run():
     # ЯВНО отключаем reloader, порт читаем из ENV (дефолт 8080)
     port = int(os.getenv("PORT", 8080))
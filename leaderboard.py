@@ -0,0 +1,164 @@
+"""Индекс рейтинга по баллам: индексируемый skip list.
+
+Порядок — по убыванию баллов, при равенстве — по id пользователя.
+Обновление, место пользователя и топ-N — за O(log n) без обхода
+записей других пользователей.
+"""
+
+import random
+from typing import Dict, List, Optional, Tuple
+
+MAX_LEVELS = 24
+
+
+class _Inf:
+    """Ключ хвостового узла: больше любого настоящего ключа."""
+
+    def __lt__(self, other):
+        return False
+
+    def __le__(self, other):
+        return other is self
+
+    def __gt__(self, other):
+        return other is not self
+
+    def __ge__(self, other):
+        return True
+
+
+class _Node:
+    __slots__ = ("key", "next", "width")
+
+    def __init__(self, key, next_nodes, widths):
+        self.key = key
+        self.next = next_nodes
+        self.width = widths
+
+
+_NIL = _Node(_Inf(), [], [])
+
+
+class RankIndex:
+    """Отсортированное множество ключей с доступом к позиции за O(log n).
+
+    ``width[level]`` у узла — на сколько позиций переносит ссылка этого уровня,
+    поэтому ранг ключа — сумма ширин по пути поиска.
+    """
+
+    def __init__(self, max_levels: int = MAX_LEVELS, seed: Optional[int] = None):
+        self.max_levels = max_levels
+        self.size = 0
+        self._head = _Node(None, [_NIL] * max_levels, [1] * max_levels)
+        self._rng = random.Random(seed)
+
+    def __len__(self) -> int:
+        return self.size
+
+    def _random_level(self) -> int:
+        level = 1
+        while level < self.max_levels and self._rng.random() < 0.5:
+            level += 1
+        return level
+
+    def insert(self, key) -> None:
+        chain = [None] * self.max_levels
+        steps_at_level = [0] * self.max_levels
+        node = self._head
+        for level in reversed(range(self.max_levels)):
+            while node.next[level].key <= key:
+                steps_at_level[level] += node.width[level]
+                node = node.next[level]
+            chain[level] = node
+        d = self._random_level()
+        new = _Node(key, [None] * d, [None] * d)
+        steps = 0
+        for level in range(d):
+            prev = chain[level]
+            new.next[level] = prev.next[level]
+            prev.next[level] = new
+            new.width[level] = prev.width[level] - steps
+            prev.width[level] = steps + 1
+            steps += steps_at_level[level]
+        for level in range(d, self.max_levels):
+            chain[level].width[level] += 1
+        self.size += 1
+
+    def remove(self, key) -> None:
+        chain = [None] * self.max_levels
+        node = self._head
+        for level in reversed(range(self.max_levels)):
+            while node.next[level].key < key:
+                node = node.next[level]
+            chain[level] = node
+        target = chain[0].next[0]
+        if target is _NIL or target.key != key:
+            raise KeyError(key)
+        for level in range(len(target.next)):
+            prev = chain[level]
+            prev.width[level] += target.width[level] - 1
+            prev.next[level] = target.next[level]
+        for level in range(len(target.next), self.max_levels):
+            chain[level].width[level] -= 1
+        self.size -= 1
+
+    def rank(self, key) -> Optional[int]:
+        """Позиция ключа, начиная с 1, или None."""
+        node, pos = self._head, 0
+        for level in reversed(range(self.max_levels)):
+            while node.next[level].key < key:
+                pos += node.width[level]
+                node = node.next[level]
+        nxt = node.next[0]
+        return pos + 1 if nxt is not _NIL and nxt.key == key else None
+
+    def head(self, n: int) -> List:
+        out = []
+        node = self._head.next[0]
+        while node is not _NIL and len(out) < n:
+            out.append(node.key)
+            node = node.next[0]
+        return out
+
+
+class Leaderboard:
+    """Баллы пользователей поверх RankIndex: update / rank / top."""
+
+    def __init__(self, seed: Optional[int] = None):
+        self._index = RankIndex(seed=seed)
+        self._points: Dict[str, int] = {}
+
+    @staticmethod
+    def _key(uid: str, points: int) -> Tuple[int, str]:
+        return (-points, uid)
+
+    def __len__(self) -> int:
+        return len(self._points)
+
+    def __contains__(self, uid) -> bool:
+        return str(uid) in self._points
+
+    def points(self, uid) -> Optional[int]:
+        return self._points.get(str(uid))
+
+    def update(self, uid, points: int) -> bool:
+        """Ставит пользователю баллы. False, если ничего не изменилось."""
+        uid, points = str(uid), int(points)
+        old = self._points.get(uid)
+        if old == points:
+            return False
+        if old is not None:
+            self._index.remove(self._key(uid, old))
+        self._index.insert(self._key(uid, points))
+        self._points[uid] = points
+        return True
+
+    def rank(self, uid) -> Optional[int]:
+        uid = str(uid)
+        points = self._points.get(uid)
+        if points is None:
+            return None
+        return self._index.rank(self._key(uid, points))
+
+    def top(self, n: int = 10) -> List[Dict[str, object]]:
+        return [{"user_id": uid, "points": -neg} for neg, uid in self._index.head(n)]
@@ -0,0 +1,153 @@
+"""Сторож цикла событий: замер задержки (lag) и место, где цикл был заблокирован.
+
+Поток раз в interval секунд ставит в цикл пустой колбэк (call_soon_threadsafe) и ждёт,
+когда тот выполнится. Если за threshold секунд колбэк не выполнен — цикл занят синхронной
+работой: поток снимает стек потока цикла (sys._current_frames) и пока цикл стоит, повторяет
+снимок каждые threshold секунд. По завершении задержки место блокировки (ближайший к
+вершине стека кадр из кода проекта + самый верхний кадр) попадает в лог и в счётчик мест.
+
+Сам цикл не трогается, накладные расходы — один колбэк за interval.
+"""
+
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Any, Dict, List, Optional, Tuple
+
+logger = logging.getLogger("healco-lite")
+
+_ROOT = os.path.dirname(os.path.abspath(__file__))
+_THIRD_PARTY = ("site-packages", "dist-packages")
+LAG_BUCKETS_MS = (50, 100, 250, 500, 1000, 5000)
+
+
+def _own(filename: str) -> bool:
+    return filename.startswith(_ROOT) and not any(p in filename for p in _THIRD_PARTY) \
+        and filename != __file__
+
+
+def _where(frame) -> str:
+    path = frame.f_code.co_filename
+    if path.startswith(_ROOT):
+        path = os.path.relpath(path, _ROOT)
+    else:
+        path = "/".join(path.split(os.sep)[-2:])
+    return f"{path}:{frame.f_lineno} {frame.f_code.co_name}"
+
+
+def call_site(frame) -> Tuple[str, str]:
+    """(место в коде проекта, самый верхний кадр) для стека, начинающегося с frame."""
+    leaf = _where(frame) if frame is not None else "?"
+    while frame is not None:
+        if _own(frame.f_code.co_filename):
+            return _where(frame), leaf
+        frame = frame.f_back
+    return leaf, leaf
+
+
+class LoopWatchdog:
+    def __init__(self, threshold: float = 0.2, interval: Optional[float] = None, top: int = 10):
+        self.threshold = threshold
+        self.interval = interval if interval is not None else max(threshold / 2, 0.01)
+        self.top = top
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread: Optional[int] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self.checks = 0
+        self.stalls = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self.blocked = 0.0  # суммарное время задержек выше порога, сек
+        self.buckets = [0] * (len(LAG_BUCKETS_MS) + 1)
+        self.sites: Counter = Counter()  # место → сколько задержек на нём поймано
+        self._leaves: Dict[str, str] = {}
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, loop: Optional[asyncio.AbstractEventLoop] = None):
+        """Вызывать из потока цикла (post_init): запоминается его поток."""
+        if self.running or self.threshold <= 0:
+            return
+        self._loop = loop or asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True, name="loop-watchdog")
+        self._thread.start()
+
+    def stop(self, timeout: float = 2.0):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            done = threading.Event()
+            posted = time.monotonic()
+            try:
+                self._loop.call_soon_threadsafe(done.set)
+            except RuntimeError:  # цикл закрыт
+                return
+            samples: Counter = Counter()
+            leaves: Dict[str, str] = {}
+            while not done.wait(self.threshold):
+                if self._stop.is_set():
+                    return
+                frame = sys._current_frames().get(self._loop_thread)
+                site, leaf = call_site(frame)
+                del frame
+                samples[site] += 1
+                leaves.setdefault(site, leaf)
+            self._record(time.monotonic() - posted, samples, leaves)
+
+    def _record(self, lag: float, samples: Counter, leaves: Dict[str, str]):
+        ms = lag * 1000
+        with self._lock:
+            self.checks += 1
+            self.last_lag = lag
+            self.max_lag = max(self.max_lag, lag)
+            self.buckets[next((i for i, b in enumerate(LAG_BUCKETS_MS) if ms <= b), len(LAG_BUCKETS_MS))] += 1
+            if lag < self.threshold:
+                return
+            self.stalls += 1
+            self.blocked += lag
+            if not samples:
+                return  # цикл освободился между проверками — места нет
+            site = samples.most_common(1)[0][0]
+            self.sites[site] += 1
+            self._leaves.setdefault(site, leaves[site])
+            seen = self.sites[site]
+        leaf = leaves[site]
+        logger.warning(f"Event loop blocked {ms:.0f} ms at {site}"
+                       + (f" (in {leaf})" if leaf != site else "") + f" — {seen}x since start")
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            buckets = {f"le_{b}ms": n for b, n in zip(LAG_BUCKETS_MS, self.buckets)}
+            buckets["gt_%dms" % LAG_BUCKETS_MS[-1]] = self.buckets[-1]
+            return {
+                "threshold_ms": round(self.threshold * 1000),
+                "checks": self.checks,
+                "stalls": self.stalls,
+                "last_lag_ms": round(self.last_lag * 1000, 1),
+                "max_lag_ms": round(self.max_lag * 1000, 1),
+                "blocked_ms_total": round(self.blocked * 1000),
+                "lag_buckets": buckets,
+                "top_sites": [{"site": s, "count": n, "leaf": self._leaves.get(s)}
+                              for s, n in self.sites.most_common(self.top)],
+            }
+
+    def summary(self) -> List[str]:
+        m = self.metrics()
+        lines = [f"Задержка цикла: сейчас {m['last_lag_ms']} мс, макс {m['max_lag_ms']} мс, "
+                 f"блокировок > {m['threshold_ms']} мс: {m['stalls']}"]
+        lines.extend(f"  {s['count']}× {s['site']}" for s in m["top_sites"][:5])
+        return lines
@@ -18,8 +18,22 @@ import requests
 import httpx
 import difflib
 import traceback
+import threading
+import time
+import atexit
+import copy
+import contextvars
+import functools
+import gc
+import weakref
+import shutil
+import multiprocessing
+import base64
+import zlib
+import tempfile
+from collections import OrderedDict
 from dataclasses import dataclass
-from datetime import datetime
+from datetime import datetime, timedelta
 from typing import Dict, Any, List, Optional, Tuple
 from requests_oauthlib import OAuth1
 
@@ -29,6 +43,18 @@ from pathlib import Path
 from dotenv import load_dotenv
 from openai import OpenAI
 from wger_api import fetch_exercises
+from leaderboard import Leaderboard
+import record_codec
+import snapshots
+import sharding
+import diary_export
+import memprof
+import loop_watchdog
+import singleflight
+from diary_columns import DiaryColumns
+from nutri_cache import NegativeCache, NutritionCache, clone_value
+from nutrition import EMPTY_VECTOR, NutritionResult, canonical_query, quantity_key, scale_vector
+from storage import AsyncStorage, SQLiteStateDB, MemoryDB, PrefixRouter, open_store
 
 # ========= ЛОГИ =========
 logging.basicConfig(
@@ -64,6 +90,7 @@ from telegram.ext import (
     ContextTypes,
     filters,
     PreCheckoutQueryHandler,
+    TypeHandler,
 )
 
 VERSION = "healco lite v1.2"
@@ -101,28 +128,33 @@ TELEGRAM_PAYMENT_PROVIDER_TOKEN = get_secret("TELEGRAM_PAYMENT_PROVIDER_TOKEN",
 DEVELOPER_USER_ID = int(get_secret("DEVELOPER_USER_ID", "0").split(",")[0]) if get_secret("DEVELOPER_USER_ID", "0").split(",")[0].isdigit() else 0
 
 # Admin users list - stored in database
-def get_admin_users() -> List[int]:
-    """Get list of admin user IDs"""
+def _read_admin_users() -> List[int]:
     admins = db_get("admin_users", [])
     if isinstance(admins, list):
         return [int(uid) for uid in admins if str(uid).isdigit()]
     return []
 
+def get_admin_users() -> List[int]:
+    """Get list of admin user IDs"""
+    return list(entitlements.admin_list())
+
 def add_admin_user(user_id: int) -> bool:
     """Add user to admin list"""
-    admins = get_admin_users()
+    admins = _read_admin_users()
     if user_id not in admins:
         admins.append(user_id)
         db_set("admin_users", admins)
+        entitlements.invalidate_admins()
         return True
     return False
 
 def remove_admin_user(user_id: int) -> bool:
     """Remove user from admin list"""
-    admins = get_admin_users()
+    admins = _read_admin_users()
     if user_id in admins:
         admins.remove(user_id)
         db_set("admin_users", admins)
+        entitlements.invalidate_admins()
         return True
     return False
 
@@ -148,69 +180,49 @@ GOOGLE_CSE_CX  = get_secret("GOOGLE_CSE_CX", "")
 VISION_KEY     = get_secret("VISION_KEY", "")        # опционально
 USDA_API_KEY   = get_secret("USDA_FDC_API_KEY", "cOQTpuHzZ2aOOpixNXoi8f5n94nEu5RvRoGf3o88")
 
-class LocalDB:
-    def __init__(self, path="db.json"):
-        self.path = path
-        if not os.path.exists(self.path):
-            with open(self.path, "w", encoding="utf-8") as f:
-                json.dump({}, f, ensure_ascii=False, indent=2)
-        self._load()
-
-    def _load(self):
-        try:
-            with open(self.path, "r", encoding="utf-8") as f:
-                self.store = json.load(f)
-        except Exception:
-            self.store = {}
-
-    def _save(self):
-        with open(self.path, "w", encoding="utf-8") as f:
-            json.dump(self.store, f, ensure_ascii=False, indent=2)
-
-    def __getitem__(self, k):
-        return self.store.get(k)
-
-    def __setitem__(self, k, v):
-        self.store[k] = v
-        self._save()
-
-    def __contains__(self, k):
-        return k in self.store
-
-    def keys(self):
-        return list(self.store.keys())
+STORAGE_BACKEND = os.getenv("HLITE_STORAGE", "replit" if HAS_REPLIT else "json").lower()  # memory | json | sqlite | replit
+
+# режим шардов (см. sharding.py): фронт раздаёт апдейты, воркер HLITE_SHARD_INDEX владеет своей долей пользователей
+SHARD_COUNT = max(1, int(os.getenv("HLITE_SHARDS", "1")))
+SHARD_INDEX = int(os.environ["HLITE_SHARD_INDEX"]) if os.getenv("HLITE_SHARD_INDEX") else None
+SHARED_PATH = os.getenv("HLITE_SHARED_PATH", "./data/shared.db")
+
+def _open_local_db():
+    if SHARD_COUNT > 1 and SHARD_INDEX is None:
+        return MemoryDB()  # фронт состояний не трогает
+    index = SHARD_INDEX or 0
+    store = open_store(
+        STORAGE_BACKEND,
+        json_path=sharding.shard_path(os.environ.get("HLITE_DB_PATH", "db.json"), index, SHARD_COUNT),
+        sqlite_path=sharding.shard_path(os.getenv("HLITE_SQLITE_PATH", "./data/state.db"), index, SHARD_COUNT),
+        replit=replit_db if HAS_REPLIT else None,
+    )
+    if SHARD_COUNT > 1 and STORAGE_BACKEND != "replit":
+        store = PrefixRouter(store, SQLiteStateDB(SHARED_PATH, shared=True), sharding.SHARED_PREFIXES)
+    return store
 
-local_db = LocalDB(os.environ.get("HLITE_DB_PATH", "db.json"))
+# хранилище процесса (см. storage.py); имя историческое — это не обязательно локальный файл
+local_db = _open_local_db()
+atexit.register(local_db.close)
 
 def db_get(k, default=None):
-    if HAS_REPLIT:
-        try:
-            return replit_db.get(k, default)
-        except Exception:
-            # Если Replit DB недоступна, используем локальную
-            return local_db.store.get(k, default)
-    # Если Replit недоступен, используем локальную
-    return local_db.store.get(k, default)
+    return local_db.get(k, default)
+
+def db_get_many(keys) -> Dict[str, Any]:
+    return local_db.get_many(keys)
 
 def db_set(k, v):
-    if HAS_REPLIT:
-        try:
-            replit_db[k] = v
-            return
-        except Exception:
-            # Если Replit DB недоступна, записываем в локальную
-            pass
-    # Записываем в локальную БД
     local_db[k] = v
 
+def db_delete(k):
+    del local_db[k]
+
+def db_cas(k, expected: int, v) -> bool:
+    """Запись при совпадении версии (_v)."""
+    return local_db.cas(k, expected, v)
+
 def db_keys_prefix(prefix: str) -> List[str]:
-    try:
-        # Пытаемся получить ключи из Replit DB, если доступно
-        src = replit_db.keys() if HAS_REPLIT else local_db.keys()
-        return [k for k in src if str(k).startswith(prefix)]
-    except Exception:
-        # Если Replit DB недоступна, возвращаем ключи из локальной БД
-        return [k for k in local_db.keys() if str(k).startswith(prefix)]
+    return local_db.keys_prefix(prefix)
 
 # ========= КНОПКИ =========
 MAIN_MENU = [
@@ -491,38 +503,515 @@ def default_state() -> Dict[str, Any]:
             "injuries": "",
             "preferences": {"menu_notes": "", "workout_notes": ""},
         },
-        "diaries": {"food": [], "train": [], "metrics": []},
-        "daily_energy": {},
         "awards": {},
         "points": 0,
         "access_level": "free",  # free/basic/premium/maximum
         "current_role": None,
         "awaiting": None,
-        "tmp": {},
     }
 
-def load_state(uid: int) -> Dict[str, Any]:
-    s = db_get(state_key(uid))
-    if not s:
-        s = default_state()
-        db_set(state_key(uid), s)
+STATE_FLUSH_INTERVAL = float(os.getenv("HLITE_FLUSH_INTERVAL", "2"))   # окно возможной потери, сек
+STATE_FLUSH_MAX_DIRTY = int(os.getenv("HLITE_FLUSH_MAX_DIRTY", "200"))  # сброс раньше срока
+
+class StateWriteBehind:
+    """
+    Отложенная запись состояний: save_state лишь помечает пользователя «грязным»,
+    а фоновая задача раз в interval секунд (или при max_dirty грязных) пишет
+    каждое состояние один раз. Повторные save_state за один апдейт схлопываются.
+    Пока фоновая задача не запущена (тесты, скрипты), запись идёт сразу.
+    """
+
+    def __init__(self, interval: float = STATE_FLUSH_INTERVAL, max_dirty: int = STATE_FLUSH_MAX_DIRTY):
+        self.interval = interval
+        self.max_dirty = max_dirty
+        self._dirty: Dict[int, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self.requested = 0
+        self.written = 0
+
+    def mark(self, uid: int, s: Dict[str, Any]):
+        self.requested += 1
+        if self._task is None:
+            _commit_state(uid, s)
+            self.written += 1
+            return
+        with self._lock:
+            self._dirty[uid] = s
+            overflow = len(self._dirty) >= self.max_dirty
+        if overflow:
+            self.flush()
+
+    def get(self, uid: int) -> Optional[Dict[str, Any]]:
+        return self._dirty.get(uid)
+
+    def flush(self) -> int:
+        with self._lock:
+            dirty, self._dirty = self._dirty, {}
+        for uid, s in dirty.items():
+            try:
+                _commit_state(uid, s)
+                self.written += 1
+            except Exception as e:
+                logger.error(f"State flush failed for {uid}: {e}")
+                with self._lock:
+                    self._dirty.setdefault(uid, s)
+        return len(dirty)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            self.flush()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        task, self._task = self._task, None
+        if task:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self.flush()
+
+state_writer = StateWriteBehind()
+atexit.register(state_writer.flush)
+
+STATE_CACHE_MB = float(os.getenv("HLITE_STATE_CACHE_MB", "64"))
+
+def _state_footprint(s: Dict[str, Any]) -> int:
+    # оценка по размеру сериализации — дёшево (C-кодер) и монотонно растёт вместе с объектом
+    try:
+        return len(json.dumps(s, ensure_ascii=False, default=str))
+    except Exception:
+        return 4096
+
+class StateCache:
+    """
+    LRU живых (уже разобранных и нормализованных) состояний по uid.
+    Попадание отдаёт тот же объект без чтения и разбора записи; вытеснение — по суммарному объёму.
+    Вытесненное «грязное» состояние не теряется: load_state сначала смотрит в state_writer.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._items: "OrderedDict[int, Tuple[Dict[str, Any], int]]" = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, uid: int) -> Optional[Dict[str, Any]]:
+        item = self._items.get(uid)
+        if item is None:
+            self.misses += 1
+            return None
+        self._items.move_to_end(uid)
+        self.hits += 1
+        return item[0]
+
+    def put(self, uid: int, s: Dict[str, Any], size: Optional[int] = None):
+        size = size if size is not None else _state_footprint(s)
+        old = self._items.pop(uid, None)
+        if old:
+            self.bytes -= old[1]
+        self._items[uid] = (s, size)
+        self.bytes += size
+        self._evict()
+
+    def resize(self, uid: int, s: Dict[str, Any], size: int):
+        """Новая оценка объёма закэшированного состояния (после записи — оно могло вырасти)."""
+        item = self._items.get(uid)
+        if item is None or item[0] is not s:
+            return
+        self._items[uid] = (s, size)
+        self.bytes += size - item[1]
+        self._evict()
+
+    def _evict(self):
+        while self.bytes > self.max_bytes and len(self._items) > 1:
+            _, (_, evicted) = self._items.popitem(last=False)
+            self.bytes -= evicted
+
+    def contains(self, uid: int, s: Dict[str, Any]) -> bool:
+        item = self._items.get(uid)
+        return item is not None and item[0] is s
+
+    def __contains__(self, uid: int) -> bool:
+        return uid in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+state_cache = StateCache(int(STATE_CACHE_MB * 1024 * 1024))
+
+SESSION_TTL = float(os.getenv("HLITE_SESSION_TTL", str(6 * 3600)))
+PERSIST_AWAITING = os.getenv("HLITE_PERSIST_AWAITING", "1") == "1"
+# шаги, которые без черновика из tmp не продолжить: после истечения сессии указатель на них сбрасывается
+_SCRATCH_STEPS = frozenset({
+    "recipe_number", "add_recipe_to_diary", "brand_portion_input", "confirm_save_menu",
+    "workout_location", "workout_inventory",
+})
+# поля, которые не пишутся в запись пользователя
+_TRANSIENT_FIELDS = ("tmp", "_base") if PERSIST_AWAITING else ("tmp", "awaiting", "_base")
+
+class SessionStore:
+    """
+    Черновик диалога (st["tmp"], st["awaiting"]) в памяти процесса с TTL, отдельно от записи
+    пользователя: списки рецептов, тексты меню/плана, незавершённая запись из брендового поиска
+    больше не переписываются при каждом save_state.
+    load_state подставляет сессию в состояние (attach), save_state запоминает её (detach).
+    Сессия живёт ttl секунд с последнего обращения; после этого tmp очищается, а awaiting
+    восстанавливается из записи (HLITE_PERSIST_AWAITING=1), если шагу не нужен черновик.
+    """
+
+    def __init__(self, ttl: float = SESSION_TTL):
+        self.ttl = ttl
+        self._items: Dict[int, list] = {}  # uid → [последнее обращение, tmp, awaiting]
+        self._swept = time.monotonic()
+        self.expired = 0
+
+    def attach(self, uid: int, s: Dict[str, Any]) -> Dict[str, Any]:
+        now = time.monotonic()
+        item = self._items.get(uid)
+        if item is None or now - item[0] > self.ttl:
+            if item is not None:
+                item[1].clear()
+                self.expired += 1
+            step = s.get("awaiting") if PERSIST_AWAITING else None
+            item = self._items[uid] = [now, {}, None if step in _SCRATCH_STEPS else step]
+            s["tmp"], s["awaiting"] = item[1], item[2]
+        elif s.get("tmp") is not item[1]:
+            # состояние перечитано из базы, а сессия ещё жива
+            s["tmp"], s["awaiting"] = item[1], item[2]
+        item[0] = now
+        if now - self._swept > max(60.0, self.ttl / 4):
+            self.sweep(now)
+        return s
+
+    def detach(self, uid: int, s: Dict[str, Any]):
+        tmp = s.get("tmp")
+        if not isinstance(tmp, dict):
+            tmp = s["tmp"] = {}
+        self._items[uid] = [time.monotonic(), tmp, s.get("awaiting")]
+
+    def sweep(self, now: Optional[float] = None) -> int:
+        now = time.monotonic() if now is None else now
+        self._swept = now
+        stale = [uid for uid, item in self._items.items() if now - item[0] > self.ttl]
+        for uid in stale:
+            # очищаем на месте: тот же словарь может висеть в состоянии из state_cache
+            self._items.pop(uid)[1].clear()
+        self.expired += len(stale)
+        return len(stale)
+
+    def __len__(self):
+        return len(self._items)
+
+sessions = SessionStore()
+
+def _persisted(s: Dict[str, Any]) -> Dict[str, Any]:
+    """Запись пользователя без черновика диалога."""
+    return {k: v for k, v in s.items() if k not in _TRANSIENT_FIELDS}
+
+def _migrate_legacy_tmp(s: Dict[str, Any]) -> bool:
+    """Старые записи хранили tmp целиком; долговечные счётчики из него поднимаем на верхний уровень."""
+    tmp = s.pop("tmp", None)
+    if not isinstance(tmp, dict):
+        return tmp is not None
+    for key in ("menu_day_counter", "used_random_recipe"):
+        if key in tmp:
+            s.setdefault(key, tmp[key])
+    return True
+
+_user_locks: "weakref.WeakValueDictionary[int, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+def user_lock(uid: int) -> asyncio.Lock:
+    lock = _user_locks.get(uid)
+    if lock is None:
+        lock = asyncio.Lock()
+        _user_locks[uid] = lock
+    return lock
+
+def per_user(handler):
+    """Апдейты одного пользователя обрабатываются по очереди, разных — параллельно."""
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        u = update.effective_user
+        if u is None:
+            return await handler(update, context)
+        async with user_lock(u.id):
+            await prefetch_state(u.id)
+            return await handler(update, context)
+    return wrapper
+
+# ========= РЕЙТИНГ =========
+# Индекс баллов в памяти; на диске — крошечные записи lb:{uid}, чтобы при старте
+# не поднимать состояния всех пользователей.
+# В режиме шардов баллы чужих пользователей подтягиваются из общего хранилища фоновой
+# задачей раз в SHARED_REFRESH сек (refresh_shared_ranks) — не на пути save_state.
+SHARED_REFRESH = 30.0
+leaderboard = Leaderboard()
+_leaderboard_persisted: Dict[str, int] = {}
+_leaderboard_loaded = False
+_shard_ring = sharding.HashRing(range(SHARD_COUNT)) if SHARD_COUNT > 1 else None
+
+def ensure_leaderboard() -> Leaderboard:
+    global _leaderboard_loaded
+    if _leaderboard_loaded:
+        return leaderboard
+    _leaderboard_loaded = True
+    keys = db_keys_prefix("lb:")
+    if keys:
+        _apply_ranks(db_get_many(keys))
+    else:
+        # первый запуск с индексом — один раз собираем баллы из записей пользователей
+        for k in db_keys_prefix("user:"):
+            st = db_get(k, {})
+            if isinstance(st, dict):
+                _sync_rank(k.split(":", 1)[1], int(st.get("points", 0)), persist=True)
+    logger.info(f"Leaderboard index: {len(leaderboard)} users")
+    return leaderboard
+
+def _apply_ranks(records: Dict[str, Any], foreign_only: bool = False) -> int:
+    changed = 0
+    for k, v in records.items():
+        try:
+            uid, pts = k.split(":", 1)[1], int(v or 0)
+        except (TypeError, ValueError):
+            continue
+        # свои пользователи в памяти свежее, чем на диске (write-behind)
+        if foreign_only and _shard_ring.node_for(uid) == SHARD_INDEX:
+            continue
+        changed += leaderboard.update(uid, pts)
+        _leaderboard_persisted[uid] = pts
+    return changed
+
+async def _read_ranks() -> Dict[str, Any]:
+    db = AsyncStorage(local_db)
+    return await db.get_many(await db.scan_prefix("lb:"))
+
+async def refresh_shared_ranks():
+    """Фон воркера шарда: чтение lb:* — через AsyncStorage (общий SQLite — в потоке), в цикле только применение."""
+    while True:
+        await asyncio.sleep(SHARED_REFRESH)
+        try:
+            _apply_ranks(await _read_ranks(), foreign_only=True)
+        except Exception as e:
+            logger.warning(f"Shared leaderboard refresh failed: {e}")
+
+def _sync_rank(uid, points: int, persist: bool = False):
+    uid = str(uid)
+    ensure_leaderboard().update(uid, points)
+    if persist and _leaderboard_persisted.get(uid) != points:
+        db_set(f"lb:{uid}", points)
+        _leaderboard_persisted[uid] = points
+
+def load_state(uid: int, rec: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Живое состояние пользователя; rec — уже прочитанная запись (см. prefetch_state)."""
+    s = state_cache.get(uid)
+    if s is not None:
+        return sessions.attach(uid, s)
+    s = state_writer.get(uid)
+    migrated, size = False, None
+    if s is None:
+        if rec is None:
+            rec = db_get(state_key(uid))
+        if not rec:
+            rec = default_state()
+            db_set(state_key(uid), rec)
+        # глубокая копия: MemoryDB/LocalDB отдают живой объект, а обработчики правят и вложенные
+        # profile/awards — без копии правка попала бы в хранилище мимо журнала и сверки версии
+        s = copy.deepcopy(rec)
+        migrated = _migrate_legacy_tmp(s)
+        s["_base"], size = _field_sigs(s)
     s.setdefault("profile", {}).setdefault("preferences", {})
-    s.setdefault("diaries", {"food": [], "train": [], "metrics": []})
-    s.setdefault("daily_energy", {})
     s.setdefault("awards", {})
     s.setdefault("points", 0)
     s.setdefault("access_level", "free")
-    s.setdefault("tmp", {})
+    sessions.attach(uid, s)
+    if diary_store.migrate_legacy(uid, s) or migrated:
+        s = _commit_state(uid, s)
+        size = None
+    state_cache.put(uid, s, size)
     return s
 
+async def prefetch_state(uid: int):
+    """
+    Промах state_cache: запись читается через AsyncStorage (у SQLite/Replit — в рабочем потоке,
+    не в event loop) и разбирается в кэш, так что load_state в обработчике берёт её оттуда.
+    Вызывается под замком пользователя (per_user).
+    """
+    if uid in state_cache or state_writer.get(uid) is not None:
+        return
+    rec = await AsyncStorage(local_db).get(state_key(uid))
+    if isinstance(rec, dict) and rec and uid not in state_cache and state_writer.get(uid) is None:
+        load_state(uid, rec)
+
 def save_state(uid: int, s: Dict[str, Any]):
-    db_set(state_key(uid), s)
+    sessions.detach(uid, s)
+    if not state_cache.contains(uid, s):
+        state_cache.put(uid, s)
+    _sync_rank(uid, int(s.get("points", 0)))
+    state_writer.mark(uid, s)
+
+STATE_CAS_RETRIES = 5
+state_metrics = {"cas_conflicts": 0, "lost_updates": 0, "field_conflicts": 0}
+# поля «текущего диалога»: при конфликте берём их из версии обработчика, а не из базы
+_SESSION_FIELDS = ("awaiting", "current_role", "tmp")
+# не сливаются по полям: служебные, диалог (см. выше) и очки (переигрываются из _ops)
+_UNMERGED_FIELDS = frozenset(("_v", "_ops", "_base", "points") + _SESSION_FIELDS)
+
+class StateConflictError(RuntimeError):
+    """Состояние не записано за STATE_CAS_RETRIES попыток; write-behind оставляет его грязным."""
+
+def _field_sig(v) -> int:
+    try:
+        return hash(json.dumps(v, ensure_ascii=False, default=str))
+    except Exception:
+        return id(v)
+
+def _field_sigs(rec: Dict[str, Any]) -> Tuple[Dict[str, int], int]:
+    """
+    Отпечатки полей записи — по ним при конфликте видно, что поменял обработчик —
+    и заодно размер сериализации (оценка объёма для state_cache).
+    """
+    sigs, size = {}, 0
+    for k, v in rec.items():
+        try:
+            dump = json.dumps(v, ensure_ascii=False, default=str)
+        except Exception:
+            dump = ""
+        size += len(k) + len(dump)
+        if k not in _UNMERGED_FIELDS:
+            sigs[k] = hash(dump) if dump else id(v)
+    return sigs, size
+
+def _merge_state(uid: int, s: Dict[str, Any], fresh: Dict[str, Any], ops: List[tuple]) -> Dict[str, Any]:
+    """
+    Версия обработчика поверх свежей записи: поля, изменённые обработчиком (по отпечаткам
+    на момент загрузки), берутся из s, остальные — из базы; очки — база + _ops.
+    Поле, изменённое с обеих сторон, остаётся за обработчиком и считается в field_conflicts.
+    """
+    merged = dict(fresh)
+    base = s.get("_base")
+    if base is not None:
+        for k in (s.keys() | base.keys()) - _UNMERGED_FIELDS:
+            if k in s and k in base and _field_sig(s[k]) == base[k]:
+                continue
+            if k in base and _field_sig(fresh.get(k)) != base[k] and (k in fresh or k in s):
+                state_metrics["field_conflicts"] += 1
+                logger.warning(f"State field {k!r} of {uid} changed concurrently, keeping handler's value")
+            if k in s:
+                merged[k] = s[k]
+            else:
+                merged.pop(k, None)
+    for f in _SESSION_FIELDS:
+        if f in s:
+            merged[f] = s[f]
+    for op in ops:
+        _apply_op(merged, op)
+    return merged
+
+def _commit_state(uid: int, s: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Условная запись состояния по версии, прочитанной обработчиком. При конфликте
+    перечитывает запись, переносит на неё изменения обработчика (_merge_state)
+    и повторяет. Возвращает то состояние, которое легло в базу; если записать
+    не удалось — StateConflictError, а s остаётся с _ops для следующей попытки.
+    """
+    k = state_key(uid)
+    orig = s
+    ops = s.pop("_ops", None) or []
+    for _ in range(STATE_CAS_RETRIES):
+        rec = _persisted(s)
+        if db_cas(k, int(s.get("_v", 0)), rec):
+            s["_v"] = rec["_v"]
+            s["_base"], size = _field_sigs(rec)
+            if state_cache.contains(uid, s):
+                state_cache.resize(uid, s, size)
+            elif uid in state_cache:
+                state_cache.put(uid, s, size)
+            _sync_rank(uid, int(s.get("points", 0)), persist=True)
+            return s
+        state_metrics["cas_conflicts"] += 1
+        logger.warning(f"State version conflict for {uid}, merging handler changes and {len(ops)} ops")
+        fresh = db_get(k)
+        fresh = copy.deepcopy(fresh) if isinstance(fresh, dict) else default_state()
+        s = _merge_state(uid, orig, fresh, ops)
+    state_metrics["lost_updates"] += 1
+    if ops:
+        orig["_ops"] = ops
+    logger.error(f"State for {uid} not saved after {STATE_CAS_RETRIES} version conflicts, will retry")
+    raise StateConflictError(f"state of {uid} not saved after {STATE_CAS_RETRIES} version conflicts")
+
+def _apply_op(st: Dict[str, Any], op: tuple):
+    kind = op[0]
+    if kind == "points":
+        st["points"] = int(st.get("points", 0)) + int(op[1])
+
+def _record_op(st: Dict[str, Any], op: tuple):
+    _apply_op(st, op)
+    st.setdefault("_ops", []).append(op)
+
+SUBSCRIPTION_DAYS = int(os.getenv("HLITE_SUBSCRIPTION_DAYS", "30"))  # 0 — подписка бессрочная
+
+class Entitlements:
+    """
+    Права доступа в памяти: список админов и тарифы пользователей.
+    Админы читаются из БД один раз и перечитываются после add/remove_admin_user
+    (в режиме шардов — ещё и раз в admin_ttl сек., правки приходят из других воркеров),
+    тариф пользователя сбрасывается при оплате. Срок подписки (access_expires, epoch)
+    проверяется лениво — при первом обращении после истечения тариф становится free.
+    """
+
+    def __init__(self, admin_ttl: Optional[float] = None):
+        self.admin_ttl = admin_ttl
+        self._admins: Optional[Tuple[int, ...]] = None
+        self._admins_at = 0.0
+        self._admin_set: frozenset = frozenset()
+        self._tiers: Dict[int, Tuple[str, Optional[float]]] = {}
+
+    def admin_list(self) -> Tuple[int, ...]:
+        if self._admins is None or (self.admin_ttl and time.monotonic() - self._admins_at > self.admin_ttl):
+            self._admins = tuple(_read_admin_users())
+            self._admin_set = frozenset(self._admins)
+            self._admins_at = time.monotonic()
+        return self._admins
+
+    def is_admin(self, user_id: int) -> bool:
+        self.admin_list()
+        return user_id in self._admin_set
+
+    def invalidate_admins(self):
+        self._admins = None
+
+    def invalidate_user(self, user_id: int):
+        self._tiers.pop(user_id, None)
+
+    def tier(self, state: Dict[str, Any], user_id: int) -> str:
+        cached = self._tiers.get(user_id)
+        if cached is None:
+            cached = (state.get("access_level", "free"), state.get("access_expires"))
+            self._tiers[user_id] = cached
+        tier, expires = cached
+        if expires and time.time() >= float(expires):
+            state["access_level"] = "free"
+            state.pop("access_expires", None)
+            self._tiers[user_id] = ("free", None)
+            logger.info(f"Subscription of {user_id} ({tier}) expired")
+            return "free"
+        return tier
+
+entitlements = Entitlements(admin_ttl=SHARED_REFRESH if SHARD_COUNT > 1 else None)
 
 def is_developer(user_id: int) -> bool:
     return user_id == DEVELOPER_USER_ID
 
 def is_admin_user(user_id: int) -> bool:
-    return user_id in get_admin_users()
+    return entitlements.is_admin(user_id)
 
 def has_full_access(user_id: int) -> bool:
     return is_developer(user_id) or is_admin_user(user_id)
@@ -530,7 +1019,7 @@ def has_full_access(user_id: int) -> bool:
 def get_user_access(state: Dict[str, Any], user_id: int) -> str:
     if has_full_access(user_id):
         return "maximum"
-    return state.get("access_level", "free")
+    return entitlements.tier(state, user_id)
 
 def check_feature_access(state: Dict[str, Any], user_id: int, feature: str) -> bool:
     level = get_user_access(state, user_id)
@@ -547,25 +1036,513 @@ def check_feature_access(state: Dict[str, Any], user_id: int, feature: str) -> b
     return False
 
 def add_points(st: Dict[str, Any], amount: int) -> int:
-    st["points"] = int(st.get("points", 0)) + int(amount)
+    _record_op(st, ("points", int(amount)))
     return st["points"]
 
-def ensure_day(s: Dict[str, Any]) -> Dict[str, int]:
-    dk = today_key()
-    s["daily_energy"].setdefault(dk, {"in": 0, "out": 0})
-    return s["daily_energy"][dk]
+def _cas_update(k: str, fn):
+    """Чтение → fn(rec) → условная запись по версии, с повтором при конфликте. Возвращает результат fn."""
+    for _ in range(STATE_CAS_RETRIES):
+        # копия: MemoryDB/LocalDB отдают живой объект, правка на месте обошла бы сверку версии,
+        # а повтор применил бы fn второй раз
+        rec = db_get(k)
+        rec = copy.deepcopy(rec) if isinstance(rec, dict) else {}
+        expected = int(rec.get("_v", 0))
+        result = fn(rec)
+        if db_cas(k, expected, rec):
+            return result
+        state_metrics["cas_conflicts"] += 1
+    state_metrics["lost_updates"] += 1
+    logger.error(f"Record {k} not saved after {STATE_CAS_RETRIES} version conflicts")
+    return None
 
-def add_kcal_in(st: Dict[str, Any], kcal: int):
-    day = ensure_day(st)
-    day["in"] += int(max(0, kcal))
+DIARY_KINDS = ("food", "train", "metrics")
+ROLLUP_FIELDS = ("kcal", "p", "f", "c", "train_kcal", "food_n", "train_n", "metrics_n")
 
-def add_kcal_out(st: Dict[str, Any], kcal: int):
-    day = ensure_day(st)
-    day["out"] += int(max(0, kcal))
+def _num(v) -> float:
+    try:
+        return float(v) if v is not None else 0.0
+    except (ValueError, TypeError):
+        return 0.0
 
-def day_totals(st: Dict[str, Any]) -> Tuple[int, int]:
-    d = st["daily_energy"].get(today_key(), {"in": 0, "out": 0})
-    return d.get("in", 0), d.get("out", 0)
+class DiaryStore:
+    """
+    Дневники вне записи пользователя, по месяцам:
+      diary:{uid}:{kind}:{YYYY-MM} — {"entries": [...]} в порядке добавления;
+      diary:{uid}:days:{YYYY-MM}   — {"days": {YYYY-MM-DD: итоги дня}}, ведутся при добавлении/удалении;
+      diary:{uid}:index            — {kind: {YYYY-MM: число записей}, "days": {YYYY-MM: 1},
+                                      "cold": {YYYY-MM: сводка архивного месяца}};
+      diary:{uid}:cold:{YYYY-MM}   — {"z": сжатый сегмент} с записями, итогами дней и наградами месяца.
+    Чтение за период трогает только нужные месяцы, счётчики и итоги дня — только индекс/сводку.
+    Архивные месяцы читаются лениво (см. RetentionEngine), запись в такой месяц сначала возвращает его из архива.
+    Партиция и индекс пишутся отдельно, поэтому при первом чтении индекса пользователя
+    в процессе (и после сбоя записи) он сверяется с ключами diary:{uid}:* (repair_index).
+    """
+
+    COLD_CACHE_SIZE = 16
+
+    def __init__(self):
+        self._cold_cache: "OrderedDict[Tuple[int, str], Dict[str, Any]]" = OrderedDict()
+        self._checked: set = set()  # uid, чей индекс уже сверен в этом процессе
+
+    @staticmethod
+    def _key(uid: int, kind: str, month: str) -> str:
+        return f"diary:{uid}:{kind}:{month}"
+
+    @staticmethod
+    def _days_key(uid: int, month: str) -> str:
+        return f"diary:{uid}:days:{month}"
+
+    @staticmethod
+    def _index_key(uid: int) -> str:
+        return f"diary:{uid}:index"
+
+    @staticmethod
+    def _cold_key(uid: int, month: str) -> str:
+        return f"diary:{uid}:cold:{month}"
+
+    @staticmethod
+    def pack_segment(seg: Dict[str, Any]) -> str:
+        return base64.b64encode(zlib.compress(record_codec.encode(seg), 6)).decode("ascii")
+
+    @staticmethod
+    def unpack_segment(z: str) -> Dict[str, Any]:
+        return record_codec.decode(zlib.decompress(base64.b64decode(z)))
+
+    @staticmethod
+    def month_of(entry: Dict[str, Any]) -> str:
+        ts = entry.get("ts") if isinstance(entry, dict) else None
+        if isinstance(ts, str) and re.match(r"\d{4}-\d{2}", ts):
+            return ts[:7]
+        return datetime.now().strftime("%Y-%m")
+
+    @staticmethod
+    def day_of(entry: Dict[str, Any]) -> str:
+        ts = entry.get("ts") if isinstance(entry, dict) else None
+        if isinstance(ts, str) and re.match(r"\d{4}-\d{2}-\d{2}", ts):
+            return ts[:10]
+        return today_key()
+
+    @staticmethod
+    def _entry_delta(kind: str, entry: Dict[str, Any]) -> Dict[str, float]:
+        if kind == "food":
+            return {"kcal": _num(entry.get("kcal")), "p": _num(entry.get("p")), "f": _num(entry.get("f")),
+                    "c": _num(entry.get("c")), "food_n": 1}
+        if kind == "train":
+            return {"train_kcal": _num(entry.get("kcal")), "train_n": 1}
+        return {"metrics_n": 1}
+
+    def _touch_days_month(self, uid: int, month: str):
+        def fn(idx):
+            idx.setdefault("days", {})[month] = 1
+            return True
+        self._update_index(uid, fn)
+
+    def _update_index(self, uid: int, fn):
+        # индекс не записался — при следующем чтении сверить заново
+        if _cas_update(self._index_key(uid), fn) is None:
+            self._checked.discard(uid)
+
+    def _index_rec(self, uid: int) -> Dict[str, Any]:
+        if uid not in self._checked:
+            self._checked.add(uid)
+            self.repair_index(uid)
+        idx = db_get(self._index_key(uid))
+        return idx if isinstance(idx, dict) else {}
+
+    def repair_index(self, uid: int) -> bool:
+        """
+        Сверяет индекс с ключами diary:{uid}:*: число записей горячих партиций (их немного —
+        старые месяцы уходят в архив), месяцы итогов дней и сводки архива. Сбой между записью
+        партиции и индекса оставляет месяц невидимым или со старым числом. True, если индекс исправлен.
+        """
+        prefix = f"diary:{uid}:"
+        found: Dict[str, set] = {}
+        for k in db_keys_prefix(prefix):
+            part, _, month = k[len(prefix):].partition(":")
+            if month:
+                found.setdefault(part, set()).add(month)
+        if not found:
+            return False
+        idx = db_get(self._index_key(uid))
+        idx = idx if isinstance(idx, dict) else {}
+        parts = db_get_many([self._key(uid, kind, m) for kind in DIARY_KINDS for m in found.get(kind, ())])
+        counts: Dict[Tuple[str, str], int] = {}
+        hot = set(found.get("days", ()))
+        for kind in DIARY_KINDS:
+            known = idx.get(kind) or {}
+            for month in found.get(kind, ()):
+                rec = parts.get(self._key(uid, kind, month))
+                n = len(_safe_list(rec.get("entries"))) if isinstance(rec, dict) else 0
+                if int(known.get(month, 0)) != n:
+                    counts[(kind, month)] = n
+                if n:
+                    hot.add(month)
+        days = found.get("days", set()) - set(idx.get("days") or {})
+        stale_cold = hot & set(idx.get("cold") or {})
+        cold = {}
+        for month in found.get("cold", set()) - set(idx.get("cold") or {}) - hot:
+            summary = self._summary(self._read_cold(uid, month))
+            if summary:
+                cold[month] = summary
+        if not (counts or days or stale_cold or cold):
+            return False
+
+        def fn(idx):
+            for (kind, month), n in counts.items():
+                if n:
+                    idx.setdefault(kind, {})[month] = n
+                else:
+                    (idx.get(kind) or {}).pop(month, None)
+            for month in days:
+                idx.setdefault("days", {})[month] = 1
+            # горячие партиции главнее архива (сбой посреди thaw)
+            for month in stale_cold:
+                (idx.get("cold") or {}).pop(month, None)
+            if cold:
+                idx.setdefault("cold", {}).update(cold)
+            return True
+        self._update_index(uid, fn)
+        logger.warning(f"Diary index of {uid} repaired: counts {sorted(counts)}, days {sorted(days)}, "
+                       f"cold {sorted(cold)}, dropped cold {sorted(stale_cold)}")
+        return True
+
+    def _apply_rollups(self, uid: int, kind: str, entries: List[Dict[str, Any]], sign: int):
+        """Прибавляет (sign=1) или вычитает (sign=-1) записи из итогов дня."""
+        by_month: Dict[str, Dict[str, Dict[str, float]]] = {}
+        for e in entries:
+            day = self.day_of(e)
+            acc = by_month.setdefault(day[:7], {}).setdefault(day, {})
+            for field, val in self._entry_delta(kind, e).items():
+                acc[field] = acc.get(field, 0) + val
+        for month, deltas in by_month.items():
+            def fn(rec, deltas=deltas):
+                days = rec.setdefault("days", {})
+                for day, delta in deltas.items():
+                    row = days.setdefault(day, dict.fromkeys(ROLLUP_FIELDS, 0))
+                    for field, val in delta.items():
+                        row[field] = round(max(0, row.get(field, 0) + sign * val), 1)
+                    if not any(row.get(f) for f in ROLLUP_FIELDS):
+                        days.pop(day)
+            _cas_update(self._days_key(uid, month), fn)
+            if sign > 0:
+                self._touch_days_month(uid, month)
+
+    def _bump(self, uid: int, kind: str, month: str, delta: int):
+        def fn(idx):
+            months = idx.setdefault(kind, {})
+            months[month] = max(0, int(months.get(month, 0)) + delta)
+            if not months[month]:
+                months.pop(month)
+            return True
+        self._update_index(uid, fn)
+
+    def append(self, uid: int, kind: str, entry: Dict[str, Any]):
+        self.extend(uid, kind, [entry])
+
+    def extend(self, uid: int, kind: str, entries: List[Dict[str, Any]]):
+        by_month: Dict[str, List[Dict[str, Any]]] = {}
+        for e in entries:
+            by_month.setdefault(self.month_of(e), []).append(e)
+        try:
+            for month, batch in by_month.items():
+                self._thaw_if_cold(uid, month)
+                _cas_update(self._key(uid, kind, month), lambda rec, b=batch: rec.setdefault("entries", []).extend(b))
+                self._bump(uid, kind, month, len(batch))
+            self._apply_rollups(uid, kind, entries, 1)
+        except BaseException:
+            self._checked.discard(uid)
+            raise
+
+    def index(self, uid: int) -> Dict[str, Dict[str, int]]:
+        idx = self._index_rec(uid)
+        return {k: v for k, v in idx.items() if k in DIARY_KINDS and isinstance(v, dict)}
+
+    def cold_months(self, uid: int) -> Dict[str, Dict[str, Any]]:
+        idx = self._index_rec(uid)
+        cold = idx.get("cold")
+        return cold if isinstance(cold, dict) else {}
+
+    def hot_months(self, uid: int) -> List[str]:
+        idx = self._index_rec(uid)
+        months = set(idx.get("days") or {})
+        for kind in DIARY_KINDS:
+            months.update(idx.get(kind) or {})
+        return sorted(months)
+
+    def months(self, uid: int, kind: str) -> List[str]:
+        months = set(self.index(uid).get(kind, {}))
+        months.update(m for m, c in self.cold_months(uid).items() if c.get(kind))
+        return sorted(months)
+
+    def count(self, uid: int, kinds=DIARY_KINDS) -> int:
+        idx = self.index(uid)
+        hot = sum(int(n) for kind in kinds for n in idx.get(kind, {}).values())
+        return hot + sum(int(c.get(kind, 0)) for c in self.cold_months(uid).values() for kind in kinds)
+
+    def rollup_months(self, uid: int) -> List[str]:
+        idx = self._index_rec(uid)
+        months = set(idx.get("days") or {})
+        months.update(m for m, c in (idx.get("cold") or {}).items() if c.get("days"))
+        return sorted(months)
+
+    def rollups(self, uid: int, month: str) -> Dict[str, Dict[str, float]]:
+        rec = db_get(self._days_key(uid, month))
+        days = rec.get("days") if rec is not None else self.cold_segment(uid, month).get("days")
+        return days if isinstance(days, dict) else {}
+
+    def rollup(self, uid: int, day: str) -> Dict[str, float]:
+        """Итоги дня: kcal/p/f/c съеденного, train_kcal и число записей каждого вида."""
+        row = self.rollups(uid, day[:7]).get(day) or {}
+        return {f: row.get(f, 0) for f in ROLLUP_FIELDS}
+
+    def recent_days(self, uid: int, n: int) -> List[Tuple[str, Dict[str, float]]]:
+        """Последние n дней с записями (новые → старые) с их итогами."""
+        out: List[Tuple[str, Dict[str, float]]] = []
+        for month in reversed(self.rollup_months(uid)):
+            days = self.rollups(uid, month)
+            out.extend((d, days[d]) for d in sorted(days, reverse=True))
+            if len(out) >= n:
+                break
+        return out[:n]
+
+    def partition(self, uid: int, kind: str, month: str) -> List[Dict[str, Any]]:
+        rec = db_get(self._key(uid, kind, month))
+        if rec is None:
+            return _safe_list(self.cold_segment(uid, month).get(kind))
+        return _safe_list(rec.get("entries"))
+
+    # --- архив ---
+
+    def cold_segment(self, uid: int, month: str) -> Dict[str, Any]:
+        """Архивный сегмент месяца; распакованные держатся в маленьком LRU."""
+        seg = self._cold_cache.get((uid, month))
+        if seg is not None:
+            self._cold_cache.move_to_end((uid, month))
+            return seg
+        seg = self._read_cold(uid, month)
+        if not seg:
+            return seg
+        self._cold_cache[(uid, month)] = seg
+        while len(self._cold_cache) > self.COLD_CACHE_SIZE:
+            self._cold_cache.popitem(last=False)
+        return seg
+
+    def _read_cold(self, uid: int, month: str) -> Dict[str, Any]:
+        rec = db_get(self._cold_key(uid, month))
+        if not isinstance(rec, dict) or not rec.get("z"):
+            return {}
+        try:
+            return self.unpack_segment(rec["z"])
+        except Exception as e:
+            logger.error(f"Damaged cold segment {self._cold_key(uid, month)}: {e}")
+            return {}
+
+    def _write_segment(self, uid: int, month: str, seg: Dict[str, Any]):
+        z = self.pack_segment(seg)
+        _cas_update(self._cold_key(uid, month), lambda rec: rec.update(z=z))
+        self._cold_cache.pop((uid, month), None)
+
+    def awards(self, uid: int, month: str) -> Dict[str, Dict[str, bool]]:
+        """Архивные награды месяца (горячие лежат в st["awards"])."""
+        return self.cold_segment(uid, month).get("awards") or {}
+
+    def archive_awards(self, uid: int, month: str, awards: Dict[str, Dict[str, bool]]):
+        seg = dict(self.cold_segment(uid, month))
+        seg["awards"] = dict(seg.get("awards") or {}, **awards)
+        self._write_segment(uid, month, seg)
+
+    def archive_month(self, uid: int, month: str) -> Dict[str, Any]:
+        """
+        Переносит записи и итоги дней месяца в сегмент, в индексе оставляет сводку.
+        Сначала пишется сегмент, потом индекс, потом удаляются горячие ключи, так что
+        после сбоя на любом шаге повтор даёт тот же результат (горячие данные главнее).
+        """
+        seg = dict(self.cold_segment(uid, month))
+        hot_keys = []
+        for kind in DIARY_KINDS:
+            rec = db_get(self._key(uid, kind, month))
+            if rec is not None:
+                seg[kind] = _safe_list(rec.get("entries"))
+                hot_keys.append(self._key(uid, kind, month))
+        rec = db_get(self._days_key(uid, month))
+        if rec is not None:
+            seg["days"] = rec.get("days") or {}
+            hot_keys.append(self._days_key(uid, month))
+        summary = self._summary(seg)
+        self._write_segment(uid, month, seg)
+
+        def fn(idx):
+            for kind in DIARY_KINDS + ("days",):
+                (idx.get(kind) or {}).pop(month, None)
+            idx.setdefault("cold", {})[month] = summary
+        _cas_update(self._index_key(uid), fn)
+        for k in hot_keys:
+            db_delete(k)
+        return summary
+
+    @staticmethod
+    def _summary(seg: Dict[str, Any]) -> Dict[str, Any]:
+        """Сводка архивного месяца для index["cold"]: число записей по видам и суммы итогов дней."""
+        summary: Dict[str, Any] = {kind: len(seg[kind]) for kind in DIARY_KINDS if seg.get(kind)}
+        if seg.get("days"):
+            summary["days"] = 1
+            summary["sum"] = {f: round(sum(_num(r.get(f)) for r in seg["days"].values()), 1) for f in ROLLUP_FIELDS}
+        return summary
+
+    def thaw(self, uid: int, month: str):
+        """Возвращает записи и итоги месяца из архива в горячие партиции."""
+        seg = self.cold_segment(uid, month)
+        for kind in DIARY_KINDS:
+            if seg.get(kind):
+                _cas_update(self._key(uid, kind, month), lambda rec, e=seg[kind]: rec.setdefault("entries", list(e)))
+        if seg.get("days"):
+            _cas_update(self._days_key(uid, month), lambda rec: rec.setdefault("days", dict(seg["days"])))
+
+        def fn(idx):
+            cold = (idx.get("cold") or {}).pop(month, None) or {}
+            for kind in DIARY_KINDS:
+                if cold.get(kind):
+                    idx.setdefault(kind, {})[month] = int(cold[kind])
+            if cold.get("days"):
+                idx.setdefault("days", {})[month] = 1
+        _cas_update(self._index_key(uid), fn)
+        if seg.get("awards"):
+            self._write_segment(uid, month, {"awards": seg["awards"]})
+        else:
+            db_delete(self._cold_key(uid, month))
+            self._cold_cache.pop((uid, month), None)
+
+    def _thaw_if_cold(self, uid: int, month: str):
+        # текущий месяц в архив не попадает — лишнего чтения индекса на обычной записи нет
+        if month < datetime.now().strftime("%Y-%m") and month in self.cold_months(uid):
+            self.thaw(uid, month)
+
+    def range(self, uid: int, kind: str, start_day: str, end_day: str) -> List[Dict[str, Any]]:
+        """Записи с start_day по end_day включительно (YYYY-MM-DD)."""
+        out = []
+        for month in self.months(uid, kind):
+            if start_day[:7] <= month <= end_day[:7]:
+                out.extend(
+                    e for e in self.partition(uid, kind, month)
+                    if isinstance(e, dict) and start_day <= str(e.get("ts", ""))[:10] <= end_day
+                )
+        return out
+
+    def columns(self, uid: int, kind: str, start_day: str, end_day: str) -> DiaryColumns:
+        """То же, что range, но в колоночном виде: выборки по дню/неделе — через bisect."""
+        return DiaryColumns.from_entries(self.range(uid, kind, start_day, end_day), kind)
+
+    def iter_entries(self, uid: int, kinds=DIARY_KINDS):
+        """
+        Все записи (вид, запись) от старых к новым; виды внутри месяца упорядочены по времени.
+        В памяти — разделы одного месяца; архивные сегменты читаются мимо LRU, чтобы
+        полный проход не вытеснял из него то, что нужно обычным просмотрам.
+        """
+        for month in self.export_months(uid, kinds):
+            yield from self.month_rows(uid, month, kinds)
+
+    def export_months(self, uid: int, kinds=DIARY_KINDS) -> List[str]:
+        """Месяцы (горячие и архивные), где есть записи этих видов, по возрастанию."""
+        idx = self.index(uid)
+        cold = self.cold_months(uid)
+        return sorted({m for kind in kinds for m in idx.get(kind, {})}
+                      | {m for m, c in cold.items() if any(c.get(kind) for kind in kinds)})
+
+    def month_rows(self, uid: int, month: str, kinds=DIARY_KINDS) -> List[Tuple[str, Dict[str, Any]]]:
+        """Записи месяца как (вид, запись) по времени — копии, их можно отдать в другой поток."""
+        seg = None
+        rows = []
+        for kind in kinds:
+            rec = db_get(self._key(uid, kind, month))
+            if rec is None:
+                if seg is None:
+                    seg = self._read_cold(uid, month) if month in self.cold_months(uid) else {}
+                entries = _safe_list(seg.get(kind))  # сегмент только что распакован — уже копия
+            else:
+                entries = copy.deepcopy(_safe_list(rec.get("entries")))
+            rows.extend((kind, e) for e in entries if isinstance(e, dict))
+        rows.sort(key=lambda r: str(r[1].get("ts", "")))
+        return rows
+
+    def iter_recent(self, uid: int, kind: str):
+        """Записи от новых к старым; месяцы подгружаются по мере надобности."""
+        for month in reversed(self.months(uid, kind)):
+            yield from reversed(self.partition(uid, kind, month))
+
+    def tail(self, uid: int, kind: str, n: int) -> List[Tuple[str, int, Dict[str, Any]]]:
+        """Последние n записей (старые → новые) как (месяц, позиция, запись) — для удаления по номеру."""
+        out: List[Tuple[str, int, Dict[str, Any]]] = []
+        for month in reversed(self.months(uid, kind)):
+            entries = self.partition(uid, kind, month)
+            for i in range(len(entries) - 1, -1, -1):
+                out.append((month, i, entries[i]))
+                if len(out) >= n:
+                    return out[::-1]
+        return out[::-1]
+
+    def remove(self, uid: int, kind: str, month: str, pos: int) -> Optional[Dict[str, Any]]:
+        self._thaw_if_cold(uid, month)
+
+        def fn(rec):
+            entries = rec.get("entries") or []
+            return entries.pop(pos) if 0 <= pos < len(entries) else None
+        removed = _cas_update(self._key(uid, kind, month), fn)
+        if removed is not None:
+            self._bump(uid, kind, month, -1)
+            self._apply_rollups(uid, kind, [removed], -1)
+        return removed
+
+    def clear(self, uid: int, kind: str) -> List[Dict[str, Any]]:
+        removed: List[Dict[str, Any]] = []
+        for month in self.months(uid, kind):
+            self._thaw_if_cold(uid, month)
+
+            def fn(rec):
+                entries, rec["entries"] = _safe_list(rec.get("entries")), []
+                return entries
+            removed.extend(_cas_update(self._key(uid, kind, month), fn) or [])
+        _cas_update(self._index_key(uid), lambda idx: idx.pop(kind, None))
+        self._apply_rollups(uid, kind, [e for e in removed if isinstance(e, dict)], -1)
+        return removed
+
+    def migrate_legacy(self, uid: int, st: Dict[str, Any]) -> bool:
+        """
+        Переносит старые st["diaries"] в партиции, а st["daily_energy"] — в итоги дней,
+        по которым записей нет. True, если состояние изменилось.
+        """
+        legacy = st.pop("diaries", None)
+        energy = st.pop("daily_energy", None)
+        if isinstance(legacy, dict):
+            for kind in DIARY_KINDS:
+                entries = [e for e in _safe_list(legacy.get(kind)) if isinstance(e, dict)]
+                if entries:
+                    self.extend(uid, kind, entries)
+        if isinstance(energy, dict):
+            by_month: Dict[str, Dict[str, Dict[str, float]]] = {}
+            for day, de in energy.items():
+                if isinstance(day, str) and len(day) == 10 and isinstance(de, dict):
+                    by_month.setdefault(day[:7], {})[day] = {"kcal": _num(de.get("in")), "train_kcal": _num(de.get("out"))}
+            for month, seeds in by_month.items():
+                self._thaw_if_cold(uid, month)
+
+                def fn(rec, seeds=seeds):
+                    days = rec.setdefault("days", {})
+                    for day, seed in seeds.items():
+                        if day not in days and (seed["kcal"] or seed["train_kcal"]):
+                            days[day] = dict(dict.fromkeys(ROLLUP_FIELDS, 0), **seed)
+                _cas_update(self._days_key(uid, month), fn)
+                self._touch_days_month(uid, month)
+        return legacy is not None or energy is not None
+
+diary_store = DiaryStore()
+
+def append_diary(uid: int, kind: str, entry: Dict[str, Any]):
+    """Добавляет запись в дневник (food/train/metrics)."""
+    diary_store.append(uid, kind, entry)
+
+def day_totals(uid: int) -> Tuple[int, int]:
+    d = diary_store.rollup(uid, today_key())
+    return int(d["kcal"]), int(d["train_kcal"])
 
 def award_once(st: Dict[str, Any], metric: str) -> bool:
     d = today_key()
@@ -575,6 +1552,130 @@ def award_once(st: Dict[str, Any], metric: str) -> bool:
     st["awards"][d][metric] = True
     return True
 
+RETENTION_DAYS = int(os.getenv("HLITE_RETENTION_DAYS", "90"))              # 0 — не архивировать
+RETENTION_INTERVAL = float(os.getenv("HLITE_RETENTION_INTERVAL", "300"))   # пауза между тиками, сек
+RETENTION_BATCH = int(os.getenv("HLITE_RETENTION_BATCH", "20"))            # пользователей за тик
+RETENTION_MONTHS_PER_USER = 3                                               # месяцев дневника за тик
+
+class RetentionEngine:
+    """
+    Архив старого: дни наград старше days дней и целые месяцы дневников до месяца отсечки
+    уходят в сжатые сегменты diary:{uid}:cold:{YYYY-MM} (см. DiaryStore). В горячем
+    состоянии остаётся сводка: st["archive"] по наградам, index["cold"] по дневникам.
+    Фоновая задача обходит пользователей по кругу: за тик — не больше batch пользователей
+    и max_months месяцев каждого, под замком пользователя.
+    """
+
+    def __init__(self, days: int = RETENTION_DAYS, interval: float = RETENTION_INTERVAL,
+                 batch: int = RETENTION_BATCH, max_months: int = RETENTION_MONTHS_PER_USER):
+        self.days = days
+        self.interval = interval
+        self.batch = batch
+        self.max_months = max_months
+        self._queue: List[int] = []
+        self._task: Optional[asyncio.Task] = None
+        self.passes = 0
+        self.archived_months = 0
+        self.archived_award_days = 0
+
+    def cutoff(self) -> str:
+        return (datetime.now() - timedelta(days=self.days)).strftime("%Y-%m-%d")
+
+    def _move_awards(self, uid: int, s: Dict[str, Any], cutoff: str) -> int:
+        awards = s.get("awards") or {}
+        old = sorted(d for d in awards if isinstance(d, str) and d < cutoff)
+        if not old:
+            return 0
+        by_month: Dict[str, Dict[str, Any]] = {}
+        for d in old:
+            by_month.setdefault(d[:7], {})[d] = awards[d]
+        for month, days in by_month.items():
+            diary_store.archive_awards(uid, month, days)
+        summary = s.setdefault("archive", {})
+        totals = summary.setdefault("awards", {})
+        for d in old:
+            day = awards.pop(d)
+            for metric, got in (day.items() if isinstance(day, dict) else ()):
+                if got:
+                    totals[metric] = totals.get(metric, 0) + 1
+        summary["months"] = sorted(set(summary.get("months") or []) | set(by_month))
+        summary["until"] = cutoff
+        return len(old)
+
+    def _archive_awards(self, uid: int, cutoff: str) -> int:
+        if uid in state_cache or state_writer.get(uid) is not None:
+            s = load_state(uid)
+            moved = self._move_awards(uid, s, cutoff)
+            if moved:
+                save_state(uid, s)
+            return moved
+        # холодного пользователя не тянем в кэш состояний — правим запись напрямую
+        rec = db_get(state_key(uid))
+        if not isinstance(rec, dict) or not any(isinstance(d, str) and d < cutoff for d in rec.get("awards") or {}):
+            return 0
+        return _cas_update(state_key(uid), lambda s: self._move_awards(uid, s, cutoff)) or 0
+
+    def archive_user(self, uid: int) -> int:
+        """Один проход по пользователю. Возвращает число перенесённых дней наград и месяцев."""
+        cutoff = self.cutoff()
+        moved = self._archive_awards(uid, cutoff)
+        self.archived_award_days += moved
+        months = [m for m in diary_store.hot_months(uid) if m < cutoff[:7]][: self.max_months]
+        for month in months:
+            diary_store.archive_month(uid, month)
+        self.archived_months += len(months)
+        return moved + len(months)
+
+    def _next_batch(self) -> List[int]:
+        if not self._queue:
+            uids = []
+            for k in db_keys_prefix("user:"):
+                try:
+                    uids.append(int(k.split(":", 1)[1]))
+                except ValueError:
+                    continue
+            self._queue = sorted(uids)
+            self.passes += 1
+        batch, self._queue = self._queue[: self.batch], self._queue[self.batch:]
+        return batch
+
+    def _archive_safe(self, uid: int) -> int:
+        try:
+            return self.archive_user(uid)
+        except Exception as e:
+            logger.error(f"Retention failed for {uid}: {e}")
+            return 0
+
+    def step(self) -> int:
+        """Один тик без фоновой задачи (скрипты, тесты)."""
+        return sum(self._archive_safe(uid) for uid in self._next_batch())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            moved = 0
+            for uid in self._next_batch():
+                async with user_lock(uid):
+                    moved += self._archive_safe(uid)
+                await asyncio.sleep(0)
+            if moved:
+                logger.info(f"Retention: archived {moved} items, queue {len(self._queue)}")
+
+    def start(self):
+        if self._task is None and self.days > 0:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        task, self._task = self._task, None
+        if task:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+retention = RetentionEngine()
+
 def profile_complete(p: Dict[str, Any]) -> bool:
     return all(
         [
@@ -908,41 +2009,105 @@ def route_query_with_ai(info: dict, original_text: str) -> dict:
 # GOOGLE_CSE_CX = get_secret("GOOGLE_CSE_CX", "")   # Перенесено выше
 # VISION_KEY = get_secret("VISION_KEY", "")         # Перенесено выше
 
-# === Лёгкий кэш (SQLite) для оптимизации поиска ===
-import sqlite3
-import base64
-import time
+# === Лёгкий кэш (SQLite) для оптимизации поиска: свой поток, см. nutri_cache.py ===
+CACHE_SCHEMA = "r5"  # ↑ поменяешь — старый кэш будет игнориться
+
+if SHARD_COUNT > 1 and SHARD_INDEX is None:
+    CACHE_DB_PATH = ":memory:"  # фронт продукты не ищет, а файлы кэша принадлежат воркерам
+else:
+    CACHE_DB_PATH = sharding.shard_path("./data/cache.db", SHARD_INDEX or 0, SHARD_COUNT)
+
+NUTRI_LRU_MB = float(os.getenv("HLITE_NUTRI_LRU_MB", "8"))  # LRU разобранных результатов перед SQLite; 0 — без него
+
+nutri_cache = NutritionCache(CACHE_DB_PATH, limit_bytes=50 * 1024 * 1024,
+                             memory_bytes=int(NUTRI_LRU_MB * 1024 * 1024))
+atexit.register(nutri_cache.close)
+
+def _nutri_key(family: str, text: str) -> Optional[str]:
+    """Ключ без порции (см. canonical_query); None — из запроса ничего не осталось, не кэшируем."""
+    canon = canonical_query(text)
+    return f"{family}:{CACHE_SCHEMA}:{canon}" if canon else None
 
-CACHE_SCHEMA = "r4"  # ↑ поменяешь — старый кэш будет игнориться
-
-os.makedirs("./data", exist_ok=True)
-_con = sqlite3.connect("./data/cache.db")
-_con.execute("""CREATE TABLE IF NOT EXISTS nutri_cache(
-  key TEXT PRIMARY KEY,
-  payload TEXT NOT NULL,
-  last_used INTEGER NOT NULL,
-  size_bytes INTEGER NOT NULL
-)""")
-_con.commit()
-
-def _cache_get(k: str):
-    r = _con.execute("SELECT payload FROM nutri_cache WHERE key=?", (k,)).fetchone()
-    if not r:
+async def _cache_get(k: Optional[str], g: Optional[float] = None, ml: Optional[float] = None):
+    """Значение из кэша; NutritionResult пересчитывается на порцию g/ml."""
+    if not k:
         return None
-    _con.execute("UPDATE nutri_cache SET last_used=? WHERE key=?", (int(time.time()), k))
-    _con.commit()
-    return json.loads(r[0])
-
-def _cache_put(k: str, obj: dict, limit_mb: int = 50):
-    data = json.dumps(obj, ensure_ascii=False)
-    _con.execute("INSERT OR REPLACE INTO nutri_cache(key,payload,last_used,size_bytes) VALUES (?,?,?,?)",
-                 (k, data, int(time.time()), len(data)))
-    _con.commit()
-    total = _con.execute("SELECT COALESCE(SUM(size_bytes),0) FROM nutri_cache").fetchone()[0] or 0
-    while total > limit_mb*1024*1024:
-        _con.execute("DELETE FROM nutri_cache WHERE key IN (SELECT key FROM nutri_cache ORDER BY last_used ASC LIMIT 50)")
-        _con.commit()
-        total = _con.execute("SELECT COALESCE(SUM(size_bytes),0) FROM nutri_cache").fetchone()[0] or 0
+    res = await nutri_cache.get(k)
+    return res.scaled(g, ml) if isinstance(res, NutritionResult) else res
+
+def _cache_put(k: Optional[str], obj):
+    """В кэш — значения на 100 г/100 мл без порции; результат только «на порцию» не кэшируется."""
+    if not k:
+        return
+    if isinstance(obj, NutritionResult):
+        if not obj.has_base():
+            return
+        obj = obj.scaled()
+    nutri_cache.put(k, obj)
+
+# === Негативный кэш: какой провайдер что уже не нашёл ===
+NEG_TTL_MISS = float(os.getenv("HLITE_NEG_TTL_MISS", str(6 * 3600)))  # «не найдено», сек
+NEG_TTL_ERROR = float(os.getenv("HLITE_NEG_TTL_ERROR", "120"))        # сбой сети/квоты, сек
+# провайдер → (ttl промаха, ttl ошибки); остальные — NEG_TTL_MISS / NEG_TTL_ERROR
+_NEG_TTLS = {
+    "pipeline": (NEG_TTL_MISS / 6, NEG_TTL_ERROR),     # вся цепочка: нормализатор и локальные базы могут ответить иначе
+    "brand": (NEG_TTL_MISS * 4, NEG_TTL_ERROR * 5),    # Google CSE: квота, страницы, OCR — дорого
+    "google": (NEG_TTL_MISS * 4, NEG_TTL_ERROR * 5),
+}
+negative_cache = NegativeCache((NEG_TTL_MISS, NEG_TTL_ERROR), _NEG_TTLS)
+
+# сбои провайдеров (HTTP не 200, исключения) в текущем поиске — отличают «ошибку» от «не найдено»;
+# список общий и для потоков to_thread (они получают копию контекста)
+_lookup_failures: "contextvars.ContextVar[Optional[List[str]]]" = contextvars.ContextVar("lookup_failures", default=None)
+
+def _note_lookup_failure(what: str):
+    failures = _lookup_failures.get()
+    if failures is not None:
+        failures.append(what)
+
+# одинаковые одновременные поиски (двойное нажатие, несколько пользователей) выполняются один раз
+lookup_flights = singleflight.SingleFlight()
+
+async def _lookup(provider: str, query: str, call):
+    """
+    call() провайдера с негативным кэшем по canonical_query(query): известный промах — сразу None,
+    пустой ответ запоминается как «miss», а если по дороге был сбой или исключение — как «error».
+    Одновременные вызовы с тем же запросом и той же порцией ждут один call() (single-flight);
+    порция в ключе нужна, потому что результат (ai_meal_json) бывает уже пересчитан на неё.
+    """
+    key = canonical_query(query)
+    kind = negative_cache.is_miss(provider, key)
+    if kind:
+        logger.info(f"{provider}: known {kind} for '{key}', skipping")
+        return None
+    parent = _lookup_failures.get()
+    try:
+        result, failures = await lookup_flights.run(
+            (provider, key or query, quantity_key(query)), lambda: _lookup_call(provider, key, call),
+            group=provider, clone=lambda r: (clone_value(r[0]), r[1]),
+        )
+    except Exception as e:
+        if parent is not None:
+            parent.append(f"{provider}: {type(e).__name__}: {e}")
+        raise
+    # сбои общей работы видны и ждавшим: их внешний поиск тоже запомнится как «error»
+    if parent is not None:
+        parent.extend(failures)
+    return result
+
+async def _lookup_call(provider: str, key: str, call) -> Tuple[Any, List[str]]:
+    failures: List[str] = []
+    _lookup_failures.set(failures)  # своя задача single-flight — свой контекст, сбрасывать не нужно
+    try:
+        result = await call()
+    except Exception as e:
+        failures.append(f"{type(e).__name__}: {e}")
+        negative_cache.record(provider, key, "error")
+        raise
+    # отмена (ушёл пользователь, остановка) сюда не доходит и ничего не запоминает
+    if not result:
+        negative_cache.record(provider, key, "error" if failures else "miss")
+    return result, failures
 
 # ========================= УЛУЧШЕННЫЙ GOOGLE CSE ПОИСК =========================
 def _extract_portions(text: str) -> Tuple[str, Optional[float], Optional[float]]:
@@ -1041,6 +2206,7 @@ async def _google_cse_search_branded(q: str, num: int = 8) -> List[str]:
         return filtered_urls
         
     except Exception as e:
+        _note_lookup_failure(f"cse: {e}")
         logger.warning(f"Google CSE branded search failed: {e}")
         return []
 
@@ -1070,10 +2236,12 @@ def _google_cse_search(q: str, num: int = 6, site_filter: str = None) -> List[st
             logger.info(f"Found {len(urls)} URLs via legacy Google CSE")
             return urls
         else:
+            _note_lookup_failure(f"cse: HTTP {response.status_code}")
             logger.warning(f"Google CSE returned status {response.status_code}")
             return []
             
     except Exception as e:
+        _note_lookup_failure(f"cse: {e}")
         logger.warning(f"Google CSE search failed: {e}")
         return []
 
@@ -1186,9 +2354,11 @@ def _google_cse_images(q: str, num: int = 4) -> List[str]:
         if response.status_code == 200:
             return [item["link"] for item in response.json().get("items", []) if "link" in item]
         else:
+            _note_lookup_failure(f"cse images: HTTP {response.status_code}")
             logger.warning(f"Google CSE images returned status {response.status_code}")
             return []
     except Exception as e:
+        _note_lookup_failure(f"cse images: {e}")
         logger.warning(f"Google CSE images search failed: {e}")
         return []
 
@@ -1246,138 +2416,45 @@ def _validate_and_fix_energy(kcal: Optional[float], protein: Optional[float],
 
     return kcal
 
-def _unify(n: dict, user_g: Optional[float], user_ml: Optional[float]) -> dict:
+def _serving_vector(n: Dict[str, Any]):
+    """КБЖУ «на порцию продукта» из ответа парсера (carb_serv или carbs_serv)."""
+    c_s = n.get("carb_serv")
+    if c_s is None:
+        c_s = n.get("carbs_serv")
+    return (n.get("kcal_serv"), n.get("protein_serv"), n.get("fat_serv"), c_s)
+
+def _unify(n: dict, user_g: Optional[float], user_ml: Optional[float]) -> NutritionResult:
     """Унификация результатов поиска с масштабированием на 100г/100мл и пользовательскую порцию"""
-    kcal_s = n.get("kcal_serv")
-    p_s = n.get("protein_serv")
-    f_s = n.get("fat_serv")
-    c_s = None
-    for _key in ("carb_serv", "carbs_serv"):
-        value = n.get(_key)
-        if value is not None:
-            c_s = value
-            break
-    sg = n.get("serving_g")
-    sml = n.get("serving_ml")
-
-    kcal_100g = p_100g = f_100g = c_100g = None
-    kcal_100ml = p_100ml = f_100ml = c_100ml = None
-
-    if sg and sg > 0:
-        k = 100 / sg
-        kcal_100g = kcal_s * k if kcal_s is not None else None
-        p_100g = p_s * k if p_s is not None else None
-        f_100g = f_s * k if f_s is not None else None
-        c_100g = c_s * k if c_s is not None else None
-
-    if sml and sml > 0:
-        k = 100 / sml
-        kcal_100ml = kcal_s * k if kcal_s is not None else None
-        p_100ml = p_s * k if p_s is not None else None
-        f_100ml = f_s * k if f_s is not None else None
-        c_100ml = c_s * k if c_s is not None else None
-
-    # на порцию пользователя
-    kcal_port = p_port = f_port = c_port = None
-    if user_g and kcal_100g is not None:
-        k = user_g / 100
-        kcal_port = kcal_100g * k
-        p_port = p_100g * k if p_100g is not None else None
-        f_port = f_100g * k if f_100g is not None else None
-        c_port = c_100g * k if c_100g is not None else None
-    elif user_ml and kcal_100ml is not None:
-        k = user_ml / 100
-        kcal_port = kcal_100ml * k
-        p_port = p_100ml * k if p_100ml is not None else None
-        f_port = f_100ml * k if f_100ml is not None else None
-        c_port = c_100ml * k if c_100ml is not None else None
-
-    return {"name": n.get("name"), "brand": n.get("brand"), "source": n.get("source"), "url": n.get("url"),
-            "kcal_100g": kcal_100g, "protein_100g": p_100g, "fat_100g": f_100g, "carbs_100g": c_100g,
-            "kcal_100ml": kcal_100ml, "protein_100ml": p_100ml, "fat_100ml": f_100ml, "carbs_100ml": c_100ml,
-            "portion_g": user_g, "portion_ml": user_ml,
-            "kcal_portion": kcal_port, "protein_portion": p_port, "fat_portion": f_port, "carbs_portion": c_port}
-
-def _unify_and_scale(nut: Dict[str, Any], user_g: Optional[float], user_ml: Optional[float]) -> Dict[str, Any]:
+    return _unify_and_scale(n, user_g, user_ml)
+
+def _unify_and_scale(nut: Dict[str, Any], user_g: Optional[float], user_ml: Optional[float]) -> NutritionResult:
     """
     Преобразует значения «на порцию» → на 100 г/100 мл и, если задана порция пользователя,
     считает КБЖУ на неё.
     """
-    kcal_s = nut.get("kcal_serv")
-    p_s = nut.get("protein_serv")
-    f_s = nut.get("fat_serv")
-    c_s = None
-    for _key in ("carb_serv", "carbs_serv"):
-        value = nut.get(_key)
-        if value is not None:
-            c_s = value
-            break
-    serv_g = nut.get("serving_g")
-    serv_ml = nut.get("serving_ml")
-    source = nut.get("source")
-    name = nut.get("name")
-    brand = nut.get("brand")
-    url = nut.get("url")
-
-    kcal_100g = p_100g = f_100g = c_100g = None
-    kcal_100ml = p_100ml = f_100ml = c_100ml = None
-
-    if serv_g and serv_g > 0:
-        factor = 100.0 / serv_g
-        kcal_100g = kcal_s * factor if kcal_s is not None else None
-        p_100g    = p_s    * factor if p_s    is not None else None
-        f_100g    = f_s    * factor if f_s    is not None else None
-        c_100g    = c_s    * factor if c_s    is not None else None
-
-    if serv_ml and serv_ml > 0:
-        factor = 100.0 / serv_ml
-        kcal_100ml = kcal_s * factor if kcal_s is not None else None
-        p_100ml    = p_s    * factor if p_s    is not None else None
-        f_100ml    = f_s    * factor if f_s    is not None else None
-        c_100ml    = c_s    * factor if c_s    is not None else None
-
-    # КБЖУ на пользовательскую порцию
-    kcal_portion = p_portion = f_portion = c_portion = None
-    if user_g and kcal_100g is not None:
-        k = user_g / 100.0
-        kcal_portion = kcal_100g * k
-        p_portion    = p_100g    * k if p_100g is not None else None
-        f_portion    = f_100g    * k if f_100g is not None else None
-        c_portion    = c_100g    * k if c_100g is not None else None
-    elif user_ml and kcal_100ml is not None:
-        k = user_ml / 100.0
-        kcal_portion = kcal_100ml * k
-        p_portion    = p_100ml    * k if p_100ml is not None else None
-        f_portion    = f_100ml    * k if f_100ml is not None else None
-        c_portion    = c_100ml    * k if c_100ml is not None else None
-
-    return {
-        "name": name, "brand": brand, "source": source, "url": url,
-        "kcal_100g": kcal_100g, "protein_100g": p_100g, "fat_100g": f_100g, "carbs_100g": c_100g,
-        "kcal_100ml": kcal_100ml, "protein_100ml": p_100ml, "fat_100ml": f_100ml, "carbs_100ml": c_100ml,
-        "portion_g": user_g, "portion_ml": user_ml,
-        "kcal_portion": kcal_portion, "protein_portion": p_portion,
-        "fat_portion": f_portion, "carbs_portion": c_portion
-    }
+    return NutritionResult.from_serving(
+        _serving_vector(nut), nut.get("serving_g"), nut.get("serving_ml"), user_g, user_ml,
+        name=nut.get("name"), brand=nut.get("brand"), source=nut.get("source"), url=nut.get("url"),
+    )
 
 async def search_branded_product_via_google(
     query_text: str,
     *,
     forced_urls: Optional[list[str]] = None
-) -> Optional[dict]:
+) -> Optional[NutritionResult]:
     """Брендовый поиск через Google CSE с кэшированием"""
     if not GOOGLE_CSE_KEY or not GOOGLE_CSE_CX:
         logger.warning("Google CSE credentials not configured")
         return None
         
-    # кэш с версионированием
-    ck = f"brand:{CACHE_SCHEMA}:{query_text.lower()}"
-    cached = _cache_get(ck)
+    # кэш с версионированием; ключ без порции, порция пересчитывается после попадания
+    clean, g, ml = _extract_portions(query_text)
+    ck = _nutri_key("brand", clean)
+    cached = await _cache_get(ck, g, ml)
     if cached:
         logger.info(f"Found cached result for: {query_text}")
         return cached
 
-    clean, g, ml = _extract_portions(query_text)
     logger.info(f"Branded search: clean='{clean}', grams={g}, ml={ml}")
     
     # ========= 0) FATSECRET — ПРИОРИТЕТНЫЙ ШАГ =========
@@ -1388,8 +2465,8 @@ async def search_branded_product_via_google(
             barcode = _extract_barcode(query_text)
             if barcode:
                 logger.info(f"Searching FatSecret by barcode: {barcode}")
-                ck_fs_bar = f"fs:bar:{CACHE_SCHEMA}:{barcode}:{g}:{ml}"
-                c = _cache_get(ck_fs_bar)
+                ck_fs_bar = f"fs:bar:{CACHE_SCHEMA}:{barcode}"
+                c = await _cache_get(ck_fs_bar, g, ml)
                 if c:
                     logger.info(f"FatSecret cache hit by barcode {barcode}")
                     return c
@@ -1412,8 +2489,8 @@ async def search_branded_product_via_google(
                 
             # 0b) поиск по названию/бренду
             logger.info(f"Searching FatSecret by name: {clean}")
-            ck_fs_q = f"fs:q:{CACHE_SCHEMA}:{clean}:{g}:{ml}"
-            c = _cache_get(ck_fs_q)
+            ck_fs_q = _nutri_key("fs:q", clean)
+            c = await _cache_get(ck_fs_q, g, ml)
             if c:
                 logger.info(f"FatSecret cache hit by query {clean}")
                 return c
@@ -1473,7 +2550,7 @@ async def search_branded_product_via_google(
     # Определяем категорию для фильтрации
     cat = _guess_category(query_text)
     
-    candidates: list[dict] = []
+    candidates: list[NutritionResult] = []
 
     # 0) если пришли ссылки «в обход» (например, из Vision WEB_DETECTION) — используем их первыми
     urls: list[str] = []
@@ -1513,6 +2590,7 @@ async def search_branded_product_via_google(
             logger.info(f"Parsing HTML from: {url}")
             
         except Exception as e:
+            _note_lookup_failure(f"page: {e}")
             logger.warning(f"Failed to fetch {url}: {e}")
             continue
 
@@ -1828,7 +2906,7 @@ async def search_google_for_product(
     query: str,
     g: Optional[float] = None,
     ml: Optional[float] = None,
-) -> Optional[Dict[str, Any]]:
+) -> Optional[NutritionResult]:
     """Улучшенный поиск продукта через Google CSE с поддержкой брендовых продуктов и Vision OCR"""
     if not GOOGLE_CSE_KEY or not GOOGLE_CSE_CX:
         logger.warning("Google API credentials not configured")
@@ -1909,8 +2987,12 @@ async def search_google_for_product(
             def _make_request():
                 try:
                     response = requests.get(url, params=params, timeout=15)
-                    return response.json() if response.status_code == 200 else None
+                    if response.status_code != 200:
+                        _note_lookup_failure(f"cse: HTTP {response.status_code}")
+                        return None
+                    return response.json()
                 except Exception as e:
+                    _note_lookup_failure(f"cse: {e}")
                     logger.debug(f"Request failed: {e}")
                     return None
 
@@ -1933,65 +3015,10 @@ async def search_google_for_product(
                 if nutrition_data and nutrition_data.get('kcal_100g', 0) > 0:
                     nutrition_data.setdefault('name', clean_query)
                     nutrition_data.setdefault('source', 'fallback')
+                    # порция пользователя: граммы по базе на 100 г, иначе мл по базе на 100 мл
+                    nutrition_data = nutrition_data.scaled(portion_grams, portion_ml)
 
-                    def _apply_portion_values(
-                        result: Dict[str, Any],
-                        amount: Optional[float],
-                        base_suffix: str,
-                        portion_key: str,
-                    ) -> bool:
-                        if amount is None or amount <= 0:
-                            return False
-
-                        result[portion_key] = amount
-
-                        base_kcal = result.get(f'kcal_{base_suffix}')
-                        base_protein = result.get(f'protein_{base_suffix}')
-                        base_fat = result.get(f'fat_{base_suffix}')
-                        base_carbs = result.get(f'carbs_{base_suffix}')
-
-                        if (
-                            base_kcal is None
-                            and base_protein is None
-                            and base_fat is None
-                            and base_carbs is None
-                        ):
-                            return False
-
-                        factor = amount / 100.0
-
-                        macros_written = False
-
-                        if base_kcal is not None:
-                            result['kcal_portion'] = base_kcal * factor
-                            macros_written = True
-                        if base_protein is not None:
-                            result['protein_portion'] = base_protein * factor
-                            macros_written = True
-                        if base_fat is not None:
-                            result['fat_portion'] = base_fat * factor
-                            macros_written = True
-                        if base_carbs is not None:
-                            result['carbs_portion'] = base_carbs * factor
-
-                        return macros_written
-
-                    applied = _apply_portion_values(
-                        nutrition_data,
-                        portion_grams,
-                        '100g',
-                        'portion_g',
-                    )
-
-                    if not applied:
-                        _apply_portion_values(
-                            nutrition_data,
-                            portion_ml,
-                            '100ml',
-                            'portion_ml',
-                        )
-
-                    logger.info(f"Found fallback result: {nutrition_data['name']}")
+                    logger.info(f"Found fallback result: {nutrition_data.name}")
                     return nutrition_data
 
         logger.info(f"No results found for: {query}")
@@ -2155,7 +3182,7 @@ def _to_float_or_none(x):
     except (ValueError, TypeError):
         return None
 
-def extract_nutrition_from_text(text: str, product_name: str) -> Optional[Dict[str, Any]]:
+def extract_nutrition_from_text(text: str, product_name: str) -> Optional[NutritionResult]:
     """Улучшенное извлечение данных о питательности из текста"""
     try:
         # Расширенные паттерны для поиска калорийности
@@ -2283,15 +3310,12 @@ def extract_nutrition_from_text(text: str, product_name: str) -> Optional[Dict[s
                     # Если отклонение большое, оставляем только калории
                     protein = fat = carbs = None
 
-        return {
-            'name': product_name.strip().title(),
-            'brand': '',
-            'kcal_100g': int(kcal),
-            'protein_100g': protein,
-            'fat_100g': fat,
-            'carbs_100g': carbs,
-            'url': 'smart_search'
-        }
+        return NutritionResult(
+            name=product_name.strip().title(),
+            brand='',
+            per_100g=(int(kcal), protein, fat, carbs),
+            url='smart_search',
+        )
 
     except Exception as e:
         logger.warning(f"Error extracting nutrition from text: {e}")
@@ -2431,7 +3455,7 @@ async def load_external_jsonl_database(url_or_id: str = None) -> List[Dict[str,
         logger.error(f"Error loading external JSONL database: {e}")
         return []
 
-async def search_external_jsonl_product(query: str, products: List[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+async def search_external_jsonl_product(query: str, products: List[Dict[str, Any]]) -> Optional[NutritionResult]:
     """Ищет продукт в загруженной JSONL базе"""
     if not products:
         return None
@@ -2508,15 +3532,13 @@ async def search_external_jsonl_product(query: str, products: List[Dict[str, Any
 
         if best_product:
             logger.info(f"Found in external JSONL: {best_product['name']} (score: {best_score})")
-            return {
-                'name': best_product['name'],
-                'brand': best_product.get('brand', ''),
-                'kcal_100g': int(float(best_product.get('kcal_100g', 0))),
-                'protein_100g': float(best_product.get('protein_100g', 0)),
-                'fat_100g': float(best_product.get('fat_100g', 0)),
-                'carbs_100g': float(best_product.get('carbs_100g', 0)),
-                'url': 'external_database'
-            }
+            return NutritionResult(
+                name=best_product['name'],
+                brand=best_product.get('brand', ''),
+                per_100g=(int(float(best_product.get('kcal_100g', 0))), float(best_product.get('protein_100g', 0)),
+                          float(best_product.get('fat_100g', 0)), float(best_product.get('carbs_100g', 0))),
+                url='external_database',
+            )
 
         return None
 
@@ -2563,10 +3585,12 @@ async def _fs_request(method: str, params: dict | None = None) -> dict | None:
     try:
         r = await asyncio.to_thread(_do)
         if r.status_code != 200:
+            _note_lookup_failure(f"fatsecret: HTTP {r.status_code}")
             logger.warning(f"FatSecret HTTP {r.status_code}: {r.text[:200]}")
             return None
         return r.json()
     except Exception as e:
+        _note_lookup_failure(f"fatsecret: {e}")
         logger.warning(f"FatSecret request failed: {e}")
         return None
 
@@ -2590,9 +3614,9 @@ def _fs_pick_serving(servings) -> dict | None:
         return score
     return max(servings, key=_score)
 
-def _fs_norm(food: dict, grams: float | None, ml: float | None) -> dict | None:
+def _fs_norm(food: dict, grams: float | None, ml: float | None) -> NutritionResult | None:
     """
-    Normalize FatSecret → unified dict (per 100 g/ml + per user portion).
+    Normalize FatSecret → NutritionResult (per 100 g/ml + per user portion).
     """
     if not food:
         return None
@@ -2615,27 +3639,14 @@ def _fs_norm(food: dict, grams: float | None, ml: float | None) -> dict | None:
             portion_mass = amount * 28.3495
         elif unit == "lb":
             portion_mass = amount * 453.592
-    kcal100 = p100 = f100 = c100 = None
-    if portion_mass and portion_mass > 0:
-        k = 100.0 / portion_mass
-        kcal100 = kcal_p * k if kcal_p is not None else None
-        p100    = p_p   * k if p_p   is not None else None
-        f100    = f_p   * k if f_p   is not None else None
-        c100    = c_p   * k if c_p   is not None else None
-    out = {
-        "name": name, "brand": brand, "source": "🧩 FatSecret",
-        "kcal_100g": kcal100, "protein_100g": p100, "fat_100g": f100, "carbs_100g": c100,
-        "kcal_100ml": None, "protein_100ml": None, "fat_100ml": None, "carbs_100ml": None,
-        "portion_g": grams, "portion_ml": ml,
-        "kcal_portion": None, "protein_portion": None, "fat_portion": None, "carbs_portion": None
-    }
-    scale = grams if grams is not None else ml
-    if scale and kcal100 is not None:
-        k = float(scale)/100.0
-        if kcal100 is not None: out["kcal_portion"]   = kcal100 * k
-        if p100   is not None:  out["protein_portion"]= p100 * k
-        if f100   is not None:  out["fat_portion"]    = f100 * k
-        if c100   is not None:  out["carbs_portion"]  = c100 * k
+    serving = (kcal_p, p_p, f_p, c_p)
+    per100 = scale_vector(serving, 100.0 / portion_mass) if portion_mass and portion_mass > 0 else EMPTY_VECTOR
+    out = NutritionResult(name=name, brand=brand, source="🧩 FatSecret", per_100g=per100,
+                          portion_g=grams, portion_ml=ml)
+    # порция в мл тоже считается по базе «на 100 г»: FatSecret отдаёт одну метрическую порцию
+    user_amount = grams if grams is not None else ml
+    if user_amount and per100[0] is not None:
+        out.portion = scale_vector(per100, float(user_amount) / 100.0)
     return out
 
 def _fs_extract_query_tokens(query: str | None) -> list[str]:
@@ -3144,7 +4155,7 @@ def _desc_ok_for_base(desc: str, base_en: str) -> bool:
     dl = desc.lower()
     return all(tok in dl for tok in base_en.lower().split())
 
-async def search_usda_fdc_product(query: str, base_en: str = None) -> Optional[Dict[str, Any]]:
+async def search_usda_fdc_product(query: str, base_en: str = None) -> Optional[NutritionResult]:
     """Улучшенный поиск продукта в USDA FDC API с фильтрацией по базовому продукту"""
     if not USDA_FDC_API_KEY:
         logger.warning("USDA FDC API key not configured")
@@ -3168,7 +4179,10 @@ async def search_usda_fdc_product(query: str, base_en: str = None) -> Optional[D
 
         def _make_request():
             response = requests.get(url, params=params, timeout=20)
-            return response.json() if response.status_code == 200 else None
+            if response.status_code != 200:
+                _note_lookup_failure(f"usda: HTTP {response.status_code}")
+                return None
+            return response.json()
 
         data = await asyncio.to_thread(_make_request)
 
@@ -3255,16 +4269,13 @@ async def search_usda_fdc_product(query: str, base_en: str = None) -> Optional[D
 
             # Проверяем качество результата
             if kcal and kcal > 0 and (protein or fat or carbs):
-                result = {
-                    'name': food.get('description', query),
-                    'brand': food.get('brandOwner', ''),
-                    'kcal_100g': int(kcal) if kcal else 0,
-                    'protein_100g': float(protein) if protein else 0,
-                    'fat_100g': float(fat) if fat else 0,
-                    'carbs_100g': float(carbs) if carbs else 0,
-                    'url': f"https://fdc.nal.usda.gov/fdc-app.html#/food-details/{food.get('fdcId', '')}/nutrients",
-                    'source': 'usda'
-                }
+                result = NutritionResult(
+                    name=food.get('description', query),
+                    brand=food.get('brandOwner', ''),
+                    per_100g=(int(kcal), float(protein or 0), float(fat or 0), float(carbs or 0)),
+                    url=f"https://fdc.nal.usda.gov/fdc-app.html#/food-details/{food.get('fdcId', '')}/nutrients",
+                    source='usda',
+                )
 
                 logger.info(f"Found USDA result: {food.get('description', 'Unknown')} with score {score_food(food)}")
                 return result
@@ -3278,20 +4289,18 @@ async def search_usda_fdc_product(query: str, base_en: str = None) -> Optional[D
                     alt_carbs = _pick_nutr(alt_food, _NUT_IDS["carb"])
                     
                     if alt_kcal and alt_kcal > 0 and (alt_protein or alt_fat or alt_carbs):
-                        result = {
-                            'name': alt_food.get('description', query),
-                            'brand': alt_food.get('brandOwner', ''),
-                            'kcal_100g': int(alt_kcal) if alt_kcal else 0,
-                            'protein_100g': float(alt_protein) if alt_protein else 0,
-                            'fat_100g': float(alt_fat) if alt_fat else 0,
-                            'carbs_100g': float(alt_carbs) if alt_carbs else 0,
-                            'url': f"https://fdc.nal.usda.gov/fdc-app.html#/food-details/{alt_food.get('fdcId', '')}/nutrients",
-                            'source': 'usda'
-                        }
+                        result = NutritionResult(
+                            name=alt_food.get('description', query),
+                            brand=alt_food.get('brandOwner', ''),
+                            per_100g=(int(alt_kcal), float(alt_protein or 0), float(alt_fat or 0), float(alt_carbs or 0)),
+                            url=f"https://fdc.nal.usda.gov/fdc-app.html#/food-details/{alt_food.get('fdcId', '')}/nutrients",
+                            source='usda',
+                        )
                         logger.info(f"Found alternative USDA result: {alt_food.get('description', 'Unknown')}")
                         return result
 
     except Exception as e:
+        _note_lookup_failure(f"usda: {e}")
         logger.error(f"USDA FDC API error: {e}")
 
     return None
@@ -3309,7 +4318,7 @@ def calculate_nutrition_from_usda_fdc(product_data: Dict[str, Any], grams: int)
     }
 
 # ========= OPEN FOOD FACTS API =========
-async def search_openfoodfacts_product(query: str) -> Optional[Dict[str, Any]]:
+async def search_openfoodfacts_product(query: str) -> Optional[NutritionResult]:
     """Поиск продукта в Open Food Facts API"""
     try:
         # Очищаем запрос от лишних символов
@@ -3371,6 +4380,7 @@ async def search_openfoodfacts_product(query: str) -> Optional[Dict[str, Any]]:
                 if response.status_code == 200:
                     return response.json()
                 else:
+                    _note_lookup_failure(f"off: HTTP {response.status_code}")
                     logger.warning(f"Open Food Facts API returned status {response.status_code}")
                     return None
 
@@ -3463,23 +4473,21 @@ async def search_openfoodfacts_product(query: str) -> Optional[Dict[str, Any]]:
 
                 if score > best_overall_score and score >= min_threshold:
                     best_overall_score = score
-                    best_result = {
-                        'name': product.get('product_name', original_query) or original_query,
-                        'brand': product.get('brands', '') or '',
-                        'kcal_100g': int(energy) if energy > 0 else 0,
-                        'protein_100g': proteins,
-                        'fat_100g': fat,
-                        'carbs_100g': carbs,
-                        'url': f"https://world.openfoodfacts.org/product/{product.get('code', '')}"
-                    }
+                    best_result = NutritionResult(
+                        name=product.get('product_name', original_query) or original_query,
+                        brand=product.get('brands', '') or '',
+                        per_100g=(int(energy) if energy > 0 else 0, proteins, fat, carbs),
+                        url=f"https://world.openfoodfacts.org/product/{product.get('code', '')}",
+                    )
 
         if best_result:
-            logger.info(f"Found product: {best_result['name']} with {best_result['kcal_100g']} kcal (score: {best_overall_score})")
+            logger.info(f"Found product: {best_result.name} with {best_result.per_100g[0]} kcal (score: {best_overall_score})")
             return best_result
 
         logger.info(f"No suitable product found for any query variant")
 
     except Exception as e:
+        _note_lookup_failure(f"off: {e}")
         logger.error(f"Open Food Facts API error: {e}")
 
     return None
@@ -3529,12 +4537,12 @@ def get_menu_for_day(day: int, variant: str = "a") -> Optional[Dict[str, str]]:
 def get_current_menu_day(st: Dict[str, Any]) -> int:
     """Получить текущий день меню для пользователя (циклично 1-60)"""
     # Используем количество сгенерированных меню как основу для дня
-    menu_count = st["tmp"].get("menu_day_counter", 0)
+    menu_count = st.get("menu_day_counter", 0)
     return (menu_count % 60) + 1
 
 def increment_menu_day(st: Dict[str, Any]):
     """Увеличить счетчик дня меню"""
-    st["tmp"]["menu_day_counter"] = st["tmp"].get("menu_day_counter", 0) + 1
+    st["menu_day_counter"] = st.get("menu_day_counter", 0) + 1
 
 async def generate_menu_with_nutrition(profile: Dict[str, Any], menu_items: Dict[str, str], target_kcal: int, changes: str = "") -> str:
     """Генерирует меню с рассчитанной нутрициологом граммовкой и КБЖУ"""
@@ -3705,6 +4713,11 @@ def load_recipes() -> List[Recipe]:
         for r in _default_recipes()
     ]
 
+def find_recipe(rid: Optional[str]) -> Optional[Recipe]:
+    if not rid:
+        return None
+    return next((r for r in load_recipes() if r.id == rid), None)
+
 def recipe_categories(recs: List[Recipe]) -> List[str]:
     cats = sorted({r.category for r in recs})
     order = ["завтрак", "перекус", "обед", "ужин", "десерт"]
@@ -3836,20 +4849,8 @@ async def show_recipe_category(update: Update, context: ContextTypes.DEFAULT_TYP
     lines.append("\nВведите номер рецепта (1-5) или выберите другую категорию:")
 
     st["tmp"]["current_category"] = category
-    # Конвертируем Recipe объекты в словари для JSON сериализации
-    st["tmp"]["category_recipes"] = [
-        {
-            "id": r.id,
-            "title": r.title,
-            "category": r.category,
-            "kcal": r.kcal,
-            "protein_g": r.protein_g,
-            "fat_g": r.fat_g,
-            "carbs_g": r.carbs_g,
-            "steps": r.steps,
-            "ingredients": r.ingredients
-        } for r in category_recipes
-    ]
+    # только id показанных рецептов — сами рецепты берём из recipes.json при выборе
+    st["tmp"]["category_recipe_ids"] = [r.id for r in category_recipes[:5]]
     st["awaiting"] = "recipe_number"
 
     await update.message.reply_text(
@@ -3892,13 +4893,7 @@ async def show_recipe_detail(update: Update, context: ContextTypes.DEFAULT_TYPE,
 
     lines.append("\nДобавить в дневник? (да/нет)")
 
-    st["tmp"]["current_recipe"] = {
-        "title": recipe.title,
-        "kcal": recipe.kcal,
-        "protein_g": recipe.protein_g,
-        "fat_g": recipe.fat_g,
-        "carbs_g": recipe.carbs_g
-    }
+    st["tmp"]["current_recipe_id"] = recipe.id
     st["awaiting"] = "add_recipe_to_diary"
 
     await update.message.reply_text(
@@ -3964,7 +4959,7 @@ async def recipes_callbacks(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 return
 
             if rid == "random" and get_user_access(st, u.id) == "free":
-                st["tmp"]["used_random_recipe"] = True
+                st["used_random_recipe"] = True
                 save_state(u.id, st)
 
             await query.edit_message_text(format_recipe_card(r), reply_markup=kb_recipe_actions(r.id))
@@ -3976,10 +4971,9 @@ async def recipes_callbacks(update: Update, context: ContextTypes.DEFAULT_TYPE):
             if not r:
                 await query.answer("Рецепт не найден")
                 return
-            st["diaries"]["food"].append(
+            append_diary(u.id, "food",
                 {"ts": now_ts(), "text": f"Рецепт: {r.title}", "kcal": r.kcal, "p": r.protein_g, "f": r.fat_g, "c": r.carbs_g}
             )
-            add_kcal_in(st, r.kcal)
             add_points(st, 2)
             save_state(u.id, st)
             await query.answer("Добавлено в дневник ✅")
@@ -3995,16 +4989,6 @@ async def recipes_callbacks(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.answer("Ошибка")
 
 # ========= ЛИДЕРБОРД =========
-def leaderboard_all() -> List[Dict[str, Any]]:
-    arr = []
-    for k in db_keys_prefix("user:"):
-        st = db_get(k, {})
-        if isinstance(st, dict):
-            pts = int(st.get("points", 0))
-            arr.append({"user_id": k.split(":", 1)[-1], "points": pts})
-    arr.sort(key=lambda x: x["points"], reverse=True)
-    return arr
-
 # ========= КОМАНДЫ =========
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     u = update.effective_user
@@ -4034,7 +5018,8 @@ async def help_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     u = update.effective_user
     st = load_state(u.id)
     help_text = (
-        "/start — меню\n/help — помощь\n/whoami — ваш ID\n/health — 200 OK\n/version — текущая версия\n/shop — магазин\n\n"
+        "/start — меню\n/help — помощь\n/whoami — ваш ID\n/health — 200 OK\n/version — текущая версия\n/shop — магазин\n"
+        "/export — выгрузка дневников файлом (csv или jsonl)\n\n"
         "Любой текст в выбранной роли — вопрос соответствующему специалисту. 💬"
     )
 
@@ -4043,7 +5028,9 @@ async def help_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "\n\n👑 Команды разработчика:\n"
             "/add_admin <user_id> — добавить администратора\n"
             "/remove_admin <user_id> — удалить администратора\n"
-            "/list_admins — список администраторов"
+            "/list_admins — список администраторов\n"
+            "/snapshot — снапшот данных и кэша\n"
+            "/memory — память процесса (start | snap | stop — профиль tracemalloc)"
         )
 
     await update.message.reply_text(help_text, reply_markup=role_keyboard(st.get("current_role")))
@@ -4051,8 +5038,90 @@ async def help_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def version_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(VERSION)
 
+# Задержка цикла событий: поток-сторож ловит синхронные блокировки (SQLite, json.dump, разбор HTML)
+# и пишет место в лог; метрика — /metrics keep-alive сервера и /health для администраторов.
+LOOP_LAG_MS = float(os.getenv("HLITE_LOOP_LAG_MS", "200"))  # 0 — сторож выключен
+loop_watch = loop_watchdog.LoopWatchdog(LOOP_LAG_MS / 1000)
+
 async def health_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text("200 OK")
+    user = update.effective_user
+    text = "200 OK"
+    if loop_watch.running and user and (is_developer(user.id) or is_admin_user(user.id)):
+        text += "\n" + "\n".join(loop_watch.summary())
+    await update.message.reply_text(text)
+
+# ========= ДИАГНОСТИКА ПАМЯТИ =========
+# /memory — RSS и размеры структур; /memory start [кадров] включает tracemalloc,
+# /memory snap — топ мест аллокации и прирост с прошлого снапшота, /memory stop — выключает.
+mem_profiler = memprof.MemoryProfiler()
+
+def _memory_structures() -> List[str]:
+    fmt = memprof.fmt_bytes
+    lines = []
+    store = getattr(local_db, "store", None)
+    if isinstance(store, dict):
+        lines.append(f"• база в памяти: {len(store)} ключей, ~{fmt(memprof.approx_sizeof(iter(store.values()), len(store)))}")
+    lines.append(f"• state_cache: {len(state_cache)} состояний, ~{fmt(state_cache.bytes)} "
+                 f"(лимит {fmt(state_cache.max_bytes)}), грязных в очереди: {len(state_writer._dirty)}")
+    lines.append(f"• сессии диалогов: {len(sessions)}, ~{fmt(memprof.deep_sizeof(sessions._items))}")
+    lines.append(f"• архив дневников (LRU): {len(diary_store._cold_cache)} месяцев, "
+                 f"~{fmt(memprof.deep_sizeof(diary_store._cold_cache))}")
+    lines.append(f"• негативный кэш поиска: {len(negative_cache)} записей; поисков в работе: {len(lookup_flights)}, "
+                 f"склеено повторов: {lookup_flights.stats()['coalesced_total']}")
+    lines.append(f"• лидерборд: {len(leaderboard)} пользователей")
+    lines.append(f"• тарифы: {len(entitlements._tiers)}, блокировки: {len(_user_locks)}, выгрузки: {len(_export_tasks)}")
+    cs = nutri_cache.stats()
+    ratio = lambda r: "н/д" if r is None else f"{r:.0%}"
+    lines.append(f"• кэш продуктов в памяти: {cs['memory']['items']} записей, {fmt(cs['memory']['bytes'])}, "
+                 f"попаданий {ratio(cs['memory']['hit_ratio'])}")
+    lines.append(f"• кэш продуктов (SQLite): {cs['rows']} записей, {fmt(cs['bytes'])}, "
+                 f"попаданий {ratio(cs['hit_ratio'])} (всего {ratio(cs['total_hit_ratio'])})")
+    lines.append(f"• объектов под gc: {len(gc.get_objects())}")
+    return lines
+
+async def memory_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    if not (is_developer(user.id) or is_admin_user(user.id)):
+        await update.message.reply_text("❌ Только для администраторов.")
+        return
+
+    action = (context.args[0].lower() if context.args else "")
+    lines: List[str] = []
+    if action == "start":
+        frames = int(context.args[1]) if len(context.args) > 1 and context.args[1].isdigit() else 1
+        if mem_profiler.start(frames):
+            lines.append(f"✅ tracemalloc включён ({frames} кадр.). Дальше: /memory snap")
+        else:
+            lines.append("⚠️ tracemalloc уже включён.")
+    elif action == "stop":
+        mem_profiler.stop()
+        lines.append("✅ tracemalloc выключен.")
+    elif action == "snap":
+        if not mem_profiler.tracing:
+            await update.message.reply_text("Сначала /memory start")
+            return
+        current, growth = await asyncio.to_thread(mem_profiler.snapshot, 10)
+        traced, peak = mem_profiler.traced()
+        lines.append(f"📸 Отслежено: {memprof.fmt_bytes(traced)} (пик {memprof.fmt_bytes(peak)})")
+        lines.append("Топ мест аллокации:")
+        lines.extend(current)
+        if growth:
+            lines.append("")
+            lines.append("Прирост " + growth[0])
+            lines.extend(growth[1:] or ["— нет"])
+    elif action:
+        lines.append("Использование: /memory [start [кадров] | snap | stop]")
+    else:
+        rss = memprof.rss_bytes()
+        lines.append(f"🧠 RSS: {memprof.fmt_bytes(rss) if rss is not None else 'н/д'}")
+        if mem_profiler.tracing:
+            traced, peak = mem_profiler.traced()
+            lines.append(f"tracemalloc: {memprof.fmt_bytes(traced)} (пик {memprof.fmt_bytes(peak)})")
+        else:
+            lines.append("tracemalloc: выключен (/memory start)")
+        lines.extend(_memory_structures())
+    text = "\n".join(lines)
+    await update.message.reply_text(text[:3900])
 
 async def whoami_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
@@ -4167,28 +5236,130 @@ async def refresh_database_cmd(update: Update, context: ContextTypes.DEFAULT_TYP
         if os.path.exists(temp_path):
             os.unlink(temp_path)
 
+# ========= СНАПШОТЫ =========
+SNAPSHOT_DIR = os.getenv("HLITE_SNAPSHOT_DIR", "./data/snapshots")
+if SHARD_INDEX is not None:
+    SNAPSHOT_DIR = os.path.join(SNAPSHOT_DIR, f"shard{SHARD_INDEX}")
+SNAPSHOT_INTERVAL_H = float(os.getenv("HLITE_SNAPSHOT_INTERVAL_H", "24"))  # 0 — только по команде
+SNAPSHOT_KEEP = int(os.getenv("HLITE_SNAPSHOT_KEEP", "7"))
+_snapshot_lock = threading.Lock()
+
+def take_snapshot(root: str = SNAPSHOT_DIR) -> Tuple[str, Dict[str, Dict[str, Any]]]:
+    """
+    Точечная копия состояния пользователей и кэша питания (см. snapshots.py).
+    Идёт в рабочем потоке, обработку апдейтов не останавливает. Восстановление:
+    python snapshots.py restore <каталог> при остановленном боте.
+    """
+    with _snapshot_lock:
+        path = snapshots.new_snapshot_dir(root)
+        part = f"{path}.part"
+        try:
+            files = local_db.snapshot(part) if hasattr(local_db, "snapshot") else {}
+            info = snapshots.backup_sqlite(CACHE_DB_PATH, os.path.join(part, "cache.db.gz"))
+            info.update(target=CACHE_DB_PATH, remove=[f"{CACHE_DB_PATH}-journal", f"{CACHE_DB_PATH}-wal", f"{CACHE_DB_PATH}-shm"])
+            files["cache.db.gz"] = info
+            snapshots.finish_snapshot(path, files, {"backend": STORAGE_BACKEND})
+        except Exception:
+            shutil.rmtree(part, ignore_errors=True)
+            raise
+        snapshots.prune(root, SNAPSHOT_KEEP)
+        return path, files
+
+async def _run_snapshot() -> Tuple[str, Dict[str, Dict[str, Any]]]:
+    # отложенные состояния сначала на диск — в потоке снапшота их трогать нельзя
+    state_writer.flush()
+    return await asyncio.to_thread(take_snapshot)
+
+async def _snapshot_loop():
+    while True:
+        await asyncio.sleep(SNAPSHOT_INTERVAL_H * 3600)
+        try:
+            path, _ = await _run_snapshot()
+            logger.info(f"Snapshot saved: {path}")
+        except Exception as e:
+            logger.error(f"Snapshot failed: {e}")
+
+async def snapshot_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    if not (is_developer(user.id) or is_admin_user(user.id)):
+        await update.message.reply_text("❌ Только администраторы могут делать снапшоты.")
+        return
+
+    started = time.monotonic()
+    try:
+        path, files = await _run_snapshot()
+    except Exception as e:
+        logger.error(f"Snapshot failed: {e}")
+        await update.message.reply_text(f"❌ Снапшот не удался: {e}")
+        return
+
+    lines = [f"✅ Снапшот: {path} ({time.monotonic() - started:.1f} с)"]
+    for name in files:
+        size = os.path.getsize(os.path.join(path, name))
+        lines.append(f"• {name}: {files[name]['bytes'] // 1024} КБ → {size // 1024} КБ")
+    await update.message.reply_text("\n".join(lines))
+
+# ========= ВЫГРУЗКА ДНЕВНИКОВ =========
+# Файл собирается в фоне (поток + временный файл), обработчик сразу отпускает пользователя:
+# пока идёт выгрузка, остальные сообщения обрабатываются как обычно.
+EXPORT_KINDS = ("food", "train")
+_export_tasks: Dict[int, asyncio.Task] = {}
+
+async def _send_export(bot, chat_id: int, uid: int, fmt: str):
+    fd, path = tempfile.mkstemp(prefix=f"healco-export-{uid}-", suffix=f".{fmt}")
+    os.close(fd)
+    started = time.monotonic()
+    loop = asyncio.get_running_loop()
+
+    async def snapshot(month: str):
+        return diary_store.month_rows(uid, month, EXPORT_KINDS)
+
+    def rows(months: List[str]):
+        # поток выгрузки не читает хранилище сам: копию месяца снимает event loop,
+        # где пишут обработчики, — так файл не рвётся посреди добавления записи
+        for month in months:
+            yield from asyncio.run_coroutine_threadsafe(snapshot(month), loop).result()
+
+    try:
+        months = diary_store.export_months(uid, EXPORT_KINDS)
+        n = await asyncio.to_thread(diary_export.write_export, rows(months), fmt, path)
+        logger.info(f"Export for {uid}: {n} entries, {os.path.getsize(path) // 1024} KB in {time.monotonic() - started:.1f} s")
+        with open(path, "rb") as f:
+            await bot.send_document(
+                chat_id, document=f, filename=f"healco-diary-{datetime.now():%Y-%m-%d}.{fmt}",
+                caption=f"📒 Дневники питания и тренировок: {n} записей",
+            )
+    except Exception as e:
+        logger.error(f"Export failed for {uid}: {e}")
+        await bot.send_message(chat_id, "❌ Не удалось подготовить выгрузку, попробуйте позже.")
+    finally:
+        os.remove(path)
+        _export_tasks.pop(uid, None)
+
+async def export_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    u = update.effective_user
+    fmt = (context.args[0].lower() if context.args else "csv").lstrip(".")
+    if fmt not in diary_export.FORMATS:
+        await update.message.reply_text("Формат: /export csv или /export jsonl")
+        return
+    if u.id in _export_tasks:
+        await update.message.reply_text("⏳ Выгрузка уже готовится — пришлю файл, как только будет готов.")
+        return
+    total = diary_store.count(u.id, EXPORT_KINDS)
+    if not total:
+        await update.message.reply_text("Дневники пока пусты — выгружать нечего.")
+        return
+    _export_tasks[u.id] = context.application.create_task(
+        _send_export(context.bot, update.effective_chat.id, u.id, fmt)
+    )
+    await update.message.reply_text(f"⏳ Готовлю выгрузку ({total} записей, {fmt.upper()}) — пришлю файлом.")
+
 # ========= ДНЕВНИК/СВОДКИ =========
 def _safe_list(v):
     return v if isinstance(v, list) else []
 
-def _aggregate_food_day(food_entries: List[Dict[str, Any]], day: str) -> Optional[Dict[str, int]]:
-    kcal = p = f = c = 0
-    has = False
-    for x in food_entries:
-        if isinstance(x, dict) and isinstance(x.get("ts", ""), str) and x["ts"][:10] == day:
-            has = True
-            try:
-                # Более безопасное извлечение числовых значений
-                kcal += float(x.get("kcal", 0)) if x.get("kcal") is not None else 0
-                p += float(x.get("p", 0)) if x.get("p") is not None else 0
-                f += float(x.get("f", 0)) if x.get("f") is not None else 0
-                c += float(x.get("c", 0)) if x.get("c") is not None else 0
-            except (ValueError, TypeError):
-                pass
-    return {"kcal": int(kcal), "p": int(p), "f": int(f), "c": int(c)} if has else None
-
-def format_diary_entries_for_editing(entries: List[Dict[str, Any]], entry_type: str) -> str:
-    """Форматирует записи дневника для редактирования"""
+def format_diary_entries_for_editing(entries: List[Dict[str, Any]], entry_type: str, total: Optional[int] = None) -> str:
+    """Форматирует записи дневника для редактирования (entries — хвост дневника, total — всего записей)"""
     if not entries:
         return f"Нет записей в дневнике {entry_type}."
 
@@ -4221,37 +5392,29 @@ def format_diary_entries_for_editing(entries: List[Dict[str, Any]], entry_type:
             hr_text = f", ср. пульс {avg_hr}" if avg_hr else ""
             lines.append(f"{i}. [{date_part} {time_part}] {workout_type}: {text}{hr_text} - {kcal} ккал")
 
-    lines.append(f"\nВсего записей: {len(entries)}")
+    lines.append(f"\nВсего записей: {total if total is not None else len(entries)}")
     lines.append("Введите номер записи для удаления (1-10), 'все' для удаления всех записей или 'отмена':")
     return "\n".join(lines)
 
 async def show_diaries(update: Update, st: Dict[str, Any]):
+    uid = update.effective_user.id
     try:
-        diaries, daily_energy = st.get("diaries", {}), st.get("daily_energy", {})
-        foods, trains, metrics = _safe_list(diaries.get("food")), _safe_list(diaries.get("train")), _safe_list(diaries.get("metrics"))
-        days_set = {
-            ts[:10]
-            for ts in [x.get("ts") for lst in (foods, trains, metrics) for x in lst if isinstance(x, dict) and isinstance(x.get("ts"), str) and len(x["ts"]) >= 10]
-        }
-        days_set.update(k for k in daily_energy.keys() if isinstance(k, str) and len(k) == 10)
-        if not days_set:
-            days_set.add(today_key())
-        days = sorted(days_set, reverse=True)[:7]
+        # итоги дней ведутся при добавлении/удалении записей — здесь только чтение
+        recent = diary_store.recent_days(uid, 7) or [(today_key(), diary_store.rollup(uid, today_key()))]
+        # тренировки нужны поимённо — читаем записи только за дни, где они есть
+        train_days = [d for d, r in recent if r.get("train_n")]
+        trains = diary_store.columns(uid, "train", min(train_days), max(train_days)) if train_days else DiaryColumns()
         lines = ["Сводка последних дней: 📅"]
-        for d in days:
-            agg = _aggregate_food_day(foods, d)
-            day_trains = [t for t in trains if isinstance(t, dict) and isinstance(t.get("ts"), str) and t["ts"].startswith(d)]
-            total_train_kcal = sum(int(t.get("kcal", 0)) for t in day_trains)
+        for d, agg in recent:
+            day_trains = trains.to_entries(*trains.day(d))
+            total_train_kcal = int(agg.get("train_kcal", 0))
             lines.append(f"\n{d}")
-            if agg and agg['kcal'] > 0:
-                lines.append(f"🍏 Еда: ~{agg['kcal']} ккал; Б{agg['p']}/Ж{agg['f']}/У{agg['c']}")
+            if agg.get("kcal", 0) > 0 and agg.get("food_n"):
+                lines.append(f"🍏 Еда: ~{int(agg['kcal'])} ккал; Б{int(agg['p'])}/Ж{int(agg['f'])}/У{int(agg['c'])}")
+            elif agg.get("kcal", 0) > 0:
+                lines.append(f"🍏 Еда: ~{int(agg['kcal'])} ккал")
             else:
-                de = daily_energy.get(d) or {}
-                eaten_kcal = int(de.get('in', 0))
-                if eaten_kcal > 0:
-                    lines.append(f"🍏 Еда: ~{eaten_kcal} ккал")
-                else:
-                    lines.append("🍏 Еда: пусто")
+                lines.append("🍏 Еда: пусто")
             if day_trains:
                 lines.append("💪 Тренировки:")
                 # Группируем тренировки и убираем дубликаты
@@ -4280,13 +5443,11 @@ async def show_diaries(update: Update, st: Dict[str, Any]):
                 else:
                     lines.append("💪 Тренировки: пусто")
             else:
-                de = daily_energy.get(d) or {}
-                burned_kcal = int(de.get('out', 0))
-                if burned_kcal > 0:
-                    lines.append(f"💪 Тренировки: ~{burned_kcal} ккал")
+                if total_train_kcal > 0:
+                    lines.append(f"💪 Тренировки: ~{total_train_kcal} ккал")
                 else:
                     lines.append("💪 Тренировки: пусто")
-        eat, burn = day_totals(st)
+        eat, burn = day_totals(uid)
         if profile_complete(st["profile"]):
             k = calc_kbju_weight_loss(st["profile"])
             lines.append(
@@ -4298,10 +5459,10 @@ async def show_diaries(update: Update, st: Dict[str, Any]):
                 )
             # Добавляем остаток калорий и БЖУ
             remaining_kcal = k['target_kcal'] - eat
-            today_agg = _aggregate_food_day(foods, today_key())
-            consumed_p = today_agg['p'] if today_agg and today_agg['kcal'] > 0 else 0
-            consumed_f = today_agg['f'] if today_agg and today_agg['kcal'] > 0 else 0
-            consumed_c = today_agg['c'] if today_agg and today_agg['kcal'] > 0 else 0
+            today_agg = diary_store.rollup(uid, today_key())
+            consumed_p = int(today_agg['p'])
+            consumed_f = int(today_agg['f'])
+            consumed_c = int(today_agg['c'])
 
             remaining_p = max(0, k['protein_g'] - consumed_p)
             remaining_f = max(0, k['fat_g'] - consumed_f)
@@ -4371,15 +5532,12 @@ async def show_points(update: Update, st: Dict[str, Any]):
         return
 
     pts = int(st.get("points", 0))
-    board_all = leaderboard_all()
-    total = len(board_all)
-    rank = None
+    board = ensure_leaderboard()
+    board.update(u.id, pts)
+    total = len(board)
+    rank = board.rank(u.id)
     uid_str = str(u.id)
-    for i, user_data in enumerate(board_all, 1):
-        if str(user_data["user_id"]) == uid_str:
-            rank = i
-            break
-    top = board_all[:10]
+    top = board.top(10)
     lines = [f"Ваши баллы: {pts} 🏅"]
     if rank:
         lines.append(f"Ваше место: {rank} из {total} 🙂")
@@ -4478,9 +5636,20 @@ async def successful_payment_callback(update: Update, context: ContextTypes.DEFA
 
     if payload.startswith("subscribe_"):
         _, tier, user_id = payload.split("_")
+        until = ""
+        if SUBSCRIPTION_DAYS > 0:
+            # продление того же тарифа считается от текущей даты окончания
+            start_ts = time.time()
+            if st.get("access_level") == tier and st.get("access_expires"):
+                start_ts = max(start_ts, float(st["access_expires"]))
+            st["access_expires"] = start_ts + SUBSCRIPTION_DAYS * 86400
+            until = f" Действует до {datetime.fromtimestamp(st['access_expires']).strftime('%d.%m.%Y')}."
+        else:
+            st.pop("access_expires", None)
         st["access_level"] = tier
+        entitlements.invalidate_user(u.id)
         save_state(u.id, st)
-        await context.bot.send_message(chat_id=u.id, text=f"Оплата прошла успешно! Ваш тариф обновлён до «{tier.capitalize()}». Спасибо за поддержку! 🎉")
+        await context.bot.send_message(chat_id=u.id, text=f"Оплата прошла успешно! Ваш тариф обновлён до «{tier.capitalize()}».{until} Спасибо за поддержку! 🎉")
     elif payload.startswith("motivation_"):
         _, role, user_id = payload.split("_")
         msg_list = load_motivations().get(role, [])
@@ -4539,7 +5708,7 @@ async def handle_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE, st:
             )
             st["awaiting"] = "recipe_category"
             return True
-        elif get_user_access(st, u.id) == "free" and st["tmp"].get("used_random_recipe"):
+        elif get_user_access(st, u.id) == "free" and st.get("used_random_recipe"):
             await update.message.reply_text(
                 "Вы уже использовали свой бесплатный случайный рецепт на сегодня. Полный доступ к рецептам — в тарифе Премиум и выше. ⭐",
                 reply_markup=role_keyboard("nutri"),
@@ -4552,12 +5721,12 @@ async def handle_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE, st:
         await show_diaries(update, st)
         return True
     if text == "✏️ Редактировать питание":
-        foods = _safe_list(st["diaries"].get("food", []))
+        foods = [e for _, _, e in diary_store.tail(u.id, "food", 10)]
         if not foods:
             await update.message.reply_text("Дневник питания пуст.", reply_markup=role_keyboard(st.get("current_role")))
             return True
 
-        diary_text = format_diary_entries_for_editing(foods, "питания")
+        diary_text = format_diary_entries_for_editing(foods, "питания", total=diary_store.count(u.id, ("food",)))
         st["awaiting"] = "edit_food_diary"
         await update.message.reply_text(
             diary_text,
@@ -4565,12 +5734,12 @@ async def handle_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE, st:
         )
         return True
     if text == "✏️ Редактировать тренировки":
-        trains = _safe_list(st["diaries"].get("train", []))
+        trains = [e for _, _, e in diary_store.tail(u.id, "train", 10)]
         if not trains:
             await update.message.reply_text("Дневник тренировок пуст.", reply_markup=role_keyboard(st.get("current_role")))
             return True
 
-        diary_text = format_diary_entries_for_editing(trains, "тренировок")
+        diary_text = format_diary_entries_for_editing(trains, "тренировок", total=diary_store.count(u.id, ("train",)))
         st["awaiting"] = "edit_train_diary"
         await update.message.reply_text(
             diary_text,
@@ -4583,7 +5752,7 @@ async def handle_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE, st:
     if text == "⬅️ Назад":
         st["current_role"] = None
         st["awaiting"] = None
-        st["tmp"] = {}
+        st["tmp"].clear()
         await update.message.reply_text("Главное меню:", reply_markup=role_keyboard(None))
         return True
 
@@ -4603,7 +5772,7 @@ async def handle_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE, st:
                 await update.message.reply_text("Сначала заполните анкету. 🙂")
                 return True
             bmi, cat = calc_bmi(float(st["profile"]["weight_kg"]), int(st["profile"]["height_cm"]))
-            st["diaries"]["metrics"].append({"ts": now_ts(), "type": "bmi", "data": {"bmi": bmi, "cat": cat}})
+            append_diary(u.id, "metrics", {"ts": now_ts(), "type": "bmi", "data": {"bmi": bmi, "cat": cat}})
             if award_once(st, "bmi"):
                 add_points(st, 2)
             await update.message.reply_text(f"BMI: {bmi} — {cat}. Записано. ✅", reply_markup=role_keyboard("nutri"))
@@ -4616,7 +5785,7 @@ async def handle_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE, st:
                 await update.message.reply_text("Сначала заполните анкету. 🙂")
                 return True
             k = calc_kbju_weight_loss(st["profile"])
-            st["diaries"]["metrics"].append({"ts": now_ts(), "type": "kbju", "data": k})
+            append_diary(u.id, "metrics", {"ts": now_ts(), "type": "kbju", "data": k})
             if award_once(st, "kbju"):
                 add_points(st, 2)
 
@@ -4768,9 +5937,9 @@ async def handle_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE, st:
             if not profile_complete(st["profile"]):
                 await update.message.reply_text("Сначала заполните анкету. 🙂")
                 return True
-            age, hrrest = int(st["profile"]["age"]), get_last_hrrest(st)
+            age, hrrest = int(st["profile"]["age"]), get_last_hrrest(u.id)
             z = pulse_zones(age, hrrest)
-            st["diaries"]["metrics"].append({"ts": now_ts(), "type": "zones", "data": {"hrrest": hrrest, "zones": z}})
+            append_diary(u.id, "metrics", {"ts": now_ts(), "type": "zones", "data": {"hrrest": hrrest, "zones": z}})
             if award_once(st, "zones"):
                 add_points(st, 2)
             txt = (
@@ -4786,11 +5955,11 @@ async def handle_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE, st:
             if not profile_complete(st["profile"]):
                 await update.message.reply_text("Сначала заполните анкету. 🙂")
                 return True
-            age, hrrest = int(st["profile"]["age"]), get_last_hrrest(st)
+            age, hrrest = int(st["profile"]["age"]), get_last_hrrest(u.id)
             hrmax = 208 - 0.7 * age
             vo2_est = 15.3 * (hrmax / hrrest)
             cat = vo2_category(st["profile"].get("gender", "Мужской"), vo2_est)
-            st["diaries"]["metrics"].append({"ts": now_ts(), "type": "vo2", "data": {"vo2": round(vo2_est, 1), "cat": cat, "from": "estimate", "hrrest": hrrest}})
+            append_diary(u.id, "metrics", {"ts": now_ts(), "type": "vo2", "data": {"vo2": round(vo2_est, 1), "cat": cat, "from": "estimate", "hrrest": hrrest}})
             if award_once(st, "vo2"):
                 add_points(st, 2)
 
@@ -4845,9 +6014,7 @@ async def handle_text_or_photo(update: Update, context: ContextTypes.DEFAULT_TYP
 
         # --- Дневник питания ---
         if awaiting == "log_food_entry":
-            food_count = len(st["diaries"].get("food", []))
-            train_count = len(st["diaries"].get("train", []))
-            if get_user_access(st, u.id) == "free" and (food_count + train_count) >= FREE_DIARY_LIMIT:
+            if get_user_access(st, u.id) == "free" and diary_store.count(u.id, ("food", "train")) >= FREE_DIARY_LIMIT:
                 await update.message.reply_text(
                     f"Вы достигли лимита в {FREE_DIARY_LIMIT} записи в дневнике. "
                     "Для неограниченных записей перейдите на тариф «Базовый» или выше. ⭐",
@@ -4888,7 +6055,6 @@ async def handle_text_or_photo(update: Update, context: ContextTypes.DEFAULT_TYP
 
                 if kcal:
                     entry.update({"kcal": kcal, "p": protein, "f": fat, "c": carbs})
-                    add_kcal_in(st, kcal)
 
                 add_points(st, 3)
 
@@ -4899,10 +6065,10 @@ async def handle_text_or_photo(update: Update, context: ContextTypes.DEFAULT_TYP
                 if analysis.get("notes"):
                     reply_lines.append(f"📋 {analysis['notes']}")
 
-                st["diaries"]["food"].append(entry)
+                append_diary(u.id, "food", entry)
                 st["awaiting"] = None
 
-                eat, burn = day_totals(st)
+                eat, burn = day_totals(u.id)
                 if profile_complete(st["profile"]):
                     k = calc_kbju_weight_loss(st["profile"])
                     reply_lines.append(
@@ -5015,7 +6181,6 @@ async def handle_text_or_photo(update: Update, context: ContextTypes.DEFAULT_TYP
                 carbs = round(est.get("carbs_g", 0), 1)
 
                 entry.update({"kcal": kcal, "p": protein, "f": fat, "c": carbs})
-                add_kcal_in(st, kcal)
 
                 source_note = est.get('notes', 'анализ')
                 source_data = est.get('source_data', {})
@@ -5045,11 +6210,11 @@ async def handle_text_or_photo(update: Update, context: ContextTypes.DEFAULT_TYP
                     "❌ Продукт не найден. Попробуйте указать более точное название или добавьте бренд для готовых продуктов. 🙂"
                 )
 
-            st["diaries"]["food"].append(entry)
+            append_diary(u.id, "food", entry)
             add_points(st, points)
             st["awaiting"] = None
 
-            eat, burn = day_totals(st)
+            eat, burn = day_totals(u.id)
             if profile_complete(st["profile"]):
                 k = calc_kbju_weight_loss(st["profile"])
                 reply_lines.append(
@@ -5147,7 +6312,6 @@ async def handle_text_or_photo(update: Update, context: ContextTypes.DEFAULT_TYP
             carbs = round(est.get("carbs_g", 0) or 0, 1)
 
             entry.update({"kcal": kcal, "p": protein, "f": fat, "c": carbs})
-            add_kcal_in(st, kcal)
 
             prefix = pending.get("prefix") or (
                 "Фото сохранено. +3 балла. ✅" if pending.get("is_photo") else "Запись сохранена. +2 балла. ✅"
@@ -5158,12 +6322,12 @@ async def handle_text_or_photo(update: Update, context: ContextTypes.DEFAULT_TYP
             if note_text:
                 reply_lines.append(note_text)
 
-            st["diaries"]["food"].append(entry)
+            append_diary(u.id, "food", entry)
             add_points(st, pending.get("points", 2))
             st["awaiting"] = None
             st["tmp"].pop("pending_brand_entry", None)
 
-            eat, burn = day_totals(st)
+            eat, burn = day_totals(u.id)
             if profile_complete(st["profile"]):
                 k = calc_kbju_weight_loss(st["profile"])
                 reply_lines.append(
@@ -5205,8 +6369,7 @@ async def handle_text_or_photo(update: Update, context: ContextTypes.DEFAULT_TYP
                         break
 
                 if kcal > 0:
-                    add_kcal_in(st, kcal)
-                    st["diaries"]["food"].append({
+                    append_diary(u.id, "food", {
                         "ts": now_ts(),
                         "text": f"Меню на день: {last_menu}",
                         "kcal": kcal,
@@ -5226,9 +6389,7 @@ async def handle_text_or_photo(update: Update, context: ContextTypes.DEFAULT_TYP
 
         # --- Внести тренировку ---
         elif awaiting == "add_workout":
-            food_count = len(st["diaries"].get("food", []))
-            train_count = len(st["diaries"].get("train", []))
-            if get_user_access(st, u.id) == "free" and (food_count + train_count) >= FREE_DIARY_LIMIT:
+            if get_user_access(st, u.id) == "free" and diary_store.count(u.id, ("food", "train")) >= FREE_DIARY_LIMIT:
                 await update.message.reply_text(
                     f"Лимит в {FREE_DIARY_LIMIT} записи в дневнике. Для безлимита нужен тариф «Базовый». ⭐",
                     reply_markup=role_keyboard(st.get("current_role")),
@@ -5257,10 +6418,9 @@ async def handle_text_or_photo(update: Update, context: ContextTypes.DEFAULT_TYP
                 ] if kw in t),
                 "тренировка",
             )
-            st["diaries"]["train"].append({"ts": now_ts(), "text": desc or "Тренировка", "type": t_type, "avg_hr": hrm, "kcal": kcal})
-            add_kcal_out(st, kcal)
+            append_diary(u.id, "train", {"ts": now_ts(), "text": desc or "Тренировка", "type": t_type, "avg_hr": hrm, "kcal": kcal})
             add_points(st, 3)
-            eat, burn = day_totals(st)
+            eat, burn = day_totals(u.id)
             k = calc_kbju_weight_loss(st["profile"]) if profile_complete(st["profile"]) else None
             msg = f"Записал: {t_type}{', пульс '+str(hrm) if hrm else ''}, ~{kcal} ккал. +3 балла. ✅\nСегодня: съедено ~{eat} ккал; сожжено ~{burn} ккал."
             if k:
@@ -5347,7 +6507,7 @@ async def handle_text_or_photo(update: Update, context: ContextTypes.DEFAULT_TYP
                 hrrest = int(text)
                 assert 35 <= hrrest <= 110
                 z = pulse_zones(int(st["profile"]["age"]), hrrest)
-                st["diaries"]["metrics"].append({"ts": now_ts(), "type": "zones", "data": {"hrrest": hrrest, "zones": z}})
+                append_diary(u.id, "metrics", {"ts": now_ts(), "type": "zones", "data": {"hrrest": hrrest, "zones": z}})
                 txt = (
                     "Обновлённые диапазоны ЧСС ❤️ (уд/мин):\n"
                     f"Восстановление: {z['recovery'][0]}–{z['recovery'][1]}\nАэробная база: {z['aerobic'][0]}–{z['aerobic'][1]}\n"
@@ -5361,7 +6521,7 @@ async def handle_text_or_photo(update: Update, context: ContextTypes.DEFAULT_TYP
             try:
                 vo2 = float(text.replace(",", "."))
                 cat = vo2_category(st["profile"].get("gender", "Мужской"), vo2)
-                st["diaries"]["metrics"].append({"ts": now_ts(), "type": "vo2", "data": {"vo2": vo2, "cat": cat}})
+                append_diary(u.id, "metrics", {"ts": now_ts(), "type": "vo2", "data": {"vo2": vo2, "cat": cat}})
                 if award_once(st, "vo2_manual"):
                     add_points(st, 2)
                 await update.message.reply_text(f"VO2max: {vo2:.1f} — {cat}. Записано. ✅", reply_markup=role_keyboard("trainer"))
@@ -5407,21 +6567,9 @@ async def handle_text_or_photo(update: Update, context: ContextTypes.DEFAULT_TYP
 
             try:
                 recipe_num = int(text)
-                category_recipes = st["tmp"].get("category_recipes", [])
-                if 1 <= recipe_num <= min(5, len(category_recipes)):
-                    recipe_dict = category_recipes[recipe_num - 1]
-                    # Создаем Recipe объект из словаря
-                    recipe = Recipe(
-                        id=recipe_dict["id"],
-                        title=recipe_dict["title"],
-                        category=recipe_dict["category"],
-                        kcal=recipe_dict["kcal"],
-                        protein_g=recipe_dict["protein_g"],
-                        fat_g=recipe_dict["fat_g"],
-                        carbs_g=recipe_dict["carbs_g"],
-                        steps=recipe_dict["steps"],
-                        ingredients=recipe_dict.get("ingredients")
-                    )
+                recipe_ids = st["tmp"].get("category_recipe_ids", [])
+                recipe = find_recipe(recipe_ids[recipe_num - 1]) if 1 <= recipe_num <= len(recipe_ids) else None
+                if recipe:
                     await show_recipe_detail(update, context, recipe, st)
                 else:
                     await update.message.reply_text("Введите номер от 1 до 5 или выберите категорию.")
@@ -5432,17 +6580,16 @@ async def handle_text_or_photo(update: Update, context: ContextTypes.DEFAULT_TYP
         # --- Добавление рецепта в дневник ---
         elif awaiting == "add_recipe_to_diary":
             if text.lower() == "да":
-                current_recipe = st["tmp"].get("current_recipe")
+                current_recipe = find_recipe(st["tmp"].get("current_recipe_id"))
                 if current_recipe:
-                    st["diaries"]["food"].append({
+                    append_diary(u.id, "food", {
                         "ts": now_ts(),
-                        "text": f"Рецепт: {current_recipe['title']}",
-                        "kcal": current_recipe["kcal"],
-                        "p": current_recipe["protein_g"],
-                        "f": current_recipe["fat_g"],
-                        "c": current_recipe["carbs_g"]
+                        "text": f"Рецепт: {current_recipe.title}",
+                        "kcal": current_recipe.kcal,
+                        "p": current_recipe.protein_g,
+                        "f": current_recipe.fat_g,
+                        "c": current_recipe.carbs_g
                     })
-                    add_kcal_in(st, current_recipe["kcal"])
                     add_points(st, 2)
                     await update.message.reply_text(
                         "Рецепт добавлен в дневник! +2 балла ✅",
@@ -5479,15 +6626,10 @@ async def handle_text_or_photo(update: Update, context: ContextTypes.DEFAULT_TYP
                 return
 
             if text.lower() == "все":
-                foods = st["diaries"].get("food", [])
+                foods = diary_store.clear(u.id, "food")
                 if foods:
                     # Подсчитываем общую калорийность удаляемых записей
                     total_kcal = sum(entry.get("kcal", 0) for entry in foods)
-                    # Очищаем список
-                    st["diaries"]["food"] = []
-                    # Корректируем дневную калорийность
-                    day = ensure_day(st)
-                    day["in"] = max(0, day["in"] - total_kcal)
 
                     await update.message.reply_text(
                         f"Удалены все записи питания ({len(foods)} записей, -{total_kcal} ккал)",
@@ -5500,18 +6642,14 @@ async def handle_text_or_photo(update: Update, context: ContextTypes.DEFAULT_TYP
 
             try:
                 entry_num = int(text)
-                foods = st["diaries"].get("food", [])
-                display_count = min(10, len(foods))
+                foods = diary_store.tail(u.id, "food", 10)
+                display_count = len(foods)
 
                 if 1 <= entry_num <= display_count:
-                    # Правильно вычисляем индекс для удаления из последних 10 записей
-                    actual_index = len(foods) - display_count + entry_num - 1
-                    removed_entry = foods.pop(actual_index)
+                    month, pos, _ = foods[entry_num - 1]
+                    removed_entry = diary_store.remove(u.id, "food", month, pos) or {}
 
-                    # Корректируем дневную калорийность
                     removed_kcal = removed_entry.get("kcal", 0)
-                    day = ensure_day(st)
-                    day["in"] = max(0, day["in"] - removed_kcal)
 
                     entry_text = removed_entry.get('text', 'Без названия')
                     if len(entry_text) > 50:
@@ -5536,15 +6674,10 @@ async def handle_text_or_photo(update: Update, context: ContextTypes.DEFAULT_TYP
                 return
 
             if text.lower() == "все":
-                trains = st["diaries"].get("train", [])
+                trains = diary_store.clear(u.id, "train")
                 if trains:
                     # Подсчитываем общую калорийность удаляемых записей
                     total_kcal = sum(entry.get("kcal", 0) for entry in trains)
-                    # Очищаем список
-                    st["diaries"]["train"] = []
-                    # Корректируем дневную калорийность
-                    day = ensure_day(st)
-                    day["out"] = max(0, day["out"] - total_kcal)
 
                     await update.message.reply_text(
                         f"Удалены все записи тренировок ({len(trains)} записей, -{total_kcal} ккал)",
@@ -5557,18 +6690,14 @@ async def handle_text_or_photo(update: Update, context: ContextTypes.DEFAULT_TYP
 
             try:
                 entry_num = int(text)
-                trains = st["diaries"].get("train", [])
-                display_count = min(10, len(trains))
+                trains = diary_store.tail(u.id, "train", 10)
+                display_count = len(trains)
 
                 if 1 <= entry_num <= display_count:
-                    # Правильно вычисляем индекс для удаления из последних 10 записей
-                    actual_index = len(trains) - display_count + entry_num - 1
-                    removed_entry = trains.pop(actual_index)
+                    month, pos, _ = trains[entry_num - 1]
+                    removed_entry = diary_store.remove(u.id, "train", month, pos) or {}
 
-                    # Корректируем дневную калорийность
                     removed_kcal = removed_entry.get("kcal", 0)
-                    day = ensure_day(st)
-                    day["out"] = max(0, day["out"] - removed_kcal)
 
                     entry_text = removed_entry.get('text', 'Тренировка')
                     if len(entry_text) > 50:
@@ -5639,8 +6768,7 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                         break
 
                 if kcal > 0:
-                    add_kcal_in(st, kcal)
-                    st["diaries"]["food"].append({
+                    append_diary(u.id, "food", {
                         "ts": now_ts(),
                         "text": f"Меню на день: {last_menu}",
                         "kcal": kcal,
@@ -5667,7 +6795,7 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     weekly_kcal = int(kcal_match.group(1)) if kcal_match else 1500
                 daily_kcal = weekly_kcal // 7  # Примерно делим на дни недели
 
-                st["diaries"]["train"].append({
+                append_diary(u.id, "train", {
                     "ts": now_ts(),
                     "text": f"Новый тренировочный план (неделя)",
                     "type": "план тренировок",
@@ -5823,7 +6951,7 @@ async def chat_llm(messages: List[Dict[str, str]], model: str = None, temperatur
         logger.error(f"LLM API error ({LLM_PROVIDER}): {e}")
         return f"Ошибка ИИ ({LLM_PROVIDER}): Не удалось получить ответ. Проверьте API ключ."
 
-def normalize_result(search_result: Dict[str, Any]) -> Dict[str, Any]:
+def normalize_result(search_result: NutritionResult) -> NutritionResult:
     """Нормализует результат поиска: исправляет kJ->kcal, парсит '733 ккал/100г' и т.д."""
     result = search_result.copy()
     
@@ -5852,8 +6980,8 @@ def normalize_result(search_result: Dict[str, Any]) -> Dict[str, Any]:
     return result
 
 # если JSON-LD дал числа «на порцию», пересчитаем в «на 100 г»
-def _fix_portion_leak(res: dict) -> dict:
-    r = dict(res)
+def _fix_portion_leak(res: NutritionResult) -> NutritionResult:
+    r = res.copy()
     s = r.get("serving_g") or r.get("portion_g")
     if not s or s <= 0: 
         return r
@@ -6071,8 +7199,12 @@ async def analyze_meal_photo(bot, file_id: str, profile: Dict[str, Any]) -> Opti
 async def ai_meal_json(profile: Dict[str, Any], user_text: str) -> Optional[Dict[str, Any]]:
     """
     Главная функция поиска продуктов с использованием множественных источников
-    Возвращает унифицированный результат с КБЖУ на 100г и на порцию пользователя
+    Возвращает унифицированный результат с КБЖУ на 100г и на порцию пользователя.
+    Если весь поиск по этому запросу недавно ничего не дал — сразу None (негативный кэш).
     """
+    return await _lookup("pipeline", user_text, lambda: _ai_meal_json_search(profile, user_text))
+
+async def _ai_meal_json_search(profile: Dict[str, Any], user_text: str) -> Optional[Dict[str, Any]]:
     try:
         logger.info(f"=== AI MEAL SEARCH START ===")
         logger.info(f"Query: '{user_text}'")
@@ -6124,7 +7256,7 @@ async def ai_meal_json(profile: Dict[str, Any], user_text: str) -> Optional[Dict
             logger.info("=== BRANDED SEARCH ===")
             for query in route_info["queries"]:
                 logger.info(f"Trying branded query: '{query}'")
-                result = await search_branded_product_via_google(query)
+                result = await _lookup("brand", query, lambda: search_branded_product_via_google(query))
                 if result:
                     logger.info(f"Found branded result: {result.get('name', 'Unknown')}")
                     break
@@ -6132,7 +7264,8 @@ async def ai_meal_json(profile: Dict[str, Any], user_text: str) -> Optional[Dict
             # Fallback: попробуем обычный Google поиск для брендовых продуктов
             if not result:
                 logger.info("No branded result found, trying Google search fallback")
-                result = await search_google_for_product(user_text, g=user_grams, ml=user_ml)
+                result = await _lookup("google", user_text,
+                                       lambda: search_google_for_product(user_text, g=user_grams, ml=user_ml))
                 if result:
                     logger.info(f"Found via Google search fallback: {result.get('name', 'Unknown')}")
                     result['source'] = 'smart_search'
@@ -6142,7 +7275,7 @@ async def ai_meal_json(profile: Dict[str, Any], user_text: str) -> Optional[Dict
             logger.info("=== USDA SEARCH ===")
             for query in route_info["queries"]:
                 logger.info(f"Trying USDA query: '{query}'")
-                result = await search_usda_fdc_product(query, route_info.get("base_en"))
+                result = await _lookup("usda", query, lambda: search_usda_fdc_product(query, route_info.get("base_en")))
                 if result:
                     logger.info(f"Found USDA result: {result.get('name', 'Unknown')}")
                     break
@@ -6160,7 +7293,7 @@ async def ai_meal_json(profile: Dict[str, Any], user_text: str) -> Optional[Dict
                     if barcode_match:
                         barcode = barcode_match.group()
                         logger.info(f"Searching FatSecret by barcode: {barcode}")
-                        fid = await _fs_find_by_barcode(barcode)
+                        fid = await _lookup("fatsecret_barcode", barcode, lambda: _fs_find_by_barcode(barcode))
                         if fid:
                             food = await _fs_get_food(fid)
                             if food:
@@ -6183,7 +7316,7 @@ async def ai_meal_json(profile: Dict[str, Any], user_text: str) -> Optional[Dict
                     # Поиск по названию если штрих-код не сработал
                     if not result and clean_query:
                         logger.info(f"Searching FatSecret by name: {clean_query}")
-                        food = await _fs_search_best(clean_query)
+                        food = await _lookup("fatsecret", clean_query, lambda: _fs_search_best(clean_query))
                         if food:
                             candidate = _fs_norm(food, user_grams, None)
                             if candidate and candidate.get('kcal_100g'):
@@ -6252,7 +7385,8 @@ async def ai_meal_json(profile: Dict[str, Any], user_text: str) -> Optional[Dict
                     if barcode_match:
                         barcode = barcode_match.group()
                         logger.info(f"Detected barcode: {barcode}")
-                        result = await off_by_barcode(barcode, grams=user_grams_off)
+                        result = await _lookup("off_barcode", barcode,
+                                               lambda: off_by_barcode(barcode, grams=user_grams_off))
                         if result:
                             logger.info(f"Found by barcode in Open Food Facts: {result.get('name', 'Unknown')}")
                     
@@ -6260,14 +7394,15 @@ async def ai_meal_json(profile: Dict[str, Any], user_text: str) -> Optional[Dict
                     if not result:
                         clean_query_off = re.sub(r'\d+\s*(?:г|гр|g|grams?|мл|ml)', '', user_text, flags=re.IGNORECASE).strip()
                         if clean_query_off:
-                            result = await off_search_by_name(clean_query_off, grams=user_grams_off)
+                            result = await _lookup("off", clean_query_off,
+                                                   lambda: off_search_by_name(clean_query_off, grams=user_grams_off))
                             if result:
                                 logger.info(f"Found by name in Open Food Facts: {result.get('name', 'Unknown')}")
                     
                     # Если не нашли через новый модуль, пробуем старый метод
                     if not result:
                         logger.info("Trying legacy Open Food Facts...")
-                        result = await search_openfoodfacts_product(user_text)
+                        result = await _lookup("off_legacy", user_text, lambda: search_openfoodfacts_product(user_text))
                         if result:
                             logger.info(f"Found in legacy Open Food Facts: {result.get('name', 'Unknown')}")
                         else:
@@ -6277,7 +7412,7 @@ async def ai_meal_json(profile: Dict[str, Any], user_text: str) -> Optional[Dict
             elif not result:
                 logger.info("Trying legacy Open Food Facts...")
                 try:
-                    result = await search_openfoodfacts_product(user_text)
+                    result = await _lookup("off_legacy", user_text, lambda: search_openfoodfacts_product(user_text))
                     if result:
                         logger.info(f"Found in legacy Open Food Facts: {result.get('name', 'Unknown')}")
                     else:
@@ -6289,7 +7424,8 @@ async def ai_meal_json(profile: Dict[str, Any], user_text: str) -> Optional[Dict
             if not result:
                 logger.info("Trying Google search fallback...")
                 try:
-                    result = await search_google_for_product(user_text, g=user_grams, ml=user_ml)
+                    result = await _lookup("google", user_text,
+                                           lambda: search_google_for_product(user_text, g=user_grams, ml=user_ml))
                     if result:
                         logger.info(f"Found via Google search: {result.get('name', 'Unknown')}")
                     else:
@@ -6302,18 +7438,18 @@ async def ai_meal_json(profile: Dict[str, Any], user_text: str) -> Optional[Dict
             return None
         
         # Нормализация энергий (фиксируем kJ и «733 ккал/100 г»)
-        result = normalize_result(result)
+        result = normalize_result(NutritionResult.coerce(result))
         name_display = build_display_name(result, user_text, fallback=clean_query)
-        result['name'] = name_display
+        result.name = name_display
 
         needs_grams = False
         if route_info["path"] == "brand" and not user_grams:
             portion_candidates = [
-                result.get("portion_g"),
+                result.portion_g,
                 result.get("portion_grams"),
                 result.get("serving_g"),
-                result.get("portion_ml"),
-                result.get("kcal_portion"),
+                result.portion_ml,
+                result.portion[0],
             ]
             needs_grams = not any(pc for pc in portion_candidates if pc)
 
@@ -6330,92 +7466,64 @@ async def ai_meal_json(profile: Dict[str, Any], user_text: str) -> Optional[Dict
             '🧩 FatSecret':      '🧩 FatSecret',
             'fallback':          '📦 Fallback'
         }
-        
+
+        source_key = result.source or ''
+        source_url = result.url or ''
+        source_display = source_map.get(source_key, '📊 База данных')
+        # Fallback для определения источника по URL если source не задан
+        if not source_key:
+            if 'usda' in source_url or 'fdc.nal.usda.gov' in source_url:
+                source_display = '🌿 USDA FDC'
+            elif 'openfoodfacts' in source_url:
+                source_display = '📦 Open Food Facts'
+            elif source_url == 'external_database':
+                source_display = '📊 База данных'
+            else:
+                source_display = '🔍 Умный поиск'
+
+        kcal_100g, protein_100g, fat_100g, carbs_100g = (v or 0 for v in result.per_100g)
+        source_data = {
+            'grams': 100,
+            'kcal_100g': kcal_100g,
+            'protein_100g': protein_100g,
+            'fat_100g': fat_100g,
+            'carbs_100g': carbs_100g,
+        }
+
         # Рассчитываем КБЖУ на пользовательскую порцию
         if user_grams and user_grams != 100:
             logger.info(f"Calculating nutrition for {user_grams}g portion")
             factor = user_grams / 100.0
-            
-            # Определяем источник для формирования notes
-            source_key = result.get('source', '')
-            source_url = result.get('url', '')
-            
-            # Используем обновленный маппинг источников
-            source_display = source_map.get(source_key, '📊 База данных')
-            
-            # Fallback для определения источника по URL если source не задан
-            if not source_key:
-                if 'usda' in source_url or 'fdc.nal.usda.gov' in source_url:
-                    source_display = '🌿 USDA FDC'
-                elif 'openfoodfacts' in source_url:
-                    source_display = '📦 Open Food Facts'
-                elif source_url == 'external_database':
-                    source_display = '📊 База данных'
-                else:
-                    source_display = '🔍 Умный поиск'
-            
-            notes = f"{source_display}: {name_display} ({user_grams}г)"
-
+            source_data['grams'] = user_grams
             return {
-                'kcal': int(result.get('kcal_100g', 0) * factor),
-                'protein_g': round(result.get('protein_100g', 0) * factor, 1),
-                'fat_g': round(result.get('fat_100g', 0) * factor, 1),
-                'carbs_g': round(result.get('carbs_100g', 0) * factor, 1),
-                'notes': notes,
-                'source_data': {
-                    'grams': user_grams,
-                    'kcal_100g': result.get('kcal_100g', 0),
-                    'protein_100g': result.get('protein_100g', 0),
-                    'fat_100g': result.get('fat_100g', 0),
-                    'carbs_100g': result.get('carbs_100g', 0)
-                },
+                'kcal': int(kcal_100g * factor),
+                'protein_g': round(protein_100g * factor, 1),
+                'fat_g': round(fat_100g * factor, 1),
+                'carbs_g': round(carbs_100g * factor, 1),
+                'notes': f"{source_display}: {name_display} ({user_grams}г)",
+                'source_data': source_data,
                 'needs_grams': False,
             }
-        else:
-            # Возвращаем данные на 100г
-            source_key = result.get('source', '')
-            source_url = result.get('url', '')
-            
-            # Используем обновленный маппинг источников
-            source_display = source_map.get(source_key, '📊 База данных')
-            
-            # Fallback для определения источника по URL если source не задан
-            if not source_key:
-                if 'usda' in source_url or 'fdc.nal.usda.gov' in source_url:
-                    source_display = '🌿 USDA FDC'
-                elif 'openfoodfacts' in source_url:
-                    source_display = '📦 Open Food Facts'
-                elif source_url == 'external_database':
-                    source_display = '📊 База данных'
-                else:
-                    source_display = '🔍 Умный поиск'
-            
-            notes = f"{source_display}: {name_display} (100г)"
-            
-            return {
-                'kcal': int(result.get('kcal_100g', 0)),
-                'protein_g': round(result.get('protein_100g', 0), 1),
-                'fat_g': round(result.get('fat_100g', 0), 1),
-                'carbs_g': round(result.get('carbs_100g', 0), 1),
-                'notes': notes,
-                'source_data': {
-                    'grams': 100,
-                    'kcal_100g': result.get('kcal_100g', 0),
-                    'protein_100g': result.get('protein_100g', 0),
-                    'fat_100g': result.get('fat_100g', 0),
-                    'carbs_100g': result.get('carbs_100g', 0)
-                },
-                'needs_grams': needs_grams,
-            }
-        
+
+        # Возвращаем данные на 100г
+        return {
+            'kcal': int(kcal_100g),
+            'protein_g': round(protein_100g, 1),
+            'fat_g': round(fat_100g, 1),
+            'carbs_g': round(carbs_100g, 1),
+            'notes': f"{source_display}: {name_display} (100г)",
+            'source_data': source_data,
+            'needs_grams': needs_grams,
+        }
+
     except Exception as e:
+        _note_lookup_failure(f"ai_meal_json: {e}")
         logger.error(f"ai_meal_json error: {e}")
         return None
 
-def get_last_hrrest(st: Dict[str, Any], default: int = 60) -> int:
+def get_last_hrrest(uid: int, default: int = 60) -> int:
     """Получает последний записанный пульс покоя из метрик"""
-    metrics = st.get("diaries", {}).get("metrics", [])
-    for m in reversed(metrics):
+    for m in diary_store.iter_recent(uid, "metrics"):
         if isinstance(m, dict) and m.get("type") == "zones":
             data = m.get("data", {})
             hrrest = data.get("hrrest")
@@ -7013,53 +8121,153 @@ def start_keepalive_server():
     # Используем уже импортированный keep_alive модуль
     try:
         import keep_alive
+        keep_alive.register_metrics("loop", loop_watch.metrics)
+        keep_alive.register_metrics("nutri_cache", nutri_cache.stats)
+        keep_alive.register_metrics("negative_cache", negative_cache.stats)
+        keep_alive.register_metrics("singleflight", lookup_flights.stats)
+        keep_alive.register_metrics("state", lambda: dict(state_metrics, cache_hits=state_cache.hits,
+                                                          cache_misses=state_cache.misses))
         keep_alive.start()
         logger.info("Keep‑alive server started")
     except Exception as e:
         logger.warning(f"Keep‑alive server не запущен: {e}")
 
 # ========= ЗАПУСК =========
-def main():
-    if not BOT_TOKEN:
-        raise SystemExit("Ошибка: не задан TELEGRAM_BOT_TOKEN")
-    if not TELEGRAM_PAYMENT_PROVIDER_TOKEN:
-        print("Внимание: не задан TELEGRAM_PAYMENT_PROVIDER_TOKEN. Платёжные функции будут недоступны.")
-
-    # запустим keep‑alive сервер в фоне (отдельный поток)
-    try:
-        import threading
-        threading.Thread(target=start_keepalive_server, daemon=True).start()
-    except Exception as e:
-        logger.warning(f"Не удалось запустить keep-alive: {e}")
-
-    app = Application.builder().token(BOT_TOKEN).concurrent_updates(True).build()
+async def _post_init(app: Application):
+    loop_watch.start()
+    state_writer.start()
+    await asyncio.to_thread(ensure_leaderboard)
+    if _shard_ring is not None:
+        app.bot_data["ranks_task"] = asyncio.get_running_loop().create_task(refresh_shared_ranks())
+    retention.start()
+    if SNAPSHOT_INTERVAL_H > 0:
+        app.bot_data["snapshot_task"] = asyncio.get_running_loop().create_task(_snapshot_loop())
+
+async def _post_shutdown(app: Application):
+    for name in ("snapshot_task", "ranks_task"):
+        task = app.bot_data.pop(name, None)
+        if task:
+            task.cancel()
+    await retention.stop()
+    await state_writer.stop()
+    loop_watch.stop()
+
+def build_application(polling: bool = True) -> Application:
+    builder = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .concurrent_updates(True)
+        .post_init(_post_init)
+        .post_shutdown(_post_shutdown)
+    )
+    if not polling:
+        builder = builder.updater(None)  # воркер шарда получает апдейты от фронта
+    app = builder.build()
 
-    app.add_handler(CommandHandler("start", start))
+    app.add_handler(CommandHandler("start", per_user(start)))
     app.add_handler(CommandHandler("help", help_cmd))
     app.add_handler(CommandHandler("whoami", whoami_cmd))
     app.add_handler(CommandHandler("health", health_cmd))
+    app.add_handler(CommandHandler("memory", memory_cmd))
     app.add_handler(CommandHandler("version", version_cmd))
-    app.add_handler(CommandHandler("shop", shop_command))
+    app.add_handler(CommandHandler("shop", per_user(shop_command)))
     app.add_handler(CommandHandler("add_admin", add_admin_cmd))
     app.add_handler(CommandHandler("remove_admin", remove_admin_cmd))
     app.add_handler(CommandHandler("list_admins", list_admins_cmd))
+    app.add_handler(CommandHandler("snapshot", snapshot_cmd))
+    app.add_handler(CommandHandler("export", per_user(export_cmd)))
 
 
     app.add_handler(
         CallbackQueryHandler(
-            recipes_callbacks, pattern=r"^(rroot|rcat:|rpage:|rshow:|radd:|rback|shop_open)"
+            per_user(recipes_callbacks), pattern=r"^(rroot|rcat:|rpage:|rshow:|radd:|rback|shop_open)"
         )
     )
-    app.add_handler(CallbackQueryHandler(on_callback, pattern=r"^(save_menu|save_workout|buy):"))
+    app.add_handler(CallbackQueryHandler(per_user(on_callback), pattern=r"^(save_menu|save_workout|buy):"))
 
     # платежи
     app.add_handler(PreCheckoutQueryHandler(precheckout_callback))
-    app.add_handler(MessageHandler(filters.SUCCESSFUL_PAYMENT, successful_payment_callback))
+    app.add_handler(MessageHandler(filters.SUCCESSFUL_PAYMENT, per_user(successful_payment_callback)))
 
     # основной обработчик
-    app.add_handler(MessageHandler(filters.TEXT | filters.PHOTO, handle_text_or_photo))
+    app.add_handler(MessageHandler(filters.TEXT | filters.PHOTO, per_user(handle_text_or_photo)))
     app.add_error_handler(error_handler)
+    return app
+
+# ========= ШАРДЫ =========
+def _shard_worker_main(index: int, updates):
+    asyncio.run(_shard_worker(index, updates))
+
+async def _shard_worker(index: int, updates):
+    """Воркер шарда: те же обработчики, апдейты приходят из очереди фронта (Update.to_dict())."""
+    app = build_application(polling=False)
+    async with app:
+        await _post_init(app)
+        await app.start()
+        logger.info(f"Shard {index}/{SHARD_COUNT} started")
+        while True:
+            data = await asyncio.to_thread(updates.get)
+            if data is None:
+                break
+            await app.update_queue.put(Update.de_json(data, app.bot))
+        await app.stop()
+        await _post_shutdown(app)
+
+def run_sharded(count: int):
+    """Фронт: принимает апдейты и раздаёт их воркерам по кольцу sharding.HashRing от id пользователя."""
+    ctx = multiprocessing.get_context("spawn")
+    ring = sharding.HashRing(range(count))
+    queues = [ctx.Queue() for _ in range(count)]
+    workers: List[Any] = [None] * count
+
+    def spawn(i: int):
+        # воркер при импорте main.py открывает свои файлы по HLITE_SHARD_INDEX
+        os.environ["HLITE_SHARD_INDEX"] = str(i)
+        try:
+            workers[i] = ctx.Process(target=_shard_worker_main, args=(i, queues[i]), name=f"healco-shard-{i}")
+            workers[i].start()
+        finally:
+            os.environ.pop("HLITE_SHARD_INDEX", None)
+
+    async def forward(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        u = update.effective_user
+        i = ring.node_for(u.id) if u else 0
+        if not workers[i].is_alive():
+            logger.error(f"Shard {i} is down (exit code {workers[i].exitcode}), restarting")
+            spawn(i)
+        queues[i].put(update.to_dict())
+
+    for i in range(count):
+        spawn(i)
+    app = Application.builder().token(BOT_TOKEN).concurrent_updates(True).build()
+    app.add_handler(TypeHandler(Update, forward))
+    print(f"{PROJECT_NAME} запущен: {count} шардов. {VERSION}")
+    try:
+        app.run_polling(drop_pending_updates=True, allowed_updates=Update.ALL_TYPES)
+    finally:
+        for q in queues:
+            q.put(None)
+        for p in workers:
+            p.join(timeout=30)
+
+def main():
+    if not BOT_TOKEN:
+        raise SystemExit("Ошибка: не задан TELEGRAM_BOT_TOKEN")
+    if not TELEGRAM_PAYMENT_PROVIDER_TOKEN:
+        print("Внимание: не задан TELEGRAM_PAYMENT_PROVIDER_TOKEN. Платёжные функции будут недоступны.")
+
+    # запустим keep‑alive сервер в фоне (отдельный поток)
+    try:
+        import threading
+        threading.Thread(target=start_keepalive_server, daemon=True).start()
+    except Exception as e:
+        logger.warning(f"Не удалось запустить keep-alive: {e}")
+
+    if SHARD_COUNT > 1:
+        run_sharded(SHARD_COUNT)
+        return
 
+    app = build_application()
     print(f"{PROJECT_NAME} запущен. {VERSION}")
     app.run_polling(drop_pending_updates=True)
 
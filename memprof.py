@@ -0,0 +1,130 @@
+"""Диагностика памяти: снапшоты tracemalloc с разницей между ними и оценка размеров структур.
+
+tracemalloc включается только по команде (/memory start) — пока он выключен, накладных
+расходов нет. Размеры структур считаются обходом объектов (deep_sizeof); для больших
+словарей — по выборке значений (approx_sizeof), чтобы отчёт не останавливал бота.
+"""
+
+import gc
+import itertools
+import os
+import sys
+import time
+import tracemalloc
+from collections import deque
+from typing import Any, Iterable, List, Optional, Tuple
+
+# собственные аллокации tracemalloc и импорта в отчёте только мешают
+_FILTERS = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+    tracemalloc.Filter(False, "<unknown>"),
+)
+
+
+def fmt_bytes(n: float) -> str:
+    for unit in ("B", "KB", "MB"):
+        if abs(n) < 1024:
+            return f"{n:.0f} {unit}" if unit == "B" else f"{n:.1f} {unit}"
+        n /= 1024
+    return f"{n:.1f} GB"
+
+
+def rss_bytes() -> Optional[int]:
+    """Текущий RSS процесса (Linux /proc); None, если узнать нельзя."""
+    try:
+        with open(f"/proc/{os.getpid()}/status", "r", encoding="ascii") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def deep_sizeof(obj: Any, limit: int = 1_000_000) -> int:
+    """
+    Суммарный sys.getsizeof объекта и содержимого контейнеров (dict/list/tuple/set/deque)
+    без повторов, не больше limit объектов. Атрибуты прочих объектов не обходятся —
+    иначе через блокировку или задачу отчёт уйдёт в цикл событий и дальше по всему процессу.
+    """
+    seen = set()
+    stack = [obj]
+    total = 0
+    while stack and len(seen) < limit:
+        o = stack.pop()
+        if id(o) in seen:
+            continue
+        seen.add(id(o))
+        total += sys.getsizeof(o, 0)
+        if isinstance(o, dict):
+            stack.extend(o.keys())
+            stack.extend(o.values())
+        elif isinstance(o, (list, tuple, set, frozenset, deque)):
+            stack.extend(o)
+    return total
+
+
+def approx_sizeof(values: Iterable[Any], count: int, sample: int = 200) -> int:
+    """Оценка объёма count значений по первым sample из них."""
+    if not count:
+        return 0
+    picked = list(itertools.islice(values, sample))
+    if not picked:
+        return 0
+    return int(sum(deep_sizeof(v) for v in picked) / len(picked) * count)
+
+
+class MemoryProfiler:
+    """Снапшоты tracemalloc по запросу: топ мест аллокации и прирост с прошлого снапшота."""
+
+    def __init__(self):
+        self._last: Optional[tracemalloc.Snapshot] = None
+        self._last_at = 0.0
+        self.started_by_us = False
+
+    @property
+    def tracing(self) -> bool:
+        return tracemalloc.is_tracing()
+
+    def start(self, frames: int = 1) -> bool:
+        if tracemalloc.is_tracing():
+            return False
+        tracemalloc.start(max(1, frames))
+        self.started_by_us = True
+        self._last = None
+        return True
+
+    def stop(self):
+        tracemalloc.stop()
+        self.started_by_us = False
+        self._last = None
+
+    def snapshot(self, top: int = 10) -> Tuple[List[str], List[str]]:
+        """(топ мест по объёму, топ прироста с прошлого снапшота); трассировка должна быть включена."""
+        if not tracemalloc.is_tracing():
+            raise RuntimeError("tracemalloc is not running")
+        gc.collect()
+        snap = tracemalloc.take_snapshot().filter_traces(_FILTERS)
+        current = [self._line(s.traceback, s.size, s.count) for s in snap.statistics("lineno")[:top]]
+        growth: List[str] = []
+        if self._last is not None:
+            diff = [d for d in snap.compare_to(self._last, "lineno") if d.size_diff > 0][:top]
+            mins = (time.monotonic() - self._last_at) / 60
+            growth = [f"за {mins:.0f} мин:"] + [
+                self._line(d.traceback, d.size_diff, d.count_diff, sign="+") for d in diff
+            ]
+        self._last, self._last_at = snap, time.monotonic()
+        return current, growth
+
+    @staticmethod
+    def _line(tb: tracemalloc.Traceback, size: int, count: int, sign: str = "") -> str:
+        frame = tb[0]
+        path = os.path.relpath(frame.filename) if not frame.filename.startswith("<") else frame.filename
+        if path.startswith(".."):
+            path = "/".join(frame.filename.split(os.sep)[-2:])
+        return f"{sign}{fmt_bytes(size)} ({sign}{count}) {path}:{frame.lineno}"
+
+    def traced(self) -> Tuple[int, int]:
+        return tracemalloc.get_traced_memory() if tracemalloc.is_tracing() else (0, 0)
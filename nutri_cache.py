@@ -0,0 +1,330 @@
+"""Кэш найденных продуктов (nutri_cache) как сервис на отдельном потоке.
+
+Все обращения к SQLite идут через очередь в один поток-владелец соединения, event loop
+только ждёт future. База в WAL с synchronous=NORMAL: коммит не делает fsync.
+Попадание не пишет в базу: отметка last_used копится в памяти и сбрасывается пачкой
+раз в flush_interval секунд (или при max_touches отметках). Объём кэша ведётся
+счётчиком — SUM(size_bytes) считается один раз при открытии; вытеснение берёт самые
+старые строки по индексу last_used.
+
+Перед SQLite — LRU разобранных результатов в памяти процесса (ограничен объёмом):
+чтение сначала смотрит туда (без похода в поток и без разбора записи), запись и
+попадание в SQLite кладут значение и в LRU. Общий для всех семейств ключей
+(brand:, fs:bar:, fs:q:). Наружу всегда отдаётся копия: вызывающие правят результат.
+"""
+
+import asyncio
+import concurrent.futures
+import copy
+import logging
+import os
+import queue
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional, Tuple
+
+import record_codec
+from memprof import deep_sizeof
+from nutrition import NutritionResult, from_cache, to_cache
+
+logger = logging.getLogger("healco-lite")
+
+EVICT_BATCH = 50
+
+
+def clone_value(obj):
+    """Независимая копия значения кэша: NutritionResult.copy(), остальное — deepcopy."""
+    return obj.copy() if isinstance(obj, NutritionResult) else copy.deepcopy(obj)
+
+
+def _footprint(obj) -> int:
+    if isinstance(obj, NutritionResult):
+        return sys.getsizeof(obj) + deep_sizeof(obj.pack())
+    return deep_sizeof(obj)
+
+
+class MemoryTier:
+    """LRU разобранных значений по ключу кэша, вытеснение по суммарному объёму."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._items: "OrderedDict[str, Tuple[Any, int]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, k: str):
+        with self._lock:
+            item = self._items.get(k)
+            if item is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(k)
+            self.hits += 1
+            return clone_value(item[0])
+
+    def put(self, k: str, obj):
+        if self.max_bytes <= 0 or obj is None:
+            return
+        obj = clone_value(obj)
+        size = _footprint(obj)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._items.pop(k, None)
+            if old:
+                self.bytes -= old[1]
+            self._items[k] = (obj, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, (_, evicted) = self._items.popitem(last=False)
+                self.bytes -= evicted
+
+    def __len__(self):
+        return len(self._items)
+
+
+class NutritionCache:
+    def __init__(self, path: str, limit_bytes: int = 50 * 1024 * 1024, flush_interval: float = 5.0,
+                 max_touches: int = 1000, memory_bytes: int = 8 * 1024 * 1024):
+        self.path = path
+        self.memory = MemoryTier(memory_bytes)
+        self.limit_bytes = limit_bytes
+        self.flush_interval = flush_interval
+        self.max_touches = max_touches
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._queue: "queue.Queue" = queue.Queue()
+        self._closed = False
+        self._submit_lock = threading.Lock()
+        self._touched: Dict[str, int] = {}  # только поток сервиса
+        self._flushed_at = time.monotonic()
+        self.rows = 0
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self.touch_flushes = 0
+        self._con = self._open()
+        self._thread = threading.Thread(target=self._run, daemon=True, name="nutri-cache")
+        self._thread.start()
+
+    def _open(self) -> sqlite3.Connection:
+        con = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        con.execute("PRAGMA journal_mode=WAL")
+        con.execute("PRAGMA synchronous=NORMAL")
+        con.execute("""CREATE TABLE IF NOT EXISTS nutri_cache(
+  key TEXT PRIMARY KEY,
+  payload TEXT NOT NULL,
+  last_used INTEGER NOT NULL,
+  size_bytes INTEGER NOT NULL
+)""")
+        con.commit()
+        version = con.execute("PRAGMA user_version").fetchone()[0]
+        if version < 1:
+            # JSON-записи кэша → бинарный формат record_codec
+            record_codec.migrate_rows(con, "nutri_cache", "key", "payload")
+            con.execute("UPDATE nutri_cache SET size_bytes=length(payload)")
+        if version < 2:
+            con.execute("CREATE INDEX IF NOT EXISTS nutri_cache_last_used ON nutri_cache(last_used)")
+            con.execute("PRAGMA user_version=2")
+        con.commit()
+        self.rows, self.bytes = con.execute("SELECT COUNT(*), COALESCE(SUM(size_bytes),0) FROM nutri_cache").fetchone()
+        return con
+
+    # --- поток сервиса ---
+
+    def _run(self):
+        while True:
+            try:
+                item = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                self._flush_touches()
+                continue
+            if item is None:
+                break
+            fn, args, fut = item
+            try:
+                result = fn(*args)
+            except Exception as e:
+                if fut is None:
+                    logger.warning(f"nutri_cache {fn.__name__} failed: {e}")
+                else:
+                    fut.set_exception(e)
+            else:
+                if fut is not None:
+                    fut.set_result(result)
+            if len(self._touched) >= self.max_touches or time.monotonic() - self._flushed_at >= self.flush_interval:
+                self._flush_touches()
+        self._flush_touches()
+        self._con.close()
+
+    def _flush_touches(self):
+        self._flushed_at = time.monotonic()
+        if not self._touched:
+            return
+        touched, self._touched = self._touched, {}
+        try:
+            with self._con:
+                self._con.executemany("UPDATE nutri_cache SET last_used=? WHERE key=?",
+                                      [(ts, k) for k, ts in touched.items()])
+            self.touch_flushes += 1
+        except sqlite3.Error as e:
+            logger.warning(f"nutri_cache touch flush failed: {e}")
+
+    def _get(self, k: str):
+        r = self._con.execute("SELECT payload FROM nutri_cache WHERE key=?", (k,)).fetchone()
+        if not r:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._touched[k] = int(time.time())
+        return from_cache(record_codec.decode(r[0]))
+
+    def _touch(self, k: str):
+        self._touched[k] = int(time.time())
+
+    def _put(self, k: str, data: str, ts: int):
+        old = self._con.execute("SELECT size_bytes FROM nutri_cache WHERE key=?", (k,)).fetchone()
+        with self._con:
+            self._con.execute("INSERT OR REPLACE INTO nutri_cache(key,payload,last_used,size_bytes) VALUES (?,?,?,?)",
+                              (k, data, ts, len(data)))
+        self._touched.pop(k, None)
+        if old:
+            self.bytes += len(data) - old[0]
+        else:
+            self.rows += 1
+            self.bytes += len(data)
+        if self.bytes > self.limit_bytes:
+            self._evict()
+
+    def _evict(self):
+        # сначала отметки попаданий — иначе вытесним то, что только что читали
+        self._flush_touches()
+        while self.bytes > self.limit_bytes and self.rows:
+            victims = self._con.execute("SELECT key, size_bytes FROM nutri_cache ORDER BY last_used ASC LIMIT ?",
+                                        (EVICT_BATCH,)).fetchall()
+            if not victims:
+                break
+            with self._con:
+                self._con.executemany("DELETE FROM nutri_cache WHERE key=?", [(k,) for k, _ in victims])
+            self.rows -= len(victims)
+            self.bytes -= sum(size for _, size in victims)
+            self.evicted += len(victims)
+
+    def _submit(self, fn: Callable, *args, wait: bool = True) -> Optional[concurrent.futures.Future]:
+        fut = concurrent.futures.Future() if wait else None
+        # под замком с close(): всё, что успело в очередь до отметки остановки, будет выполнено
+        with self._submit_lock:
+            if self._closed or not self._thread.is_alive():
+                raise RuntimeError("nutri_cache is closed")
+            self._queue.put((fn, args, fut))
+        return fut
+
+    # --- API ---
+
+    async def get(self, k: str):
+        """Разобранное значение (NutritionResult или как было записано) или None."""
+        obj = self.memory.get(k)
+        if obj is not None:
+            # last_used в SQLite тоже освежаем, иначе популярное вытеснится оттуда первым
+            self._submit(self._touch, k, wait=False)
+            return obj
+        obj = await asyncio.wrap_future(self._submit(self._get, k))
+        self.memory.put(k, obj)
+        return obj
+
+    def put(self, k: str, obj):
+        """Кодирует сразу (значение потом можно менять), пишет в фоне; ждать не нужно."""
+        self.memory.put(k, obj)
+        self._submit(self._put, k, record_codec.encode(to_cache(obj)), int(time.time()), wait=False)
+
+    def call(self, fn: Callable[[sqlite3.Connection], Any]) -> Any:
+        """Синхронно выполнить fn(соединение) в потоке сервиса (скрипты, тесты, диагностика)."""
+        return self._submit(fn, self._con).result()
+
+    def flush(self):
+        self._submit(self._flush_touches).result()
+
+    def close(self):
+        with self._submit_lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._queue.put(None)
+        self._thread.join(timeout=30)
+
+    def stats(self) -> Dict[str, Any]:
+        mem = self.memory
+        return {"rows": self.rows, "bytes": self.bytes, "hits": self.hits, "misses": self.misses,
+                "hit_ratio": _ratio(self.hits, self.misses), "evicted": self.evicted,
+                "pending_touches": len(self._touched),
+                "memory": {"items": len(mem), "bytes": mem.bytes, "max_bytes": mem.max_bytes, "hits": mem.hits,
+                           "misses": mem.misses, "hit_ratio": _ratio(mem.hits, mem.misses)},
+                # доля запросов, обслуженных хоть каким-то уровнем
+                "total_hit_ratio": _ratio(mem.hits + self.hits, self.misses)}
+
+
+def _ratio(hits: int, misses: int) -> Optional[float]:
+    return round(hits / (hits + misses), 3) if hits + misses else None
+
+
+class NegativeCache:
+    """
+    Промахи поиска по (провайдер, канонический запрос) с TTL в памяти процесса.
+    «error» — сбой сети/квоты, держится коротко; «miss» — провайдер честно ничего не нашёл.
+    ttls: провайдер → (ttl промаха, ttl ошибки); остальным — default_ttls. TTL <= 0 — не запоминать.
+    """
+
+    def __init__(self, default_ttls: Tuple[float, float] = (6 * 3600, 120),
+                 ttls: Optional[Dict[str, Tuple[float, float]]] = None, max_items: int = 50_000):
+        self.default_ttls = default_ttls
+        self.ttls = dict(ttls or {})
+        self.max_items = max_items
+        self._items: "OrderedDict[Tuple[str, str], Tuple[float, str]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.recorded: Dict[str, int] = {"miss": 0, "error": 0}
+        self.skipped: Dict[str, int] = {}
+
+    def ttl(self, provider: str, kind: str) -> float:
+        miss, error = self.ttls.get(provider, self.default_ttls)
+        return error if kind == "error" else miss
+
+    def record(self, provider: str, key: str, kind: str = "miss"):
+        ttl = self.ttl(provider, kind)
+        if not key or ttl <= 0:
+            return
+        with self._lock:
+            self._items.pop((provider, key), None)
+            self._items[(provider, key)] = (time.monotonic() + ttl, kind)
+            self.recorded[kind] = self.recorded.get(kind, 0) + 1
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+
+    def is_miss(self, provider: str, key: str) -> Optional[str]:
+        """Вид действующей отметки («miss»/«error») или None; попадание считается пропуском."""
+        if not key:
+            return None
+        with self._lock:
+            item = self._items.get((provider, key))
+            if item is None:
+                return None
+            if item[0] <= time.monotonic():
+                del self._items[(provider, key)]
+                return None
+            self.skipped[provider] = self.skipped.get(provider, 0) + 1
+            return item[1]
+
+    def forget(self, provider: str, key: str):
+        with self._lock:
+            self._items.pop((provider, key), None)
+
+    def __len__(self):
+        return len(self._items)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"entries": len(self._items), "recorded": dict(self.recorded), "skipped": dict(self.skipped)}
@@ -0,0 +1,227 @@
+"""Результат поиска продукта: КБЖУ на 100 г, на 100 мл и на порцию пользователя + источник.
+
+Раньше каждый провайдер собирал свой словарь из ~20 ключей (kcal_100g … carbs_portion).
+NutritionResult хранит то же тремя кортежами (ккал, белки, жиры, углеводы) и сохраняет
+словарный доступ — result.get("kcal_100g"), result["source"] = ... — так что старые
+обработчики работают без правок. None в векторе — значения нет: get() вернёт default.
+
+В кэш пишется компактно (pack/unpack, см. to_cache/from_cache), а не словарём ключей.
+Ключ кэша строится из canonical_query — без порции, регистра, ё и пунктуации, так что
+«Bombbar 40г» и «bombbar 60 г» попадают в одну запись (на 100 г/100 мл).
+"""
+
+import re
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+NUTRIENTS = ("kcal", "protein", "fat", "carbs")
+Vector = Tuple[Optional[float], Optional[float], Optional[float], Optional[float]]
+EMPTY_VECTOR: Vector = (None, None, None, None)
+
+# устаревшие ключи словаря → (поле, индекс в векторе)
+_VECTOR_KEYS = {
+    f"{n}_{suffix}": (field, i)
+    for suffix, field in (("100g", "per_100g"), ("100ml", "per_100ml"), ("portion", "portion"))
+    for i, n in enumerate(NUTRIENTS)
+}
+_SCALAR_KEYS = ("name", "brand", "source", "url", "portion_g", "portion_ml")
+_KEYS = _SCALAR_KEYS[:4] + tuple(_VECTOR_KEYS)[:8] + _SCALAR_KEYS[4:] + tuple(_VECTOR_KEYS)[8:]
+
+PACK_VERSION = 1
+CACHE_TAG = "_nr"
+
+
+# количество с единицей массы/объёма: порция пользователя, в ключ кэша не входит
+_QUANTITY_RE = re.compile(r"\d+(?:[.,]\d+)?\s*(?:кг|kg|гр|г|grams?|g|мл|ml|литр(?:а|ов)?|л|l)(?!\w)", re.I)
+_DECIMAL_COMMA_RE = re.compile(r"(?<=\d),(?=\d)")
+_PUNCT_RE = re.compile(r"[^\w.]+|_")
+_STRAY_DOT_RE = re.compile(r"(?<!\d)\.|\.(?!\d)")
+
+
+def canonical_query(text: str, sort_tokens: bool = True) -> str:
+    """Запрос → ключ: без количеств с единицами, casefold, ё→е, без пунктуации, слова по алфавиту."""
+    s = (text or "").casefold().replace("ё", "е")
+    s = _QUANTITY_RE.sub(" ", s)
+    s = _DECIMAL_COMMA_RE.sub(".", s)
+    s = _STRAY_DOT_RE.sub(" ", _PUNCT_RE.sub(" ", s))
+    tokens = s.split()
+    if sort_tokens:
+        tokens.sort()
+    return " ".join(tokens)
+
+
+def quantity_key(text: str) -> str:
+    """Количества с единицами из запроса («40г», «0.5л») — то, что canonical_query отбрасывает."""
+    found = (_DECIMAL_COMMA_RE.sub(".", re.sub(r"\s+", "", m.group()))
+             for m in _QUANTITY_RE.finditer((text or "").casefold()))
+    return " ".join(sorted(found))
+
+
+def scale_vector(vec: Vector, k: float) -> Vector:
+    return tuple(None if v is None else v * k for v in vec)  # type: ignore[return-value]
+
+
+class NutritionResult:
+    __slots__ = ("name", "brand", "source", "url", "per_100g", "per_100ml", "portion",
+                 "portion_g", "portion_ml", "extra")
+
+    def __init__(self, name: Optional[str] = None, brand: Optional[str] = None, source: Optional[str] = None,
+                 url: Optional[str] = None, per_100g: Vector = EMPTY_VECTOR, per_100ml: Vector = EMPTY_VECTOR,
+                 portion: Vector = EMPTY_VECTOR, portion_g: Optional[float] = None, portion_ml: Optional[float] = None,
+                 extra: Optional[Dict[str, Any]] = None):
+        self.name = name
+        self.brand = brand
+        self.source = source
+        self.url = url
+        self.per_100g = per_100g
+        self.per_100ml = per_100ml
+        self.portion = portion
+        self.portion_g = portion_g
+        self.portion_ml = portion_ml
+        self.extra = extra  # прочие ключи провайдера (serving_g, energy-kcal_100g, …); обычно None
+
+    # --- построение ---
+
+    @classmethod
+    def from_serving(cls, serving: Vector, serving_g: Optional[float], serving_ml: Optional[float],
+                     user_g: Optional[float] = None, user_ml: Optional[float] = None, **provenance) -> "NutritionResult":
+        """Значения «на порцию продукта» → на 100 г/100 мл и на порцию пользователя."""
+        per_g = scale_vector(serving, 100.0 / serving_g) if serving_g and serving_g > 0 else EMPTY_VECTOR
+        per_ml = scale_vector(serving, 100.0 / serving_ml) if serving_ml and serving_ml > 0 else EMPTY_VECTOR
+        return cls(per_100g=per_g, per_100ml=per_ml, **provenance).scaled(user_g, user_ml)
+
+    @classmethod
+    def from_dict(cls, d: Dict[str, Any]) -> "NutritionResult":
+        """Словарь старого формата (или ответ провайдера) → NutritionResult; лишние ключи — в extra."""
+        vecs = {"per_100g": [None] * 4, "per_100ml": [None] * 4, "portion": [None] * 4}
+        res = cls()
+        extra = {}
+        for k, v in d.items():
+            slot = _VECTOR_KEYS.get(k)
+            if slot is not None:
+                vecs[slot[0]][slot[1]] = v
+            elif k in _SCALAR_KEYS:
+                setattr(res, k, v)
+            else:
+                extra[k] = v
+        res.per_100g, res.per_100ml, res.portion = (tuple(vecs[f]) for f in ("per_100g", "per_100ml", "portion"))
+        res.extra = extra or None
+        return res
+
+    @classmethod
+    def coerce(cls, obj) -> Optional["NutritionResult"]:
+        if obj is None or isinstance(obj, cls):
+            return obj
+        return cls.from_dict(obj)
+
+    def copy(self) -> "NutritionResult":
+        return NutritionResult(self.name, self.brand, self.source, self.url, self.per_100g, self.per_100ml,
+                               self.portion, self.portion_g, self.portion_ml,
+                               dict(self.extra) if self.extra else None)
+
+    def has_base(self) -> bool:
+        """Есть значения на 100 г или 100 мл — результат можно пересчитать на любую порцию."""
+        return any(v is not None for v in self.per_100g + self.per_100ml)
+
+    def scaled(self, grams: Optional[float] = None, ml: Optional[float] = None) -> "NutritionResult":
+        """Копия с порцией пользователя: граммы по базе на 100 г, иначе миллилитры по базе на 100 мл."""
+        res = self.copy()
+        res.portion_g, res.portion_ml, res.portion = grams, ml, EMPTY_VECTOR
+        if grams and self.per_100g[0] is not None:
+            res.portion = scale_vector(self.per_100g, grams / 100.0)
+        elif ml and self.per_100ml[0] is not None:
+            res.portion = scale_vector(self.per_100ml, ml / 100.0)
+        return res
+
+    # --- словарная совместимость ---
+
+    def __getitem__(self, key: str):
+        slot = _VECTOR_KEYS.get(key)
+        if slot is not None:
+            return getattr(self, slot[0])[slot[1]]
+        if key in _SCALAR_KEYS:
+            return getattr(self, key)
+        if self.extra and key in self.extra:
+            return self.extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key: str, value):
+        slot = _VECTOR_KEYS.get(key)
+        if slot is not None:
+            field, i = slot
+            vec = list(getattr(self, field))
+            vec[i] = value
+            setattr(self, field, tuple(vec))
+        elif key in _SCALAR_KEYS:
+            setattr(self, key, value)
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+
+    def get(self, key: str, default=None):
+        try:
+            value = self[key]
+        except KeyError:
+            return default
+        return default if value is None else value
+
+    def setdefault(self, key: str, default=None):
+        value = self.get(key)
+        if value is None:
+            self[key] = value = default
+        return value
+
+    def __contains__(self, key) -> bool:
+        return self.get(key) is not None
+
+    def keys(self) -> List[str]:
+        return [k for k in _KEYS if self[k] is not None] + list(self.extra or ())
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.keys())
+
+    def items(self):
+        return [(k, self[k]) for k in self.keys()]
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Полный словарь старого формата (все 18 ключей + extra)."""
+        out = {k: self[k] for k in _KEYS}
+        if self.extra:
+            out.update(self.extra)
+        return out
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, NutritionResult):
+            return all(getattr(self, s) == getattr(other, s) for s in self.__slots__)
+        return NotImplemented
+
+    def __repr__(self) -> str:
+        return (f"NutritionResult({self.name!r}, source={self.source!r}, per_100g={self.per_100g}, "
+                f"per_100ml={self.per_100ml}, portion={self.portion})")
+
+    # --- компактная сериализация ---
+
+    def pack(self) -> list:
+        """Плоский список для кэша; пустые векторы — None вместо четырёх None."""
+        return [PACK_VERSION, self.name, self.brand, self.source, self.url,
+                *(None if v == EMPTY_VECTOR else list(v) for v in (self.per_100g, self.per_100ml, self.portion)),
+                self.portion_g, self.portion_ml, self.extra]
+
+    @classmethod
+    def unpack(cls, data: list) -> "NutritionResult":
+        if not data or data[0] != PACK_VERSION:
+            raise ValueError(f"unknown NutritionResult pack: {data[:1]!r}")
+        _, name, brand, source, url, g, ml, port, portion_g, portion_ml, extra = data
+        return cls(name, brand, source, url, *(EMPTY_VECTOR if v is None else tuple(v) for v in (g, ml, port)),
+                   portion_g, portion_ml, extra or None)
+
+
+def to_cache(obj):
+    """Значение для записи в кэш: NutritionResult упаковывается, прочее — как есть."""
+    return {CACHE_TAG: obj.pack()} if isinstance(obj, NutritionResult) else obj
+
+
+def from_cache(obj):
+    if isinstance(obj, dict) and len(obj) == 1 and CACHE_TAG in obj:
+        return NutritionResult.unpack(obj[CACHE_TAG])
+    return obj
@@ -0,0 +1,354 @@
+"""Компактное бинарное кодирование записей (состояние, дневники, кэш питания).
+
+Формат: ``b"HC" + версия схемы`` и значение в виде тега + данных:
+
+* целые — zigzag varint; дробные с 1–2 знаками — varint от x*10 / x*100,
+  остальные — double;
+* строки вида ``YYYY-MM-DD HH:MM:SS`` и ``YYYY-MM-DD`` — секунды/дни от эпохи;
+* ключи словарей — номер в таблице известных полей (``KEY_TABLES``),
+  дата/месяц или, для прочих, сама строка.
+
+Таблица ключей только дополняется; новая таблица — новая версия схемы,
+старые версии остаются читаемыми. ``decode`` понимает и прежний JSON,
+так что переход на формат не требует остановки: записи перекодируются
+при следующей записи или через ``migrate_rows``.
+"""
+
+import calendar
+import functools
+import json
+import struct
+import time
+from typing import Any, Dict, List
+
+MAGIC = b"HC"
+SCHEMA_VERSION = 1
+
+KEY_TABLES: Dict[int, List[str]] = {
+    1: [
+        # записи дневников и итоги дней
+        "ts", "text", "kcal", "p", "f", "c", "type", "avg_hr", "data", "entries", "days",
+        "food", "train", "metrics", "train_kcal", "food_n", "train_n", "metrics_n",
+        "hrrest", "zones", "vo2", "cat", "from", "bmi",
+        # состояние пользователя
+        "profile", "gender", "age", "height_cm", "weight_kg", "activity", "goal",
+        "allergies", "conditions", "injuries", "preferences", "menu_notes", "workout_notes",
+        "workout_plan", "workout_plan_link", "workout_weekly_kcal",
+        "awards", "points", "access_level", "access_expires", "current_role", "awaiting", "tmp", "_v",
+        # результаты поиска питания
+        "kcal_100g", "protein_100g", "fat_100g", "carbs_100g",
+        "kcal_100ml", "protein_100ml", "fat_100ml", "carbs_100ml",
+        "kcal_portion", "protein_portion", "fat_portion", "carbs_portion",
+        "portion_g", "portion_ml", "name", "brand", "source", "url",
+        "protein_g", "fat_g", "carbs_g", "notes", "source_data", "grams", "needs_grams",
+    ],
+}
+
+_T_NONE, _T_FALSE, _T_TRUE, _T_INT, _T_F64, _T_DEC1, _T_DEC2 = range(7)
+_T_STR, _T_LIST, _T_DICT, _T_DATETIME, _T_DATE = range(7, 12)
+
+# младшие 2 бита префикса ключа
+_K_TABLE, _K_STR, _K_DATE, _K_MONTH = range(4)
+
+_F64 = struct.Struct("<d")
+_KEY_INDEX = {v: {k: i for i, k in enumerate(keys)} for v, keys in KEY_TABLES.items()}
+
+
+class CodecError(ValueError):
+    pass
+
+
+def _zigzag(n: int) -> int:
+    return n * 2 if n >= 0 else -n * 2 - 1
+
+
+def _put_varint(out: bytearray, n: int) -> None:
+    while n > 0x7F:
+        out.append((n & 0x7F) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def _parse_datetime(s: str):
+    # быстрый разбор "YYYY-MM-DD HH:MM:SS" без strptime; None — если строка не такая
+    if len(s) != 19 or s[4] != "-" or s[7] != "-" or s[10] != " " or s[13] != ":" or s[16] != ":":
+        return None
+    try:
+        parts = (int(s[0:4]), int(s[5:7]), int(s[8:10]), int(s[11:13]), int(s[14:16]), int(s[17:19]))
+    except ValueError:
+        return None
+    if not (1 <= parts[1] <= 12 and parts[0] >= 1):
+        return None
+    epoch = calendar.timegm(parts + (0, 0, 0))
+    # защита от нормализации (2026-02-31 и т.п.) — только точный обратный формат
+    if time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(epoch)) != s:
+        return None
+    return epoch
+
+
+def _parse_date(s: str):
+    if len(s) != 10 or s[4] != "-" or s[7] != "-":
+        return None
+    try:
+        y, m, d = int(s[0:4]), int(s[5:7]), int(s[8:10])
+    except ValueError:
+        return None
+    if not (1 <= m <= 12 and y >= 1):
+        return None
+    epoch = calendar.timegm((y, m, d, 0, 0, 0, 0, 0, 0))
+    if time.strftime("%Y-%m-%d", time.gmtime(epoch)) != s:
+        return None
+    return epoch // 86400
+
+
+def _parse_month(s: str):
+    if len(s) != 7 or s[4] != "-":
+        return None
+    try:
+        y, m = int(s[0:4]), int(s[5:7])
+    except ValueError:
+        return None
+    if not (1 <= m <= 12 and 1970 <= y) or s != f"{y:04d}-{m:02d}":
+        return None
+    return (y - 1970) * 12 + (m - 1)
+
+
+class _Encoder:
+    def __init__(self, version: int):
+        self.keys = _KEY_INDEX[version]
+        self.out = bytearray(MAGIC)
+        self.out.append(version)
+
+    def key(self, k) -> None:
+        out = self.out
+        if not isinstance(k, str):
+            # как json.dumps: простые ключи приводятся к строке
+            if k is None or isinstance(k, (bool, int, float)):
+                k = json.dumps(k)
+            else:
+                raise CodecError(f"unsupported key type {type(k).__name__}")
+        idx = self.keys.get(k)
+        if idx is not None:
+            _put_varint(out, idx << 2 | _K_TABLE)
+            return
+        day = _parse_date(k)
+        if day is not None and day >= 0:
+            _put_varint(out, day << 2 | _K_DATE)
+            return
+        month = _parse_month(k)
+        if month is not None:
+            _put_varint(out, month << 2 | _K_MONTH)
+            return
+        raw = k.encode("utf-8")
+        _put_varint(out, len(raw) << 2 | _K_STR)
+        out += raw
+
+    def value(self, v: Any) -> None:
+        out = self.out
+        if v is None:
+            out.append(_T_NONE)
+        elif v is True:
+            out.append(_T_TRUE)
+        elif v is False:
+            out.append(_T_FALSE)
+        elif isinstance(v, int):
+            out.append(_T_INT)
+            _put_varint(out, _zigzag(v))
+        elif isinstance(v, float):
+            if v == v and abs(v) < 1e15:
+                d1 = round(v * 10)
+                if d1 / 10 == v:
+                    out.append(_T_DEC1)
+                    _put_varint(out, _zigzag(d1))
+                    return
+                d2 = round(v * 100)
+                if d2 / 100 == v:
+                    out.append(_T_DEC2)
+                    _put_varint(out, _zigzag(d2))
+                    return
+            out.append(_T_F64)
+            out += _F64.pack(v)
+        elif isinstance(v, str):
+            if len(v) == 19:
+                epoch = _parse_datetime(v)
+                if epoch is not None:
+                    out.append(_T_DATETIME)
+                    _put_varint(out, _zigzag(epoch))
+                    return
+            elif len(v) == 10:
+                day = _parse_date(v)
+                if day is not None:
+                    out.append(_T_DATE)
+                    _put_varint(out, _zigzag(day))
+                    return
+            raw = v.encode("utf-8")
+            out.append(_T_STR)
+            _put_varint(out, len(raw))
+            out += raw
+        elif isinstance(v, dict):
+            out.append(_T_DICT)
+            _put_varint(out, len(v))
+            for k, item in v.items():
+                self.key(k)
+                self.value(item)
+        elif isinstance(v, (list, tuple)):
+            out.append(_T_LIST)
+            _put_varint(out, len(v))
+            for item in v:
+                self.value(item)
+        else:
+            raise CodecError(f"unsupported type {type(v).__name__}")
+
+
+@functools.lru_cache(maxsize=8192)
+def _day_str(day: int) -> str:
+    return time.strftime("%Y-%m-%d", time.gmtime(day * 86400))
+
+
+def _make_decoder(keys: List[str]):
+    """
+    Разбор n элементов списка/словаря с позиции pos → (значение, новая позиция).
+    Скаляры разбираются прямо в цикле, рекурсия — только на вложенные контейнеры:
+    вызов функции на каждое значение был основной ценой разбора.
+    """
+
+    def items(data: bytes, pos: int, n: int, is_dict: bool):
+        out: Any = {} if is_dict else []
+        append = None if is_dict else out.append
+        k = None
+        for _ in range(n):
+            if is_dict:
+                p = data[pos]
+                pos += 1
+                if p & 0x80:
+                    p &= 0x7F
+                    shift = 7
+                    while True:
+                        b = data[pos]
+                        pos += 1
+                        p |= (b & 0x7F) << shift
+                        if not b & 0x80:
+                            break
+                        shift += 7
+                kind, p = p & 3, p >> 2
+                if kind == _K_TABLE:
+                    k = keys[p]
+                elif kind == _K_STR:
+                    k = data[pos:pos + p].decode("utf-8")
+                    pos += p
+                elif kind == _K_DATE:
+                    k = _day_str(p)
+                else:
+                    y, m = divmod(p, 12)
+                    k = f"{1970 + y:04d}-{m + 1:02d}"
+            tag = data[pos]
+            pos += 1
+            if tag <= _T_TRUE:
+                v = (None, False, True)[tag]
+            elif tag == _T_F64:
+                v = _F64.unpack_from(data, pos)[0]
+                pos += 8
+            else:
+                x = data[pos]
+                pos += 1
+                if x & 0x80:
+                    x &= 0x7F
+                    shift = 7
+                    while True:
+                        b = data[pos]
+                        pos += 1
+                        x |= (b & 0x7F) << shift
+                        if not b & 0x80:
+                            break
+                        shift += 7
+                if tag == _T_STR:
+                    v = data[pos:pos + x].decode("utf-8")
+                    pos += x
+                elif tag == _T_DICT or tag == _T_LIST:
+                    v, pos = items(data, pos, x, tag == _T_DICT)
+                else:
+                    x = x >> 1 if not x & 1 else -((x + 1) >> 1)
+                    if tag == _T_INT:
+                        v = x
+                    elif tag == _T_DEC1:
+                        v = x / 10
+                    elif tag == _T_DEC2:
+                        v = x / 100
+                    elif tag == _T_DATETIME:
+                        day, sec = divmod(x, 86400)
+                        h, sec = divmod(sec, 3600)
+                        m, sec = divmod(sec, 60)
+                        v = f"{_day_str(day)} {h:02d}:{m:02d}:{sec:02d}"
+                    elif tag == _T_DATE:
+                        v = _day_str(x)
+                    else:
+                        raise CodecError(f"bad tag {tag} at {pos - 1}")
+            if is_dict:
+                out[k] = v
+            else:
+                append(v)
+        return out, pos
+
+    return items
+
+
+_DECODERS = {v: _make_decoder(keys) for v, keys in KEY_TABLES.items()}
+
+
+def encode(value: Any, version: int = SCHEMA_VERSION) -> bytes:
+    enc = _Encoder(version)
+    enc.value(value)
+    return bytes(enc.out)
+
+
+def is_encoded(data) -> bool:
+    return isinstance(data, (bytes, bytearray, memoryview)) and bytes(data[:2]) == MAGIC
+
+
+def decode(data) -> Any:
+    """Разбирает бинарную запись; прежний JSON (str/bytes) тоже принимается."""
+    if isinstance(data, memoryview):
+        data = data.tobytes()
+    if is_encoded(data):
+        if len(data) < 4:
+            raise CodecError("truncated record")
+        items = _DECODERS.get(data[2])
+        if items is None:
+            raise CodecError(f"unknown schema version {data[2]}")
+        data = bytes(data)
+        try:
+            # корень — как список из одного элемента
+            value, pos = items(data, 3, 1, False)
+        except (IndexError, struct.error, UnicodeDecodeError):
+            raise CodecError("truncated record") from None
+        if pos != len(data):
+            raise CodecError("truncated record" if pos > len(data) else "trailing bytes in record")
+        return value[0]
+    if isinstance(data, (bytes, bytearray)):
+        data = data.decode("utf-8")
+    return json.loads(data)
+
+
+def migrate_rows(con, table: str, key_col: str, value_col: str, batch: int = 500) -> int:
+    """Перекодирует JSON-строки таблицы SQLite в бинарный формат. Возвращает число строк."""
+    migrated = 0
+    last_key = ""
+    while True:
+        rows = con.execute(
+            f"SELECT {key_col}, {value_col} FROM {table} WHERE {key_col} > ? ORDER BY {key_col} LIMIT ?",
+            (last_key, batch),
+        ).fetchall()
+        if not rows:
+            return migrated
+        updates = []
+        for k, v in rows:
+            if not is_encoded(v):
+                try:
+                    updates.append((encode(decode(v)), k))
+                except (ValueError, CodecError):
+                    continue
+        if updates:
+            with con:
+                con.executemany(f"UPDATE {table} SET {value_col}=? WHERE {key_col}=?", updates)
+            migrated += len(updates)
+        last_key = rows[-1][0]
@@ -0,0 +1,124 @@
+"""Шардирование по id пользователя: консистентное хэш-кольцо и перенос данных при смене числа шардов.
+
+Режим включается HLITE_SHARDS=K (см. main.run_sharded): фронт-процесс принимает апдейты
+и отдаёт каждого пользователя одному из K воркеров по HashRing. У воркера свои файлы
+состояния и кэша (shard_path), общие ключи (админы, баллы рейтинга) лежат в HLITE_SHARED_PATH —
+его открывают все воркеры, поэтому условная запись там сверяет версию в самой базе (shared=True).
+При смене K данные переносит rebalance, бот при этом остановлен::
+
+    HLITE_STORAGE=sqlite python sharding.py rebalance 2 4
+"""
+
+import bisect
+import hashlib
+import os
+import sys
+from typing import Any, Callable, Dict, Iterable, Optional
+
+SHARED_PREFIXES = ("admin_users", "lb:")
+_USER_KEY_KINDS = ("user", "diary", "lb")
+
+
+def _hash(s: str) -> int:
+    return int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    """Кольцо с виртуальными узлами: при K → K+1 переезжает ~1/(K+1) пользователей, а не почти все."""
+
+    def __init__(self, nodes: Iterable[int], vnodes: int = 128):
+        self.nodes = sorted(set(nodes))
+        if not self.nodes:
+            raise ValueError("ring needs at least one node")
+        points = sorted((_hash(f"{node}#{i}"), node) for node in self.nodes for i in range(vnodes))
+        self._hashes = [h for h, _ in points]
+        self._owners = [n for _, n in points]
+
+    def node_for(self, key) -> int:
+        i = bisect.bisect(self._hashes, _hash(str(key)))
+        return self._owners[i % len(self._owners)]
+
+
+def shard_path(path: str, index: int, count: int) -> str:
+    """Файл шарда: db.json → db.shard1.json. Без шардирования (count=1) путь не меняется."""
+    if count <= 1:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.shard{index}{ext}"
+
+
+def key_owner(key: str) -> Optional[int]:
+    """uid владельца ключа (user:{uid}, diary:{uid}:..., lb:{uid}); None — ключ не пользовательский."""
+    parts = str(key).split(":", 2)
+    if len(parts) >= 2 and parts[0] in _USER_KEY_KINDS and parts[1].lstrip("-").isdigit():
+        return int(parts[1])
+    return None
+
+
+def is_shared_key(key: str) -> bool:
+    return str(key).startswith(SHARED_PREFIXES)
+
+
+def rebalance(base_path: str, old: int, new: int, open_path: Callable[[str], Any],
+              shared_path: Optional[str] = None) -> Dict[str, int]:
+    """
+    Раскладывает данные с old шардов на new. open_path(path) открывает хранилище файла
+    (KVStore). Ключи пользователей уезжают к владельцу по новому кольцу, общие — в
+    shared_path (new > 1) или в обычный файл (new = 1), прочие — на шард 0.
+    Ключ сначала пишется на новое место и только потом удаляется со старого,
+    так что прерванный перенос можно просто запустить ещё раз.
+    """
+    stores: Dict[str, Any] = {}
+
+    def store(path: str):
+        if path not in stores:
+            stores[path] = open_path(path)
+        return stores[path]
+
+    ring = HashRing(range(new))
+    shared_target = shared_path if new > 1 else shard_path(base_path, 0, 1)
+    sources = [shard_path(base_path, i, old) for i in range(old)]
+    if old > 1 and shared_path and os.path.exists(shared_path):
+        sources.append(shared_path)
+    stats = {"moved": 0, "kept": 0}
+    try:
+        for src_path in sources:
+            src = store(src_path)
+            moves: Dict[str, Dict[str, Any]] = {}
+            for k in src.keys():
+                if is_shared_key(k):
+                    target = shared_target
+                else:
+                    uid = key_owner(k)
+                    target = shard_path(base_path, 0 if uid is None else ring.node_for(uid), new)
+                if target == src_path:
+                    stats["kept"] += 1
+                else:
+                    moves.setdefault(target, {})[k] = src.get(k)
+            for target, items in moves.items():
+                dst = store(target)
+                dst.put_many(items)
+                dst.flush()
+                for k in items:
+                    del src[k]
+                stats["moved"] += len(items)
+    finally:
+        for s in stores.values():
+            s.flush()
+            s.close()
+    return stats
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 4 or sys.argv[1] != "rebalance":
+        raise SystemExit("usage: python sharding.py rebalance <old shards> <new shards>")
+    from storage import LocalDB, SQLiteStateDB
+
+    backend = os.getenv("HLITE_STORAGE", "json").lower()
+    base = os.getenv("HLITE_SQLITE_PATH", "./data/state.db") if backend == "sqlite" else os.getenv("HLITE_DB_PATH", "db.json")
+    result = rebalance(
+        base, int(sys.argv[2]), int(sys.argv[3]),
+        lambda p: SQLiteStateDB(p) if p.endswith(".db") else LocalDB(p),
+        os.getenv("HLITE_SHARED_PATH", "./data/shared.db"),
+    )
+    print(f"moved {result['moved']} keys, kept {result['kept']}")
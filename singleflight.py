@@ -0,0 +1,41 @@
+"""Single-flight: одинаковые одновременные вызовы выполняются один раз.
+
+Первый вызов по ключу запускает работу отдельной задачей, остальные (пока она идёт)
+ждут её же результат. Работа защищена от отмены (shield): если первый вызывающий
+отменён, остальные всё равно получают ответ. Каждому вызывающему, включая первого,
+отдаётся clone(результат): сам результат никто не получает, и правки одного не видят другие. Ключ снимается, как только работа закончилась,
+то есть кэшем это не является.
+"""
+
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional
+
+
+class SingleFlight:
+    def __init__(self):
+        self._inflight: Dict[Hashable, "asyncio.Task"] = {}
+        self.leaders: Dict[str, int] = {}
+        self.coalesced: Dict[str, int] = {}
+
+    async def run(self, key: Hashable, call: Callable[[], Awaitable[Any]], group: str = "",
+                  clone: Optional[Callable[[Any], Any]] = None) -> Any:
+        task = self._inflight.get(key)
+        if task is not None and not task.done():
+            self.coalesced[group] = self.coalesced.get(group, 0) + 1
+        else:
+            self.leaders[group] = self.leaders.get(group, 0) + 1
+            task = self._inflight[key] = asyncio.ensure_future(call())
+            task.add_done_callback(lambda t: self._inflight.pop(key, None) if self._inflight.get(key) is t else None)
+        result = await asyncio.shield(task)
+        return clone(result) if clone else result
+
+    def __len__(self):
+        return len(self._inflight)
+
+    def stats(self) -> Dict[str, Any]:
+        groups = sorted(set(self.leaders) | set(self.coalesced))
+        return {
+            "inflight": len(self._inflight),
+            "groups": {g: {"calls": self.leaders.get(g, 0), "coalesced": self.coalesced.get(g, 0)} for g in groups},
+            "coalesced_total": sum(self.coalesced.values()),
+        }
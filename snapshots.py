@@ -0,0 +1,158 @@
+"""Онлайн-снапшоты хранилищ: сжатые копии файлов + манифест с контрольными суммами.
+
+Снапшот — каталог с файлами ``*.gz`` и ``manifest.json``. В манифесте для каждого
+файла — sha256 и размер несжатого содержимого и путь, куда он восстанавливается.
+Каталог собирается под именем ``*.part`` и переименовывается только целиком,
+так что недописанный снапшот не выглядит готовым.
+
+Восстановление (бот остановлен)::
+
+    python snapshots.py verify data/snapshots/20261016-040000
+    python snapshots.py restore data/snapshots/20261016-040000
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import time
+from typing import BinaryIO, Dict, Iterable, List, Optional, Tuple
+
+MANIFEST = "manifest.json"
+CHUNK = 1024 * 1024
+
+
+def gzip_stream(parts: Iterable[Tuple[BinaryIO, Optional[int]]], dst_path: str) -> Dict[str, object]:
+    """Сжимает подряд идущие куски (файл, сколько байт взять; None — до конца) в dst_path."""
+    digest = hashlib.sha256()
+    total = 0
+    with gzip.open(dst_path, "wb", compresslevel=6) as out:
+        for src, limit in parts:
+            left = limit
+            while left is None or left > 0:
+                chunk = src.read(CHUNK if left is None else min(CHUNK, left))
+                if not chunk:
+                    break
+                out.write(chunk)
+                digest.update(chunk)
+                total += len(chunk)
+                if left is not None:
+                    left -= len(chunk)
+    return {"sha256": digest.hexdigest(), "bytes": total}
+
+
+def backup_sqlite(src_path: str, dst_gz: str) -> Dict[str, object]:
+    """Копия живой SQLite-базы через online backup API (одним шагом — согласованная точка)."""
+    tmp = f"{dst_gz}.tmp.db"
+    src = sqlite3.connect(src_path, timeout=30)
+    dst = sqlite3.connect(tmp)
+    try:
+        src.backup(dst)
+    finally:
+        dst.close()
+        src.close()
+    try:
+        with open(tmp, "rb") as f:
+            return gzip_stream([(f, None)], dst_gz)
+    finally:
+        os.remove(tmp)
+
+
+def new_snapshot_dir(root: str) -> str:
+    os.makedirs(root, exist_ok=True)
+    name = time.strftime("%Y%m%d-%H%M%S")
+    path, n = os.path.join(root, name), 1
+    while os.path.exists(path) or os.path.exists(f"{path}.part"):
+        n += 1
+        path = os.path.join(root, f"{name}-{n}")
+    os.makedirs(f"{path}.part")
+    return path
+
+
+def finish_snapshot(path: str, files: Dict[str, Dict[str, object]], meta: Optional[Dict[str, object]] = None) -> str:
+    """Пишет манифест и переименовывает path.part → path."""
+    part = f"{path}.part"
+    manifest = dict(meta or {}, created=time.strftime("%Y-%m-%d %H:%M:%S"), files=files)
+    with open(os.path.join(part, MANIFEST), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=1)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(part, path)
+    return path
+
+
+def read_manifest(path: str) -> Dict[str, object]:
+    with open(os.path.join(path, MANIFEST), "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def verify(path: str) -> List[str]:
+    """Список проблем снапшота; пустой — всё сходится."""
+    try:
+        files = read_manifest(path)["files"]
+    except (OSError, ValueError, KeyError) as e:
+        return [f"manifest: {e}"]
+    problems = []
+    for name, info in files.items():
+        digest, total = hashlib.sha256(), 0
+        try:
+            with gzip.open(os.path.join(path, name), "rb") as f:
+                for chunk in iter(lambda: f.read(CHUNK), b""):
+                    digest.update(chunk)
+                    total += len(chunk)
+        except (OSError, EOFError) as e:
+            problems.append(f"{name}: {e}")
+            continue
+        if digest.hexdigest() != info.get("sha256") or total != info.get("bytes"):
+            problems.append(f"{name}: checksum mismatch")
+    return problems
+
+
+def restore(path: str) -> List[str]:
+    """Проверяет снапшот и раскладывает файлы по местам из манифеста. Возвращает пути."""
+    problems = verify(path)
+    if problems:
+        raise ValueError("snapshot is damaged: " + "; ".join(problems))
+    restored = []
+    for name, info in read_manifest(path)["files"].items():
+        target = info["target"]
+        os.makedirs(os.path.dirname(target) or ".", exist_ok=True)
+        tmp = f"{target}.restore"
+        with gzip.open(os.path.join(path, name), "rb") as src, open(tmp, "wb") as dst:
+            shutil.copyfileobj(src, dst, CHUNK)
+            dst.flush()
+            os.fsync(dst.fileno())
+        # побочные файлы (WAL, журнал отката, сворачиваемый журнал) относятся к старой копии
+        for side in info.get("remove", []):
+            if os.path.exists(side):
+                os.remove(side)
+        os.replace(tmp, target)
+        restored.append(target)
+    return restored
+
+
+def prune(root: str, keep: int) -> List[str]:
+    """Оставляет keep последних готовых снапшотов; недописанные *.part тоже убирает."""
+    if not os.path.isdir(root):
+        return []
+    names = sorted(n for n in os.listdir(root) if os.path.isfile(os.path.join(root, n, MANIFEST)))
+    stale = [n for n in os.listdir(root) if n.endswith(".part")]
+    removed = []
+    for n in names[: max(0, len(names) - keep)] + stale:
+        shutil.rmtree(os.path.join(root, n), ignore_errors=True)
+        removed.append(n)
+    return removed
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3 or sys.argv[1] not in ("verify", "restore"):
+        raise SystemExit("usage: python snapshots.py verify|restore <snapshot dir>")
+    if sys.argv[1] == "verify":
+        issues = verify(sys.argv[2])
+        print("\n".join(issues) or "OK")
+        raise SystemExit(1 if issues else 0)
+    for p in restore(sys.argv[2]):
+        print(f"restored {p}")
@@ -0,0 +1,774 @@
+"""Хранилища состояния ключ → значение и общий интерфейс к ним.
+
+KVStore — синхронный интерфейс (get / put / пакетные get_many, put_many /
+keys_prefix / cas по версии _v / delete), его реализации: MemoryDB, LocalDB
+(JSON-снапшот + журнал), SQLiteStateDB, ReplitDB. Какое хранилище открыть, решает
+open_store (HLITE_STORAGE).
+
+AsyncStorage — тот же набор операций для корутин. Через него бот читает запись
+пользователя на промахе кэша состояний (main.prefetch_state, до входа в обработчик)
+и баллы рейтинга других шардов; его же гоняет бенчмарк (benchmarks/bench_storage.py).
+Остальное — синхронно через db_* в main.py: дневники (DiaryStore) и запись состояний,
+которая у SQLiteStateDB всё равно уходит в поток-писатель.
+"""
+
+import asyncio
+import io
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional
+
+import record_codec
+import snapshots
+
+logger = logging.getLogger("healco-lite")
+
+
+class KVStore:
+    """
+    Общий интерфейс хранилищ. Обязательны get, __setitem__, __delitem__, cas и keys_prefix;
+    пакетные операции по умолчанию — цикл, хранилища переопределяют их, где это дешевле.
+    BLOCKING — операции могут ждать диск или сеть (AsyncStorage уносит их в поток).
+    """
+
+    BLOCKING = False
+
+    def get(self, k, default=None):
+        raise NotImplementedError
+
+    def __setitem__(self, k, v):
+        raise NotImplementedError
+
+    def __delitem__(self, k):
+        raise NotImplementedError
+
+    def cas(self, k, expected: int, v) -> bool:
+        """Пишет v, только если сохранённая версия (_v) равна expected; при успехе v["_v"] = expected + 1."""
+        raise NotImplementedError
+
+    def keys_prefix(self, prefix: str) -> List[str]:
+        raise NotImplementedError
+
+    def __getitem__(self, k):
+        return self.get(k)
+
+    def __contains__(self, k):
+        return self.get(k) is not None
+
+    def keys(self) -> List[str]:
+        return self.keys_prefix("")
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, Any]:
+        """Значения найденных ключей; отсутствующих в ответе нет."""
+        out = {}
+        for k in keys:
+            v = self.get(k)
+            if v is not None:
+                out[k] = v
+        return out
+
+    def put_many(self, items: Dict[str, Any]):
+        for k, v in items.items():
+            self[k] = v
+
+    def flush(self, timeout: Optional[float] = None):
+        pass
+
+    def close(self):
+        pass
+
+
+class MemoryDB(KVStore):
+    """Всё в памяти процесса: тесты, бенчмарки, одноразовые прогоны. После перезапуска пусто."""
+
+    def __init__(self):
+        self.store: Dict[str, Any] = {}
+        self._lock = threading.Lock()
+
+    def get(self, k, default=None):
+        return self.store.get(k, default)
+
+    def __setitem__(self, k, v):
+        self.store[k] = v
+
+    def __delitem__(self, k):
+        self.store.pop(k, None)
+
+    def cas(self, k, expected: int, v) -> bool:
+        with self._lock:
+            cur = self.store.get(k)
+            cur_v = int(cur.get("_v", 0)) if isinstance(cur, dict) else 0
+            if cur_v != expected:
+                return False
+            v["_v"] = expected + 1
+            self.store[k] = v
+            return True
+
+    def keys_prefix(self, prefix: str) -> List[str]:
+        return [k for k in self.store if str(k).startswith(prefix)]
+
+
+LOCAL_DB_COMPACT_MB = float(os.getenv("HLITE_JOURNAL_COMPACT_MB", "8"))
+
+class LocalDB(KVStore):
+    """
+    Локальное JSON-хранилище: снапшот (db.json) + журнал изменений (db.json.journal).
+
+    Запись дописывает в журнал одну строку {"k": ключ, "v": значение} — стоимость
+    пропорциональна размеру одной записи, а не всей базы. Когда журнал превышает
+    порог, фоновый поток сворачивает его в новый снапшот. При старте состояние
+    восстанавливается так: снапшот → недосвёрнутый журнал → текущий журнал.
+    """
+
+    def __init__(self, path="db.json", compact_bytes: Optional[int] = None):
+        self.path = path
+        self.journal_path = f"{path}.journal"
+        self.compacting_path = f"{path}.journal.compacting"
+        self.compact_bytes = compact_bytes if compact_bytes is not None else int(LOCAL_DB_COMPACT_MB * 1024 * 1024)
+        self._lock = threading.RLock()
+        self._compactor: Optional[threading.Thread] = None
+        if not os.path.exists(self.path):
+            self._write_snapshot({})
+        self._load()
+        self._seal_journal(self.journal_path)
+        self._journal = open(self.journal_path, "a", encoding="utf-8")
+        self._journal_size = self._journal.tell()
+
+    def _load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                self.store = json.load(f)
+        except Exception:
+            self.store = {}
+        if not isinstance(self.store, dict):
+            self.store = {}
+        for journal in (self.compacting_path, self.journal_path):
+            self._replay(journal, self.store)
+
+    @staticmethod
+    def _replay(journal_path: str, store: Dict[str, Any]) -> int:
+        """Применяет записи журнала к store. Оборванная последняя строка (сбой при записи) пропускается."""
+        if not os.path.exists(journal_path):
+            return 0
+        applied = 0
+        with open(journal_path, "r", encoding="utf-8") as f:
+            for line_num, line in enumerate(f, 1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    rec = json.loads(line)
+                    if rec.get("d"):
+                        store.pop(rec["k"], None)
+                    else:
+                        store[rec["k"]] = rec["v"]
+                    applied += 1
+                except (json.JSONDecodeError, KeyError, TypeError) as e:
+                    logger.warning(f"LocalDB: skipping damaged journal record {journal_path}:{line_num}: {e}")
+        return applied
+
+    @staticmethod
+    def _seal_journal(journal_path: str):
+        """Обрезает оборванную последнюю строку журнала, иначе следующая запись допишется к ней и пропадёт."""
+        if not os.path.exists(journal_path):
+            return
+        with open(journal_path, "rb+") as f:
+            size = f.seek(0, os.SEEK_END)
+            if not size:
+                return
+            f.seek(size - 1)
+            if f.read(1) == b"\n":
+                return
+            pos = size
+            while pos > 0:
+                chunk = min(64 * 1024, pos)
+                pos -= chunk
+                f.seek(pos)
+                nl = f.read(chunk).rfind(b"\n")
+                if nl >= 0:
+                    pos += nl + 1
+                    break
+            f.truncate(pos)
+        logger.warning(f"LocalDB: truncated torn journal tail {journal_path}: {size - pos} bytes")
+
+    def _write_snapshot(self, data: Dict[str, Any]):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def _append(self, k, v, deleted: bool = False):
+        rec = {"k": k, "d": 1} if deleted else {"k": k, "v": v}
+        self._write_lines(json.dumps(rec, ensure_ascii=False) + "\n")
+
+    def _write_lines(self, line: str):
+        with self._lock:
+            self._journal.write(line)
+            self._journal.flush()
+            self._journal_size += len(line.encode("utf-8"))
+            if self._journal_size >= self.compact_bytes:
+                self.compact(wait=False)
+
+    def compact(self, wait: bool = True):
+        """Сворачивает журнал в снапшот. Живые объекты не трогаются — слияние идёт по файлам."""
+        with self._lock:
+            if self._compactor and self._compactor.is_alive():
+                worker = self._compactor
+            else:
+                # счётчик сбрасывается сразу: если сворачивание упадёт, повтор — не раньше следующих compact_bytes
+                self._journal_size = 0
+                worker = threading.Thread(target=self._compact_worker, daemon=True, name="localdb-compactor")
+                self._compactor = worker
+                worker.start()
+        if wait:
+            worker.join()
+
+    def _compact_worker(self):
+        try:
+            # незавершённый прошлый сворачиваемый журнал не перезаписываем — сначала доедаем его
+            if os.path.exists(self.compacting_path):
+                self._fold_compacting()
+            with self._lock:
+                self._journal.close()
+                os.replace(self.journal_path, self.compacting_path)
+                self._journal = open(self.journal_path, "a", encoding="utf-8")
+            self._fold_compacting()
+        except Exception as e:
+            logger.error(f"LocalDB compaction failed: {e}")
+
+    def _fold_compacting(self):
+        with open(self.path, "r", encoding="utf-8") as f:
+            base = json.load(f)
+        applied = self._replay(self.compacting_path, base)
+        self._write_snapshot(base)
+        os.remove(self.compacting_path)
+        logger.info(f"LocalDB: compacted {applied} journal records into {self.path}")
+
+    def close(self):
+        with self._lock:
+            self._journal.close()
+
+    def snapshot(self, out_dir: str, name: str = "state") -> Dict[str, Dict[str, Any]]:
+        """
+        Онлайн-копия: под замком фиксируются открытые файлы и длина журнала,
+        сжатие идёт уже без замка. Журнал только дописывается, а повторное
+        применение его записей к более новому снапшоту ничего не меняет,
+        так что параллельное сворачивание копии не портит.
+        """
+        with self._lock:
+            self._journal.flush()
+            try:
+                compacting = open(self.compacting_path, "rb")
+            except FileNotFoundError:
+                compacting = None
+            snap = open(self.path, "rb")
+            journal = open(self.journal_path, "rb")
+            journal_len = os.fstat(journal.fileno()).st_size
+        snap_name, journal_name = f"{name}.json.gz", f"{name}.journal.gz"
+        try:
+            files = {snap_name: snapshots.gzip_stream([(snap, None)], os.path.join(out_dir, snap_name))}
+            files[snap_name].update(target=self.path, remove=[self.compacting_path, f"{self.path}.tmp"])
+            parts = [(compacting, None), (io.BytesIO(b"\n"), None)] if compacting else []
+            files[journal_name] = snapshots.gzip_stream(parts + [(journal, journal_len)],
+                                                        os.path.join(out_dir, journal_name))
+            files[journal_name].update(target=self.journal_path)
+        finally:
+            for f in (compacting, snap, journal):
+                if f:
+                    f.close()
+        return files
+
+    def __getitem__(self, k):
+        return self.store.get(k)
+
+    def __setitem__(self, k, v):
+        self.store[k] = v
+        self._append(k, v)
+
+    def put_many(self, items: Dict[str, Any]):
+        # одна запись в журнал на всю пачку
+        lines = "".join(json.dumps({"k": k, "v": v}, ensure_ascii=False) + "\n" for k, v in items.items())
+        with self._lock:
+            self.store.update(items)
+            self._write_lines(lines)
+
+    def __delitem__(self, k):
+        with self._lock:
+            if self.store.pop(k, None) is not None:
+                self._append(k, None, deleted=True)
+
+    def __contains__(self, k):
+        return k in self.store
+
+    def get(self, k, default=None):
+        return self.store.get(k, default)
+
+    def cas(self, k, expected: int, v) -> bool:
+        """Пишет v, только если сохранённая версия (_v) равна expected; при успехе v["_v"] = expected + 1."""
+        with self._lock:
+            cur = self.store.get(k)
+            cur_v = int(cur.get("_v", 0)) if isinstance(cur, dict) else 0
+            if cur_v != expected:
+                return False
+            v["_v"] = expected + 1
+            self[k] = v
+            return True
+
+    def keys(self):
+        return list(self.store.keys())
+
+    def keys_prefix(self, prefix: str) -> List[str]:
+        return [k for k in self.store if str(k).startswith(prefix)]
+
+
+class StorageWriteError(RuntimeError):
+    """Записи приняты хранилищем, но на диск не легли."""
+
+
+_DELETED = object()  # отметка удаления в очереди/_pending SQLiteStateDB
+
+class SQLiteStateDB(KVStore):
+    """
+    Хранилище состояния в SQLite (WAL): одна строка на ключ (user:{uid}, admin_users, ...).
+
+    Чтение — точечный SELECT по ключу, старт не разбирает записи всех пользователей.
+    Запись сериализуется в вызывающем потоке и уходит в очередь выделенного потока-писателя,
+    который пишет пачками в одной транзакции, так что event loop на диске не ждёт.
+    Пока запись не легла в базу, её видно чтению через _pending. Пачка, которую записать
+    не удалось, остаётся в _pending и повторяется с нарастающей паузой; flush()/close()
+    в это время бросают StorageWriteError.
+    Значения хранятся в бинарном формате record_codec, кроме «горячих» записей (JSON_PREFIXES,
+    состояние пользователя): их читают на каждый промах state_cache прямо в event loop,
+    а json.loads разбирает в несколько раз быстрее разборщика на Python.
+    """
+
+    BLOCKING = True
+    JSON_PREFIXES = ("user:",)
+    RETRY_DELAY = 0.1
+    RETRY_DELAY_MAX = 5.0
+
+    def __init__(self, path: str = "./data/state.db", import_json: Optional[str] = None, shared: bool = False):
+        self.path = path
+        # shared — файл открыт несколькими процессами (общее хранилище шардов): cas сверяет версию в самой базе
+        self.shared = shared
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.write_errors = 0
+        self._unwritten = 0  # строк в неудавшейся пачке, ждущей повтора
+        self._last_error: Optional[BaseException] = None
+        self._pending: Dict[str, str] = {}
+        self._pending_lock = threading.Lock()
+        self._queue: "queue.Queue" = queue.Queue()
+        self._local = threading.local()
+        con = self._connect()
+        con.execute("""CREATE TABLE IF NOT EXISTS kv(
+  key TEXT PRIMARY KEY,
+  value TEXT NOT NULL,
+  version INTEGER NOT NULL DEFAULT 0
+)""")
+        if "version" not in {r[1] for r in con.execute("PRAGMA table_info(kv)")}:
+            con.execute("ALTER TABLE kv ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+        con.commit()
+        version = con.execute("PRAGMA user_version").fetchone()[0]
+        if version < 1:
+            migrated = record_codec.migrate_rows(con, "kv", "key", "value")
+            if migrated:
+                logger.info(f"SQLiteStateDB: re-encoded {migrated} JSON rows")
+        if version < 2:
+            self._hot_rows_to_json(con)
+            con.execute("PRAGMA user_version=2")
+        con.commit()
+        self._versions: Dict[str, int] = {}
+        if import_json:
+            self._import_json(con, import_json)
+        self._writer = threading.Thread(target=self._writer_loop, daemon=True, name="sqlite-state-writer")
+        self._writer.start()
+
+    def _connect(self) -> sqlite3.Connection:
+        con = sqlite3.connect(self.path, timeout=30)
+        con.execute("PRAGMA journal_mode=WAL")
+        con.execute("PRAGMA synchronous=NORMAL")
+        return con
+
+    @classmethod
+    def _encode(cls, k: str, v) -> Any:
+        if k.startswith(cls.JSON_PREFIXES):
+            return json.dumps(v, ensure_ascii=False, separators=(",", ":"))
+        return record_codec.encode(v)
+
+    def _hot_rows_to_json(self, con: sqlite3.Connection):
+        for prefix in self.JSON_PREFIXES:
+            rows = con.execute("SELECT key, value FROM kv WHERE key >= ? AND key < ?",
+                               (prefix, prefix + "\U0010ffff")).fetchall()
+            updates = [(self._encode(k, record_codec.decode(v)), k) for k, v in rows if record_codec.is_encoded(v)]
+            if updates:
+                with con:
+                    con.executemany("UPDATE kv SET value=? WHERE key=?", updates)
+                logger.info(f"SQLiteStateDB: stored {len(updates)} {prefix}* rows as JSON")
+
+    def _reader(self) -> sqlite3.Connection:
+        # у каждого потока своё соединение на чтение (loop, to_thread-воркеры)
+        con = getattr(self._local, "con", None)
+        if con is None:
+            con = self._local.con = self._connect()
+        return con
+
+    def _import_json(self, con: sqlite3.Connection, json_path: str):
+        """Одноразовый перенос из db.json (+журнал), если таблица ещё пустая."""
+        if con.execute("SELECT 1 FROM kv LIMIT 1").fetchone() or not os.path.exists(json_path):
+            return
+        legacy = LocalDB(json_path)
+        try:
+            rows = [(k, self._encode(k, v), self._version_of(v)) for k, v in legacy.store.items()]
+        finally:
+            legacy.close()
+        with con:
+            con.executemany("INSERT OR REPLACE INTO kv(key, value, version) VALUES (?, ?, ?)", rows)
+        logger.info(f"SQLiteStateDB: imported {len(rows)} keys from {json_path}")
+
+    def _writer_loop(self):
+        con = self._connect()
+        retry: List[tuple] = []
+        failures = 0
+        while True:
+            if retry:
+                time.sleep(min(self.RETRY_DELAY_MAX, self.RETRY_DELAY * 2 ** (failures - 1)))
+                batch = []
+            else:
+                batch = [self._queue.get()]
+            while len(batch) < 500:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            with self._pending_lock:
+                # перезаписанное позже уже стоит в очереди следом — старую версию не пишем
+                rows = [r for r in retry + [b for b in batch if isinstance(b, tuple)] if self._pending.get(r[0]) is r[1]]
+            if rows:
+                try:
+                    with con:
+                        for r in rows:
+                            if r[1] is _DELETED:
+                                con.execute("DELETE FROM kv WHERE key=?", (r[0],))
+                            else:
+                                con.execute("INSERT OR REPLACE INTO kv(key, value, version) VALUES (?, ?, ?)", r)
+                except Exception as e:
+                    failures += 1
+                    self.write_errors += 1
+                    self._last_error = e
+                    retry = rows
+                    logger.error(f"SQLiteStateDB write of {len(rows)} rows failed (attempt {failures}): {e}")
+                else:
+                    failures = 0
+                    retry = []
+                    with self._pending_lock:
+                        for k, payload, _ in rows:
+                            if self._pending.get(k) is payload:
+                                del self._pending[k]
+            else:
+                retry = []
+            self._unwritten = len(retry)
+            for b in batch:
+                if isinstance(b, threading.Event):
+                    b.set()
+            if any(b is None for b in batch):
+                con.close()
+                return
+
+    def _raise_unwritten(self):
+        if self._unwritten:
+            raise StorageWriteError(f"SQLiteStateDB: {self._unwritten} rows not written: {self._last_error}")
+
+    def get(self, k, default=None):
+        with self._pending_lock:
+            payload = self._pending.get(k)
+        if payload is None:
+            row = self._reader().execute("SELECT value FROM kv WHERE key=?", (k,)).fetchone()
+            if not row:
+                return default
+            payload = row[0]
+        elif payload is _DELETED:
+            return default
+        return record_codec.decode(payload)
+
+    def get_many(self, keys) -> Dict[str, Any]:
+        keys = list(keys)
+        out: Dict[str, Any] = {}
+        missing = []
+        with self._pending_lock:
+            for k in keys:
+                payload = self._pending.get(k)
+                if payload is None:
+                    missing.append(k)
+                elif payload is not _DELETED:
+                    out[k] = payload
+        con = self._reader()
+        for i in range(0, len(missing), 500):
+            chunk = missing[i:i + 500]
+            marks = ",".join("?" * len(chunk))
+            out.update(con.execute(f"SELECT key, value FROM kv WHERE key IN ({marks})", chunk).fetchall())
+        return {k: record_codec.decode(out[k]) for k in keys if k in out}
+
+    @staticmethod
+    def _version_of(v) -> int:
+        return int(v.get("_v", 0)) if isinstance(v, dict) else 0
+
+    def __setitem__(self, k, v):
+        payload = self._encode(k, v)
+        version = self._version_of(v)
+        with self._pending_lock:
+            self._pending[k] = payload
+            self._versions[k] = version
+        self._queue.put((k, payload, version))
+
+    def put_many(self, items: Dict[str, Any]):
+        rows = [(k, self._encode(k, v), self._version_of(v)) for k, v in items.items()]
+        with self._pending_lock:
+            for k, payload, version in rows:
+                self._pending[k] = payload
+                self._versions[k] = version
+        for row in rows:
+            self._queue.put(row)
+
+    def cas(self, k, expected: int, v) -> bool:
+        """
+        Условная запись по версии. Если писатель у файла один (этот процесс), сверка идёт в памяти
+        и запись уходит в очередь; в общем файле (shared) — условным UPDATE прямо в базе.
+        """
+        if self.shared:
+            return self._cas_in_db(k, expected, v)
+        with self._pending_lock:
+            cur_v = self._versions.get(k)
+            if cur_v is None:
+                row = self._reader().execute("SELECT version FROM kv WHERE key=?", (k,)).fetchone()
+                cur_v = int(row[0]) if row else 0
+            if cur_v != expected:
+                self._versions[k] = cur_v
+                return False
+            v["_v"] = expected + 1
+            payload = self._encode(k, v)
+            self._pending[k] = payload
+            self._versions[k] = expected + 1
+        self._queue.put((k, payload, expected + 1))
+        return True
+
+    def _cas_in_db(self, k, expected: int, v) -> bool:
+        with self._pending_lock:
+            queued = k in self._pending
+        if queued:
+            self.flush()  # своя отложенная запись этого ключа не должна лечь поверх
+        payload = self._encode(k, dict(v, _v=expected + 1) if isinstance(v, dict) else v)
+        con = self._reader()
+        with con:
+            if expected == 0:
+                cur = con.execute(
+                    "INSERT INTO kv(key, value, version) VALUES (?, ?, 1) "
+                    "ON CONFLICT(key) DO UPDATE SET value=excluded.value, version=1 WHERE kv.version=0",
+                    (k, payload))
+            else:
+                cur = con.execute("UPDATE kv SET value=?, version=? WHERE key=? AND version=?",
+                                  (payload, expected + 1, k, expected))
+        if cur.rowcount != 1:
+            return False
+        v["_v"] = expected + 1
+        return True
+
+    def __delitem__(self, k):
+        with self._pending_lock:
+            self._pending[k] = _DELETED
+            self._versions[k] = 0
+        self._queue.put((k, _DELETED, 0))
+
+    def keys_prefix(self, prefix: str) -> List[str]:
+        rows = self._reader().execute(
+            "SELECT key FROM kv WHERE key >= ? AND key < ?", (prefix, prefix + "\U0010ffff")
+        ).fetchall()
+        keys = {r[0] for r in rows}
+        with self._pending_lock:
+            for k, payload in self._pending.items():
+                if k.startswith(prefix):
+                    if payload is _DELETED:
+                        keys.discard(k)
+                    else:
+                        keys.add(k)
+        return list(keys)
+
+    def snapshot(self, out_dir: str, name: str = "state") -> Dict[str, Dict[str, Any]]:
+        """Онлайн-копия через backup API: писатель и читатели не останавливаются (WAL)."""
+        self.flush()
+        info = snapshots.backup_sqlite(self.path, os.path.join(out_dir, f"{name}.db.gz"))
+        info.update(target=self.path, remove=[f"{self.path}-wal", f"{self.path}-shm"])
+        return {f"{name}.db.gz": info}
+
+    def flush(self, timeout: Optional[float] = None):
+        """Ждёт, пока все поставленные в очередь записи лягут в базу; StorageWriteError, если не легли."""
+        done = threading.Event()
+        self._queue.put(done)
+        done.wait(timeout)
+        self._raise_unwritten()
+
+    def close(self):
+        if self._writer.is_alive():
+            self._queue.put(None)
+            self._writer.join()
+        self._raise_unwritten()
+
+
+class ReplitDB(KVStore):
+    """Replit DB. Атомарного CAS у неё нет — версия сверяется best effort. Ошибки не маскируются."""
+
+    BLOCKING = True
+
+    def __init__(self, db):
+        self.db = db
+
+    def get(self, k, default=None):
+        return self.db.get(k, default)
+
+    def __setitem__(self, k, v):
+        self.db[k] = v
+
+    def __delitem__(self, k):
+        if k in self.db:
+            del self.db[k]
+
+    def cas(self, k, expected: int, v) -> bool:
+        cur = self.db.get(k)
+        cur_v = int(cur.get("_v", 0)) if isinstance(cur, dict) else 0
+        if cur_v != expected:
+            return False
+        v["_v"] = expected + 1
+        self.db[k] = v
+        return True
+
+    def keys_prefix(self, prefix: str) -> List[str]:
+        return [k for k in self.db.keys() if str(k).startswith(prefix)]
+
+
+class PrefixRouter(KVStore):
+    """
+    Ключи с заданными префиксами — в общее хранилище (shared), остальные — в своё (local).
+    В режиме шардов так у воркера свои записи пользователей, а список админов
+    и баллы рейтинга видны всем воркерам (см. sharding.py).
+    """
+
+    def __init__(self, local: KVStore, shared: KVStore, prefixes: Iterable[str]):
+        self.local = local
+        self.shared = shared
+        self.prefixes = tuple(prefixes)
+        self.BLOCKING = local.BLOCKING or shared.BLOCKING
+
+    def _pick(self, k) -> KVStore:
+        return self.shared if str(k).startswith(self.prefixes) else self.local
+
+    def get(self, k, default=None):
+        return self._pick(k).get(k, default)
+
+    def __setitem__(self, k, v):
+        self._pick(k)[k] = v
+
+    def __delitem__(self, k):
+        del self._pick(k)[k]
+
+    def cas(self, k, expected: int, v) -> bool:
+        return self._pick(k).cas(k, expected, v)
+
+    def keys_prefix(self, prefix: str) -> List[str]:
+        if prefix.startswith(self.prefixes):
+            return self.shared.keys_prefix(prefix)
+        keys = [k for k in self.local.keys_prefix(prefix) if not k.startswith(self.prefixes)]
+        if any(p.startswith(prefix) for p in self.prefixes):
+            keys.extend(k for k in self.shared.keys_prefix(prefix) if k.startswith(self.prefixes))
+        return keys
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, Any]:
+        keys = list(keys)
+        out = self.local.get_many([k for k in keys if self._pick(k) is self.local])
+        out.update(self.shared.get_many([k for k in keys if self._pick(k) is self.shared]))
+        return out
+
+    def put_many(self, items: Dict[str, Any]):
+        self.local.put_many({k: v for k, v in items.items() if self._pick(k) is self.local})
+        self.shared.put_many({k: v for k, v in items.items() if self._pick(k) is self.shared})
+
+    def snapshot(self, out_dir: str, name: str = "state") -> Dict[str, Dict[str, Any]]:
+        files = {}
+        for store, store_name in ((self.local, name), (self.shared, "shared")):
+            if hasattr(store, "snapshot"):
+                files.update(store.snapshot(out_dir, store_name))
+        return files
+
+    def flush(self, timeout: Optional[float] = None):
+        self.local.flush(timeout)
+        self.shared.flush(timeout)
+
+    def close(self):
+        self.local.close()
+        self.shared.close()
+
+
+BACKENDS = ("memory", "json", "sqlite", "replit")
+
+
+def open_store(kind: str, json_path: str = "db.json", sqlite_path: str = "./data/state.db", replit=None) -> KVStore:
+    """Открывает хранилище по имени (значение HLITE_STORAGE). Незнакомое имя — ошибка, а не тихая подмена."""
+    kind = kind.lower()
+    if kind == "memory":
+        return MemoryDB()
+    if kind == "json":
+        return LocalDB(json_path)
+    if kind == "sqlite":
+        return SQLiteStateDB(sqlite_path, import_json=json_path)
+    if kind == "replit":
+        if replit is None:
+            raise ValueError("HLITE_STORAGE=replit, but Replit DB is not available")
+        return ReplitDB(replit)
+    raise ValueError(f"unknown storage backend {kind!r}, expected one of {', '.join(BACKENDS)}")
+
+
+class AsyncStorage:
+    """
+    Асинхронный доступ к KVStore. Блокирующие хранилища (SQLite, Replit) вызываются
+    в рабочем потоке, in-memory (MemoryDB, LocalDB) — прямо в event loop.
+    """
+
+    def __init__(self, store: KVStore):
+        self.store = store
+
+    async def _call(self, fn, *args):
+        if self.store.BLOCKING:
+            return await asyncio.to_thread(fn, *args)
+        return fn(*args)
+
+    async def get(self, k, default=None):
+        return await self._call(self.store.get, k, default)
+
+    async def put(self, k, v):
+        await self._call(self.store.__setitem__, k, v)
+
+    async def delete(self, k):
+        await self._call(self.store.__delitem__, k)
+
+    async def get_many(self, keys: Iterable[str]) -> Dict[str, Any]:
+        return await self._call(self.store.get_many, list(keys))
+
+    async def put_many(self, items: Dict[str, Any]):
+        await self._call(self.store.put_many, items)
+
+    async def scan_prefix(self, prefix: str) -> List[str]:
+        return sorted(await self._call(self.store.keys_prefix, prefix))
+
+    async def put_if_version(self, k, expected: int, v) -> bool:
+        return await self._call(self.store.cas, k, expected, v)
+
+    async def flush(self):
+        await self._call(self.store.flush)
+
+    async def close(self):
+        await self._call(self.store.close)
@@ -0,0 +1,39 @@
+from pathlib import Path
+import sys
+
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+from diary_columns import DiaryColumns, parse_ts
+
+
+def test_roundtrip_is_exact():
+    food = [
+        {"ts": "2026-10-02 09:00:00", "text": "Творог", "kcal": 180, "p": 18.5, "f": 5, "c": 3.0},
+        {"ts": "2026-10-01 08:15:00", "text": "Овсянка", "kcal": 320.5, "p": None, "note": {"src": "photo"}},
+        {"ts": "вчера", "text": "без времени", "kcal": True},
+        {"text": "нет ts", "type": 5},
+    ]
+    cols = DiaryColumns.from_entries(food, "food")
+    cols.extend([{"ts": "2026-10-01 19:00:00", "text": "Бег", "type": "бег", "kcal": 300, "avg_hr": 140}], "train")
+    out_food = cols.to_entries(kind="food")
+    by_text = {e["text"]: e for e in out_food}
+    assert all(by_text[e["text"]] == e for e in food) and len(out_food) == 4
+    assert cols.to_entries(kind="train") == [{"ts": "2026-10-01 19:00:00", "text": "Бег", "type": "бег",
+                                              "kcal": 300, "avg_hr": 140}]
+    assert parse_ts("2026-02-30 10:00:00") is None and parse_ts("2026-10-01T10:00:00") is None
+
+
+def test_day_week_and_totals():
+    cols = DiaryColumns()
+    for d in ("2026-10-04", "2026-10-05", "2026-10-05", "2026-10-11", "2026-10-12"):  # вс, пн, пн, вс, пн
+        cols.extend([{"ts": f"{d} 12:00:00", "kcal": 100, "p": 1.5}], "food")
+    cols.extend([{"ts": "2026-10-05 23:59:59", "kcal": 400}], "train")
+    lo, hi = cols.day("2026-10-05")
+    assert hi - lo == 3
+    assert cols.totals(lo, hi) == {"kcal": 200.0, "p": 3.0, "f": 0.0, "c": 0.0, "n": 2}
+    assert cols.totals(lo, hi, "train")["kcal"] == 400.0
+    lo, hi = cols.week("2026-10-08")
+    assert [e["ts"][:10] for e in cols.to_entries(lo, hi, "food")] == ["2026-10-05", "2026-10-05", "2026-10-11"]
+    assert cols.day("2026-10-06") == cols.day("2026-10-07")  # пустой день — пустой отрезок
@@ -0,0 +1,81 @@
+from pathlib import Path
+import csv
+import json
+import sys
+
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+import diary_export
+import main
+
+
+def _store(monkeypatch):
+    db = main.MemoryDB()
+    monkeypatch.setattr(main, "local_db", db)
+    store = main.DiaryStore()
+    store.append(1, "food", {"ts": "2025-01-05 08:00:00", "text": "каша, с \"молоком\"", "kcal": 300, "p": 10.5})
+    store.append(1, "train", {"ts": "2025-01-05 07:00:00", "text": "бег", "kcal": 400, "avg_hr": 150})
+    store.append(1, "food", {"ts": "2026-10-01 13:00:00", "text": "обед", "kcal": 700})
+    store.append(1, "metrics", {"ts": "2026-10-01 06:00:00", "type": "weight", "data": {"kg": 70}})
+    store.archive_month(1, "2025-01")
+    return store
+
+
+def test_iter_entries_reads_hot_and_cold_in_order(monkeypatch):
+    store = _store(monkeypatch)
+    assert "2025-01" in store.cold_months(1)
+    rows = list(store.iter_entries(1, ("food", "train")))
+    assert [(k, e["text"]) for k, e in rows] == [("train", "бег"), ("food", 'каша, с "молоком"'), ("food", "обед")]
+    assert not store._cold_cache  # полный проход не засоряет LRU архива
+
+
+def test_write_export_csv_and_jsonl(monkeypatch, tmp_path):
+    store = _store(monkeypatch)
+    path = str(tmp_path / "out.csv")
+    assert diary_export.write_export(store.iter_entries(1, ("food", "train")), "csv", path) == 3
+    with open(path, encoding="utf-8-sig", newline="") as f:
+        rows = list(csv.DictReader(f))
+    assert [r["kind"] for r in rows] == ["train", "food", "food"]
+    assert rows[0]["extra"] == '{"avg_hr": 150}' and rows[1]["text"] == 'каша, с "молоком"' and rows[1]["p"] == "10.5"
+
+    path = str(tmp_path / "out.jsonl")
+    assert diary_export.write_export(store.iter_entries(1), "jsonl", path) == 4
+    lines = [json.loads(line) for line in Path(path).read_text(encoding="utf-8").splitlines()]
+    assert lines[-2] == {"ts": "2026-10-01 06:00:00", "type": "weight", "data": {"kg": 70}, "kind": "metrics"}
+
+    many = (("food", {"ts": f"2026-10-01 10:00:{i % 60:02d}", "kcal": i}) for i in range(1201))
+    chunks = list(diary_export.csv_chunks(many, chunk_rows=500))
+    assert len(chunks) == 3 and sum(c.count("\n") for c in chunks) == 1202
+
+
+def test_send_export_reads_store_only_on_the_loop(monkeypatch, tmp_path):
+    import asyncio
+    import threading
+
+    _store(monkeypatch)
+    real_get = main.db_get
+    loop_thread = []
+
+    def get(k, default=None):
+        assert threading.current_thread() is loop_thread[0], "store read from the export thread"
+        return real_get(k, default)
+
+    monkeypatch.setattr(main, "db_get", get)
+    sent = {}
+
+    class Bot:
+        async def send_document(self, chat_id, document, filename, caption):
+            sent["body"] = document.read().decode("utf-8-sig")
+
+        async def send_message(self, chat_id, text):
+            sent["error"] = text
+
+    async def scenario():
+        loop_thread.append(threading.current_thread())
+        await main._send_export(Bot(), 1, 1, "csv")
+
+    asyncio.run(scenario())
+    assert "error" not in sent
+    assert [line.split(",")[0] for line in sent["body"].splitlines()[1:]] == ["train", "food", "food"]
@@ -0,0 +1,48 @@
+from pathlib import Path
+import sys
+
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+import main
+
+
+def test_admin_set_cached_until_invalidated(monkeypatch):
+    reads = []
+    store = {"admin_users": [10]}
+
+    def fake_get(k, default=None):
+        reads.append(k)
+        return store.get(k, default)
+
+    monkeypatch.setattr(main, "db_get", fake_get)
+    monkeypatch.setattr(main, "db_set", lambda k, v: store.__setitem__(k, v))
+    monkeypatch.setattr(main, "entitlements", main.Entitlements())
+
+    assert main.is_admin_user(10) and not main.is_admin_user(11)
+    assert main.check_feature_access({}, 10, "analytics")
+    assert reads == ["admin_users"]
+
+    assert main.add_admin_user(11)
+    assert main.is_admin_user(11)
+    assert main.remove_admin_user(10)
+    assert not main.is_admin_user(10)
+    assert main.get_admin_users() == [11]
+
+
+def test_subscription_expires_lazily(monkeypatch):
+    monkeypatch.setattr(main, "entitlements", main.Entitlements())
+    monkeypatch.setattr(main, "DEVELOPER_USER_ID", 0)
+    monkeypatch.setattr(main.entitlements, "_admins", ())
+    now = [1_000_000.0]
+    monkeypatch.setattr(main.time, "time", lambda: now[0])
+
+    st = {"access_level": "premium", "access_expires": now[0] + 60}
+    assert main.check_feature_access(st, 5, "recipes")
+    now[0] += 61
+    assert main.get_user_access(st, 5) == "free"
+    assert st["access_level"] == "free" and "access_expires" not in st
+
+    legacy = {"access_level": "basic"}  # оплачено до появления сроков — без ограничения
+    assert main.get_user_access(legacy, 6) == "basic"
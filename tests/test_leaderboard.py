@@ -0,0 +1,36 @@
+from pathlib import Path
+import random
+import sys
+
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+from leaderboard import Leaderboard
+
+
+def test_leaderboard_matches_full_sort():
+    rng = random.Random(7)
+    board = Leaderboard(seed=7)
+    expected = {}
+    for _ in range(3000):
+        uid, pts = str(rng.randrange(200)), rng.randrange(100)
+        board.update(uid, pts)
+        expected[uid] = pts
+
+    order = sorted(expected, key=lambda u: (-expected[u], u))
+    assert [row["user_id"] for row in board.top(10)] == order[:10]
+    assert [row["points"] for row in board.top(10)] == [expected[u] for u in order[:10]]
+    for place, uid in enumerate(order, 1):
+        assert board.rank(uid) == place
+    assert len(board) == len(expected)
+    assert board.rank("nobody") is None
+
+
+def test_leaderboard_update_is_idempotent():
+    board = Leaderboard(seed=1)
+    assert board.update(1, 10)
+    assert not board.update("1", 10)
+    board.update(2, 20)
+    board.update(1, 30)
+    assert board.top(2) == [{"user_id": "1", "points": 30}, {"user_id": "2", "points": 20}]
@@ -0,0 +1,43 @@
+from pathlib import Path
+import asyncio
+import sys
+import time
+
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+import loop_watchdog
+
+
+def _blocking_parse():
+    time.sleep(0.25)
+
+
+def test_stall_is_attributed_to_blocking_call_site():
+    dog = loop_watchdog.LoopWatchdog(threshold=0.05, interval=0.02)
+
+    async def scenario():
+        dog.start()
+        await asyncio.sleep(0.1)
+        _blocking_parse()
+        await asyncio.sleep(0.1)
+        dog.stop()
+
+    asyncio.run(scenario())
+    m = dog.metrics()
+    assert m["stalls"] >= 1 and m["max_lag_ms"] >= 200
+    site = m["top_sites"][0]
+    assert site["site"].startswith("tests/test_loop_watchdog.py:") and site["site"].endswith("_blocking_parse")
+    assert sum(m["lag_buckets"].values()) == m["checks"]
+    assert not dog.running
+
+
+def test_disabled_watchdog_does_not_start():
+    dog = loop_watchdog.LoopWatchdog(threshold=0)
+
+    async def scenario():
+        dog.start()
+        return dog.running
+
+    assert asyncio.run(scenario()) is False
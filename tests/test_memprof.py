@@ -0,0 +1,34 @@
+from pathlib import Path
+import sys
+
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+import memprof
+import main
+
+
+def test_sizes_follow_containers_only():
+    shared = "x" * 1000
+    small = memprof.deep_sizeof({"a": [1, 2]})
+    big = memprof.deep_sizeof({"a": [shared, shared], "b": (shared,)})
+    assert big - small >= 1000 and big - small < 2000  # общая строка считается один раз
+    assert memprof.approx_sizeof(iter([[shared]] * 10), 10) >= 10 * 1000
+    assert memprof.approx_sizeof(iter(()), 0) == 0
+    assert memprof.deep_sizeof(main.sessions) < 1000  # атрибуты объектов не обходятся
+
+
+def test_snapshot_reports_growth():
+    prof = memprof.MemoryProfiler()
+    assert prof.start()
+    try:
+        current, growth = prof.snapshot()
+        assert current and growth == []
+        keep = [bytearray(4096) for _ in range(200)]
+        _, growth = prof.snapshot()
+        assert growth[0].startswith("за") and any("test_memprof.py" in line for line in growth[1:])
+        assert len(keep) == 200
+    finally:
+        prof.stop()
+    assert not prof.tracing
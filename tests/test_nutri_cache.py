@@ -0,0 +1,196 @@
+from pathlib import Path
+import asyncio
+import sys
+
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+from nutri_cache import NutritionCache
+from nutrition import NutritionResult
+
+
+def _last_used(cache, key):
+    return cache.call(lambda con: con.execute("SELECT last_used FROM nutri_cache WHERE key=?", (key,)).fetchone()[0])
+
+
+def test_hits_are_batched_and_results_round_trip(tmp_path):
+    cache = NutritionCache(str(tmp_path / "cache.db"), flush_interval=60, memory_bytes=0)
+    res = NutritionResult.from_serving((200.0, 10.0, 5.0, 20.0), 50.0, None, user_g=100.0, name="bar", source="fs")
+    cache.put("a", res)
+    res["name"] = "changed after put"  # значение закодировано при put
+    cache.call(lambda con: con.execute("UPDATE nutri_cache SET last_used=1 WHERE key='a'"))
+
+    async def read():
+        return await cache.get("a"), await cache.get("missing")
+
+    got, missing = asyncio.run(read())
+    assert got.name == "bar" and got.per_100g == (400.0, 20.0, 10.0, 40.0) and missing is None
+    assert _last_used(cache, "a") == 1  # попадание ещё не в базе
+    cache.flush()
+    assert _last_used(cache, "a") > 1
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 1
+    cache.close()
+
+
+def test_running_total_drives_eviction_and_survives_reopen(tmp_path):
+    path = str(tmp_path / "cache.db")
+    cache = NutritionCache(path, limit_bytes=10_000, memory_bytes=0)
+    for i in range(60):
+        cache.put(f"k{i}", {"name": "x" * 200, "i": i})
+    cache.put("k59", {"name": "y"})  # замена учитывается по разнице размеров
+    total = cache.call(lambda con: con.execute("SELECT COUNT(*), SUM(size_bytes) FROM nutri_cache").fetchone())
+    assert (cache.rows, cache.bytes) == total and cache.bytes <= 10_000 and cache.evicted
+    assert asyncio.run(cache.get("k0")) is None and asyncio.run(cache.get("k59")) == {"name": "y"}
+    cache.close()
+
+    reopened = NutritionCache(path, limit_bytes=10_000)
+    assert (reopened.rows, reopened.bytes) == total
+    assert reopened.call(lambda con: con.execute("PRAGMA journal_mode").fetchone()[0]) == "wal"
+    reopened.close()
+
+
+def test_memory_tier_serves_copies_and_counts_per_tier(tmp_path):
+    path = str(tmp_path / "cache.db")
+    cache = NutritionCache(path)
+    res = NutritionResult.from_serving((100.0, 1.0, 2.0, 3.0), 100.0, None, name="банан")
+    cache.put("fs:q:r4:банан", res)
+
+    async def read_twice():
+        first = await cache.get("fs:q:r4:банан")
+        first["name"] = "испорчено"
+        return await cache.get("fs:q:r4:банан")
+
+    assert asyncio.run(read_twice()).name == "банан"
+    stats = cache.stats()
+    assert stats["memory"]["hits"] == 2 and stats["hits"] == stats["misses"] == 0
+    cache.close()
+
+    cold = NutritionCache(path)  # новый процесс: память пуста, значение из SQLite поднимается в LRU
+    asyncio.run(cold.get("fs:q:r4:банан"))
+    asyncio.run(cold.get("fs:q:r4:банан"))
+    stats = cold.stats()
+    assert stats["hits"] == 1 and stats["memory"]["hits"] == 1 and stats["memory"]["misses"] == 1
+    assert stats["total_hit_ratio"] == 1.0
+    cold.close()
+
+
+def test_calls_after_close_fail_instead_of_hanging(tmp_path):
+    import pytest
+
+    cache = NutritionCache(str(tmp_path / "cache.db"))
+    cache.put("a", {"name": "x"})
+    cache.close()
+    cache.close()
+    with pytest.raises(RuntimeError):
+        asyncio.run(cache.get("b"))
+    with pytest.raises(RuntimeError):
+        cache.flush()
+
+
+def test_lookup_records_misses_and_errors_with_own_ttls(monkeypatch):
+    import main
+    from nutri_cache import NegativeCache
+
+    neg = NegativeCache((3600, 60), {"slow": (7200, 0)})
+    monkeypatch.setattr(main, "negative_cache", neg)
+    calls = []
+
+    async def not_found():
+        calls.append("nf")
+        return None
+
+    async def flaky():
+        calls.append("flaky")
+        main._note_lookup_failure("HTTP 503")
+        return None
+
+    async def scenario():
+        await main._lookup("fs", "Bombbar 40г", not_found)
+        await main._lookup("fs", "bombbar 60 г", not_found)  # тот же канонический запрос — пропуск
+        await main._lookup("cse", "редкий продукт", flaky)
+        await main._lookup("slow", "редкий продукт", flaky)   # ttl ошибки 0 — не запоминается
+        await main._lookup("slow", "редкий продукт", flaky)
+
+    asyncio.run(scenario())
+    assert calls == ["nf", "flaky", "flaky", "flaky"]
+    assert neg.is_miss("fs", "bombbar") == "miss" and neg.is_miss("cse", "продукт редкий") == "error"
+    assert neg.is_miss("slow", "продукт редкий") is None
+    assert neg.skipped["fs"] == 2 and neg.recorded == {"miss": 1, "error": 1}
+
+
+def test_cancelled_lookup_is_not_cached_as_miss(monkeypatch):
+    import main
+    from nutri_cache import NegativeCache
+
+    neg = NegativeCache()
+    monkeypatch.setattr(main, "negative_cache", neg)
+
+    async def slow():
+        await asyncio.sleep(10)
+        return {"kcal": 1}
+
+    async def boom():
+        raise RuntimeError("quota")
+
+    async def scenario():
+        task = asyncio.ensure_future(main._lookup("fs", "овсянка", slow))
+        await asyncio.sleep(0.01)
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        try:
+            await main._lookup("cse", "гречка", boom)
+        except RuntimeError:
+            pass
+
+    asyncio.run(scenario())
+    assert neg.is_miss("fs", "овсянка") is None
+    assert neg.is_miss("cse", "гречка") == "error" and neg.recorded == {"miss": 0, "error": 1}
+
+
+def test_failures_inside_nested_lookup_mark_pipeline_as_error(monkeypatch):
+    import main
+    from nutri_cache import NegativeCache
+
+    neg = NegativeCache((3600, 60))
+    monkeypatch.setattr(main, "negative_cache", neg)
+
+    async def provider():
+        main._note_lookup_failure("timeout")
+        return None
+
+    async def pipeline():
+        return await main._lookup("inner", "кефир", provider)
+
+    asyncio.run(main._lookup("pipeline", "кефир 200 мл", pipeline))
+    assert neg.is_miss("pipeline", "кефир") == "error" and neg.is_miss("inner", "кефир") == "error"
+
+
+def test_lookup_coalesces_same_query_and_portion_only(monkeypatch):
+    import main
+    import singleflight
+    from nutri_cache import NegativeCache
+
+    monkeypatch.setattr(main, "negative_cache", NegativeCache())
+    monkeypatch.setattr(main, "lookup_flights", singleflight.SingleFlight())
+    calls = []
+
+    def provider(text):
+        async def call():
+            calls.append(text)
+            await asyncio.sleep(0.05)
+            return NutritionResult(name=text, per_100g=(100.0, 1.0, 1.0, 1.0))
+        return call
+
+    async def scenario():
+        queries = ["Гречка 100г", "гречка 100 г", "ГРЕЧКА, 100г", "гречка 200г"]
+        return await asyncio.gather(*(main._lookup("pipeline", q, provider(q)) for q in queries))
+
+    results = asyncio.run(scenario())
+    assert calls == ["Гречка 100г", "гречка 200г"]
+    results[1]["name"] = "правка ждавшего"
+    assert results[0].name == "Гречка 100г" and results[3].name == "гречка 200г"
+    assert main.lookup_flights.stats()["groups"]["pipeline"] == {"calls": 2, "coalesced": 2}
@@ -0,0 +1,63 @@
+import asyncio
+from pathlib import Path
+import sys
+
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+import record_codec
+from nutrition import NutritionResult, canonical_query, from_cache, to_cache
+
+
+def test_from_serving_scales_and_reads_like_dict():
+    res = NutritionResult.from_serving((200, 10, None, 30), serving_g=50, serving_ml=None, user_g=150,
+                                       name="Батончик", source="google_cse_jsonld")
+    assert res.per_100g == (400.0, 20.0, None, 60.0)
+    assert res.get("kcal_portion") == 600.0 and res["fat_100g"] is None
+    assert res.get("fat_100g", 0) == 0 and "fat_100g" not in res and "kcal_100ml" not in res
+    res["source"] = "smart_search"
+    res["carbs_100g"] = 55.0
+    res["serving_g"] = 50
+    assert res.source == "smart_search" and res.per_100g[3] == 55.0 and res.extra == {"serving_g": 50}
+    legacy = res.to_dict()
+    assert len(legacy) == 19 and legacy["portion_g"] == 150 and legacy["kcal_100ml"] is None
+    assert NutritionResult.from_dict(legacy) == res
+
+    ml = NutritionResult.from_serving((40, 1, 0, 9), None, 100, user_ml=250)
+    assert ml.portion == (100.0, 2.5, 0.0, 22.5) and ml.portion_ml == 250
+
+
+def test_cache_roundtrip_is_compact():
+    res = NutritionResult(name="Kefir", brand="", url="https://example.org/k", per_100g=(41, 3.0, 1.0, 4.0))
+    res = res.scaled(grams=200)
+    blob = record_codec.encode(to_cache(res))
+    assert from_cache(record_codec.decode(blob)) == res
+    assert len(blob) < len(record_codec.encode(res.to_dict()))
+    assert from_cache(record_codec.decode(record_codec.encode({"kcal_100g": 5}))) == {"kcal_100g": 5}
+
+
+def test_canonical_query_drops_portion_case_and_punctuation():
+    assert canonical_query("Bombbar 40г") == canonical_query("bombbar 60 г") == "bombbar"
+    assert canonical_query("Молоко 3,2% 1л") == canonical_query("молоко, 3.2 %") == "3.2 молоко"
+    assert canonical_query("Ёжик «Шоколадный»") == canonical_query("шоколадный ежик")
+    assert canonical_query("Шоколадный ёжик", sort_tokens=False) == "шоколадный ежик"
+    assert canonical_query("250 мл") == ""
+
+
+def test_cache_stores_per_100g_and_rescales_portion(monkeypatch, tmp_path):
+    import main
+    from nutri_cache import NutritionCache
+
+    cache = NutritionCache(str(tmp_path / "cache.db"))
+    monkeypatch.setattr(main, "nutri_cache", cache)
+    found = NutritionResult.from_serving((200.0, 20.0, 8.0, 16.0), 50.0, None, user_g=40.0, name="Bombbar")
+    main._cache_put(main._nutri_key("brand", "Bombbar 40г"), found)
+    main._cache_put(main._nutri_key("brand", "порция"), NutritionResult(portion=(100.0, 1.0, 1.0, 1.0)))
+
+    hit = asyncio.run(main._cache_get(main._nutri_key("brand", "bombbar 60 г"), 60.0, None))
+    assert hit.portion_g == 60.0 and hit.portion == (240.0, 24.0, 9.6, 19.2)
+    assert hit.per_100g == found.per_100g
+    assert asyncio.run(main._cache_get(main._nutri_key("brand", "порция"))) is None
+    assert main._nutri_key("brand", "100 г") is None
+    cache.close()
@@ -0,0 +1,50 @@
+from pathlib import Path
+import json
+import sqlite3
+import sys
+
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+import pytest
+
+import record_codec
+
+
+def test_roundtrip_and_size():
+    rec = {
+        "entries": [{"ts": "2026-10-01 08:15:00", "text": "Овсянка", "kcal": 320, "p": 12.5, "f": 6.0, "c": 54.25}],
+        "days": {"2026-10-01": {"kcal": 320.0, "food_n": 1}},
+        "awards": {"2026-02-31": {"log_food": True}},  # не дата — остаётся строкой
+        "months": {"2026-10": 3, 5: None},
+        "misc": [None, False, -7, 1e-9, float("inf"), "2026-13-01 00:00:00", (1, 2)],
+    }
+    blob = record_codec.encode(rec)
+    assert record_codec.is_encoded(blob)
+    out = record_codec.decode(blob)
+    expected = json.loads(json.dumps(rec))
+    expected["misc"][4] = float("inf")
+    assert out == expected
+    assert len(blob) < len(json.dumps(rec, ensure_ascii=False).encode("utf-8")) / 2
+
+
+def test_legacy_json_and_errors():
+    assert record_codec.decode('{"a": [1, 2.5]}') == {"a": [1, 2.5]}
+    assert record_codec.decode(b'{"a": 1}') == {"a": 1}
+    blob = record_codec.encode({"text": "x" * 10})
+    with pytest.raises(record_codec.CodecError):
+        record_codec.decode(blob[:-3])
+    with pytest.raises(record_codec.CodecError):
+        record_codec.decode(b"HC\x63\x00")
+
+
+def test_migrate_rows_reencodes_json():
+    con = sqlite3.connect(":memory:")
+    con.execute("CREATE TABLE kv (key TEXT PRIMARY KEY, value BLOB)")
+    con.executemany("INSERT INTO kv VALUES (?, ?)", [(f"k{i}", json.dumps({"kcal": i})) for i in range(7)])
+    con.execute("INSERT INTO kv VALUES ('bin', ?)", (record_codec.encode({"kcal": 1}),))
+    assert record_codec.migrate_rows(con, "kv", "key", "value", batch=3) == 7
+    rows = dict(con.execute("SELECT key, value FROM kv").fetchall())
+    assert all(record_codec.is_encoded(v) for v in rows.values())
+    assert record_codec.decode(rows["k5"]) == {"kcal": 5}
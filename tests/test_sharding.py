@@ -0,0 +1,112 @@
+from pathlib import Path
+from collections import Counter
+import sys
+
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+import sharding
+from storage import LocalDB, MemoryDB, PrefixRouter, SQLiteStateDB
+
+
+def test_hash_ring_balances_and_moves_few_users():
+    uids = range(20000)
+    ring3, ring4 = sharding.HashRing(range(3)), sharding.HashRing(range(4))
+    load = Counter(ring4.node_for(u) for u in uids)
+    assert min(load.values()) > 20000 / 4 * 0.8
+    moved = sum(ring3.node_for(u) != ring4.node_for(u) for u in uids)
+    assert moved < 20000 * 0.35  # ~1/4, а не почти все
+    assert all(ring4.node_for(u) == 3 for u in uids if ring3.node_for(u) != ring4.node_for(u))
+    assert ring4.node_for(42) == ring4.node_for("42")
+
+
+def test_prefix_router_keeps_shared_keys_apart():
+    local, shared = MemoryDB(), MemoryDB()
+    db = PrefixRouter(local, shared, sharding.SHARED_PREFIXES)
+    db.put_many({"user:1": {"points": 3}, "lb:1": 3, "admin_users": [7]})
+    assert set(local.store) == {"user:1"} and set(shared.store) == {"lb:1", "admin_users"}
+    assert sorted(db.keys_prefix("")) == ["admin_users", "lb:1", "user:1"]
+    assert db.keys_prefix("lb:") == ["lb:1"]
+    assert db.get_many(["user:1", "lb:1"]) == {"user:1": {"points": 3}, "lb:1": 3}
+
+
+def test_rebalance_moves_users_to_new_owners(tmp_path):
+    base = str(tmp_path / "db.json")
+    shared = str(tmp_path / "shared.db")
+
+    def open_path(p):
+        return SQLiteStateDB(p) if p.endswith(".db") else LocalDB(p)
+
+    db = LocalDB(base)
+    for uid in range(60):
+        db[f"user:{uid}"] = {"points": uid}
+        db[f"diary:{uid}:food:2026-10"] = {"entries": [{"kcal": uid}]}
+        db[f"lb:{uid}"] = uid
+    db["admin_users"] = [1]
+    db.close()
+
+    assert sharding.rebalance(base, 1, 3, open_path, shared)["moved"] == 181
+    ring = sharding.HashRing(range(3))
+    for i in range(3):
+        shard = LocalDB(sharding.shard_path(base, i, 3))
+        owners = {sharding.key_owner(k) for k in shard.keys()}
+        assert owners and all(ring.node_for(uid) == i for uid in owners)
+        shard.close()
+
+    stats = sharding.rebalance(base, 3, 2, open_path, shared)
+    assert stats["kept"] > 0
+    stats = sharding.rebalance(base, 2, 1, open_path, shared)
+    db = LocalDB(base)
+    assert len(db.keys()) == 181 and db["admin_users"] == [1] and db["diary:7:food:2026-10"]["entries"][0]["kcal"] == 7
+    db.close()
+
+
+def test_shared_ranks_refresh_off_the_save_path(monkeypatch):
+    import main
+
+    ring = sharding.HashRing(range(2))
+    own = next(str(u) for u in range(100) if ring.node_for(str(u)) == 0)
+    foreign = next(str(u) for u in range(100) if ring.node_for(str(u)) == 1)
+    db = main.MemoryDB()
+    db[f"lb:{own}"] = 1
+    db[f"lb:{foreign}"] = 7
+    monkeypatch.setattr(main, "local_db", db)
+    monkeypatch.setattr(main, "_shard_ring", ring)
+    monkeypatch.setattr(main, "SHARD_INDEX", 0)
+    monkeypatch.setattr(main, "leaderboard", main.Leaderboard())
+    monkeypatch.setattr(main, "_leaderboard_loaded", True)
+    monkeypatch.setattr(main, "_leaderboard_persisted", {})
+
+    def scan(prefix):
+        raise AssertionError("save path must not scan lb:*")
+
+    with monkeypatch.context() as m:
+        m.setattr(main, "db_keys_prefix", scan)
+        main._sync_rank(own, 5, persist=True)
+    db[f"lb:{own}"] = 1  # запись на диске отстала (write-behind)
+
+    import asyncio
+
+    main._apply_ranks(asyncio.run(main._read_ranks()), foreign_only=True)
+    assert main.leaderboard.points(own) == 5  # своё в памяти свежее записи на диске
+    assert main.leaderboard.points(foreign) == 7
+
+
+def test_shared_sqlite_cas_sees_other_process_writes(tmp_path):
+    path = str(tmp_path / "shared.db")
+    a = SQLiteStateDB(path, shared=True)
+    b = SQLiteStateDB(path, shared=True)  # второй воркер со своим соединением
+    try:
+        assert a.cas("lb:meta", 0, {"n": 1})
+        assert not b.cas("lb:meta", 0, {"n": 2})
+        rec = b.get("lb:meta")
+        assert rec == {"n": 1, "_v": 1}
+        rec["n"] = 2
+        assert b.cas("lb:meta", 1, rec) and rec["_v"] == 2
+        # у первого в памяти всё ещё версия 1 — запись по ней должна не пройти
+        assert not a.cas("lb:meta", 1, {"n": 3})
+        assert a.get("lb:meta") == {"n": 2, "_v": 2}
+    finally:
+        a.close()
+        b.close()
@@ -0,0 +1,66 @@
+from pathlib import Path
+import asyncio
+import sys
+
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+from singleflight import SingleFlight
+
+
+def test_concurrent_calls_share_one_run_and_get_copies():
+    flights = SingleFlight()
+    runs = []
+
+    async def work():
+        runs.append(1)
+        await asyncio.sleep(0.05)
+        return {"kcal": 100}
+
+    async def scenario():
+        return await asyncio.gather(*(flights.run("k", work, group="fs", clone=dict) for _ in range(4)))
+
+    results = asyncio.run(scenario())
+    assert len(runs) == 1 and all(r == {"kcal": 100} for r in results)
+    assert len({id(r) for r in results}) == 4
+    assert flights.stats()["groups"]["fs"] == {"calls": 1, "coalesced": 3} and len(flights) == 0
+
+
+def test_cancelled_leader_does_not_cancel_followers():
+    flights = SingleFlight()
+
+    async def work():
+        await asyncio.sleep(0.05)
+        return "ok"
+
+    async def scenario():
+        leader = asyncio.ensure_future(flights.run("k", work))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(flights.run("k", work))
+        await asyncio.sleep(0)
+        leader.cancel()
+        return await follower, leader.cancelled()
+
+    assert asyncio.run(scenario()) == ("ok", True)
+
+
+def test_leader_edits_are_not_seen_by_followers():
+    flights = SingleFlight()
+
+    async def work():
+        await asyncio.sleep(0.02)
+        return {"kcal": 100}
+
+    async def caller(scale):
+        r = await flights.run("k", work, clone=dict)
+        if scale:
+            r["kcal"] *= 2  # лидер пересчитывает на свою порцию
+            await asyncio.sleep(0)
+        return r
+
+    async def scenario():
+        return await asyncio.gather(caller(True), caller(False), caller(False))
+
+    leader, *followers = asyncio.run(scenario())
+    assert leader == {"kcal": 200} and all(r == {"kcal": 100} for r in followers)
@@ -0,0 +1,591 @@
+from pathlib import Path
+import json
+import sqlite3
+import sys
+
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+import main
+from storage import LocalDB
+
+
+def test_local_db_journal_replay(tmp_path):
+    path = str(tmp_path / "db.json")
+    db = LocalDB(path)
+    db["user:1"] = {"points": 1}
+    db["user:2"] = {"points": 2}
+    db["user:1"] = {"points": 5}
+    db.close()
+
+    # снапшот не переписывался — всё лежит в журнале
+    assert Path(path).read_text(encoding="utf-8").strip() == "{}"
+
+    with open(f"{path}.journal", "a", encoding="utf-8") as f:
+        f.write('{"k": "user:3", "v": {"poi')  # оборванная запись
+
+    db = LocalDB(path)
+    assert db["user:1"] == {"points": 5}
+    assert db["user:2"] == {"points": 2}
+    assert db["user:3"] is None
+    # первая запись после сбоя не должна приклеиться к оборванной строке
+    db["user:4"] = {"points": 4}
+    db.close()
+
+    db = LocalDB(path)
+    assert db["user:4"] == {"points": 4}
+    assert db["user:3"] is None
+    db.close()
+
+
+def test_local_db_compaction_finishes_leftover_and_counts_bytes(tmp_path):
+    path = str(tmp_path / "db.json")
+    db = LocalDB(path, compact_bytes=10 ** 9)
+    db["user:1"] = {"name": "Ёж"}
+    assert db._journal_size == Path(f"{path}.journal").stat().st_size
+    db.close()
+    # прошлое сворачивание оборвалось
+    Path(f"{path}.journal").replace(f"{path}.journal.compacting")
+
+    db = LocalDB(path, compact_bytes=10 ** 9)
+    db["user:2"] = {"points": 2}
+    db.compact(wait=True)
+    assert db._journal_size == 0
+    assert not Path(f"{path}.journal.compacting").exists()
+    assert Path(f"{path}.journal").stat().st_size == 0
+    db.close()
+
+    db = LocalDB(path)
+    assert db["user:1"] == {"name": "Ёж"} and db["user:2"] == {"points": 2}
+    db.close()
+
+
+def test_local_db_compaction(tmp_path):
+    path = str(tmp_path / "db.json")
+    db = LocalDB(path)
+    for i in range(10):
+        db[f"user:{i}"] = {"points": i}
+    db.compact(wait=True)
+    db["user:0"] = {"points": 100}
+    db.close()
+
+    assert not Path(f"{path}.journal.compacting").exists()
+    db = LocalDB(path)
+    assert db["user:9"] == {"points": 9}
+    assert db["user:0"] == {"points": 100}
+    db.close()
+
+
+def test_sqlite_state_db_rows_and_import(tmp_path):
+    json_path = str(tmp_path / "db.json")
+    legacy = LocalDB(json_path)
+    legacy["user:1"] = {"points": 1}
+    legacy["admin_users"] = [42]
+    legacy.close()
+
+    db = main.SQLiteStateDB(str(tmp_path / "state.db"), import_json=json_path)
+    assert db.get("user:1") == {"points": 1}
+    db["user:2"] = {"points": 2}
+    # видно до того, как писатель дошёл до диска
+    assert db["user:2"] == {"points": 2}
+    assert sorted(db.keys_prefix("user:")) == ["user:1", "user:2"]
+    db.close()
+
+    db = main.SQLiteStateDB(str(tmp_path / "state.db"), import_json=json_path)
+    assert db.get("user:2") == {"points": 2}
+    assert db.get("admin_users") == [42]
+    assert db.get("user:404", "missing") == "missing"
+    db.close()
+
+
+def test_sqlite_state_db_keeps_user_state_as_json(tmp_path):
+    import record_codec
+
+    path = str(tmp_path / "state.db")
+    con = sqlite3.connect(path)
+    con.execute("CREATE TABLE kv(key TEXT PRIMARY KEY, value TEXT NOT NULL, version INTEGER NOT NULL DEFAULT 0)")
+    con.execute("INSERT INTO kv VALUES ('user:1', ?, 3)", (record_codec.encode({"points": 1, "_v": 3}),))
+    con.execute("PRAGMA user_version=1")
+    con.commit()
+
+    db = main.SQLiteStateDB(path)
+    db["diary:1:food:2026-10"] = {"entries": [{"ts": "2026-10-01 08:00:00", "kcal": 300}]}
+    assert db.cas("user:2", 0, {"points": 2})
+    db.close()
+
+    rows = dict(con.execute("SELECT key, value FROM kv").fetchall())
+    assert json.loads(rows["user:1"]) == {"points": 1, "_v": 3}
+    assert json.loads(rows["user:2"]) == {"points": 2, "_v": 1}
+    assert record_codec.is_encoded(rows["diary:1:food:2026-10"])
+    con.close()
+
+
+def test_sqlite_state_db_keeps_failed_writes_pending(tmp_path, monkeypatch):
+    import pytest
+    from storage import StorageWriteError
+
+    monkeypatch.setattr(main.SQLiteStateDB, "RETRY_DELAY", 0.01)
+    path = str(tmp_path / "state.db")
+    db = main.SQLiteStateDB(path)
+    con = sqlite3.connect(path)
+    con.execute("CREATE TRIGGER boom BEFORE INSERT ON kv BEGIN SELECT RAISE(ABORT, 'disk full'); END")
+    con.commit()
+
+    db["user:1"] = {"points": 1}
+    with pytest.raises(StorageWriteError):
+        db.flush()
+    assert db.write_errors >= 1
+    assert db["user:1"] == {"points": 1}  # чтению по-прежнему видно
+
+    con.execute("DROP TRIGGER boom")
+    con.commit()
+    con.close()
+    db.flush()
+    db.close()
+
+    db = main.SQLiteStateDB(path)
+    assert db["user:1"] == {"points": 1}
+    db.close()
+
+
+def test_state_write_behind_coalesces(monkeypatch):
+    import asyncio
+
+    writes = []
+    monkeypatch.setattr(main, "_commit_state", lambda uid, v: writes.append((main.state_key(uid), dict(v))))
+    writer = main.StateWriteBehind(interval=60, max_dirty=100)
+
+    async def scenario():
+        writer.start()
+        st = {"points": 1}
+        writer.mark(7, st)
+        st["points"] = 2
+        writer.mark(7, st)
+        assert writer.get(7) is st
+        assert writes == []
+        await writer.stop()
+
+    asyncio.run(scenario())
+    assert writes == [("user:7", {"points": 2})]
+    assert writer.requested == 2 and writer.written == 1
+
+
+def test_state_cache_evicts_by_size_and_per_user_lock_serialises():
+    import asyncio
+    from types import SimpleNamespace
+
+    cache = main.StateCache(max_bytes=100)
+    a, b = {"n": 1}, {"n": 2}
+    cache.put(1, a, size=60)
+    cache.put(2, b, size=60)
+    assert cache.get(1) is None  # вытеснен как самый старый
+    assert cache.get(2) is b
+    assert cache.bytes == 60
+
+    order = []
+
+    async def handler(update, context):
+        order.append(("in", update.marker))
+        await asyncio.sleep(0.01)
+        order.append(("out", update.marker))
+
+    wrapped = main.per_user(handler)
+
+    async def scenario():
+        upd = lambda uid, m: SimpleNamespace(effective_user=SimpleNamespace(id=uid), marker=m)
+        await asyncio.gather(wrapped(upd(1, "a"), None), wrapped(upd(1, "b"), None), wrapped(upd(2, "c"), None))
+
+    asyncio.run(scenario())
+    # апдейты одного пользователя не перемежаются, другой пользователь идёт параллельно
+    assert order.index(("out", "a")) < order.index(("in", "b"))
+    assert order.index(("in", "c")) < order.index(("out", "a"))
+
+
+def test_per_user_prefetches_state_through_async_storage(tmp_path, monkeypatch):
+    import asyncio
+    import threading
+    from types import SimpleNamespace
+
+    db = main.SQLiteStateDB(str(tmp_path / "state.db"))
+    db["user:12"] = {"points": 7, "profile": {"preferences": {}}, "_v": 1}
+    monkeypatch.setattr(main, "local_db", db)
+    monkeypatch.setattr(main, "state_cache", main.StateCache(max_bytes=10 ** 6))
+    reads = []
+    real_get = db.get
+
+    def get(k, default=None):
+        reads.append(threading.current_thread() is threading.main_thread())
+        return real_get(k, default)
+
+    monkeypatch.setattr(db, "get", get)
+    seen = {}
+
+    async def handler(update, context):
+        seen["points"] = main.load_state(update.effective_user.id)["points"]
+
+    upd = SimpleNamespace(effective_user=SimpleNamespace(id=12))
+    asyncio.run(main.per_user(handler)(upd, None))
+    assert seen == {"points": 7}
+    assert reads == [False]  # запись прочитана один раз и не в потоке цикла
+    db.close()
+
+
+def test_commit_remeasures_cached_state(tmp_path, monkeypatch):
+    db = LocalDB(str(tmp_path / "db.json"))
+    cache = main.StateCache(max_bytes=10 ** 6)
+    monkeypatch.setattr(main, "local_db", db)
+    monkeypatch.setattr(main, "state_cache", cache)
+    monkeypatch.setattr(main, "state_writer", main.StateWriteBehind())
+
+    s = main.load_state(9)
+    before = cache.bytes
+    s["profile"]["notes"] = "x" * 5000
+    main.save_state(9, s)
+    assert cache.bytes >= before + 5000
+    db.close()
+
+
+def test_commit_state_reapplies_ops_on_version_conflict(tmp_path, monkeypatch):
+    import copy
+
+    db = LocalDB(str(tmp_path / "db.json"))
+    monkeypatch.setattr(main, "local_db", db)
+    db["user:5"] = {"points": 0, "awaiting": None}
+
+    a = copy.deepcopy(db["user:5"])
+    b = copy.deepcopy(db["user:5"])
+    main.add_points(a, 3)
+    main.add_points(b, 2)
+    b["awaiting"] = "log_food_entry"
+
+    conflicts = main.state_metrics["cas_conflicts"]
+    main._commit_state(5, a)
+    merged = main._commit_state(5, b)
+
+    assert main.state_metrics["cas_conflicts"] == conflicts + 1
+    saved = db["user:5"]
+    assert saved == main._persisted(merged) and saved is not merged  # в базе — копия без черновика диалога
+    assert "_base" in merged and "_base" not in saved
+    assert saved["points"] == 5
+    assert saved["awaiting"] == "log_food_entry"
+    assert saved["_v"] == 2 and "_ops" not in saved
+    db.close()
+
+
+def test_commit_state_keeps_payment_racing_points_update(tmp_path, monkeypatch):
+    db = LocalDB(str(tmp_path / "db.json"))
+    monkeypatch.setattr(main, "local_db", db)
+    db["user:7"] = {"points": 10, "access_level": "free", "profile": {"name": "A"}, "_v": 1}
+
+    def loaded():
+        s = dict(db["user:7"])
+        s["_base"] = main._field_sigs(s)[0]
+        return s
+
+    paid, scored = loaded(), loaded()
+    paid["access_level"] = "premium"
+    paid["access_expires"] = "2026-11-16T00:00:00"
+    main.add_points(scored, 4)
+    scored["profile"] = {"name": "B"}
+
+    main._commit_state(7, scored)
+    main._commit_state(7, paid)
+
+    saved = db["user:7"]
+    assert saved["access_level"] == "premium" and saved["access_expires"] == "2026-11-16T00:00:00"
+    assert saved["points"] == 14 and saved["profile"] == {"name": "B"}
+    assert "_base" not in saved and saved["_v"] == 3
+    db.close()
+
+
+def test_load_state_does_not_share_nested_objects_with_store(tmp_path, monkeypatch):
+    db = LocalDB(str(tmp_path / "db.json"))
+    monkeypatch.setattr(main, "local_db", db)
+    monkeypatch.setattr(main, "state_cache", main.StateCache(max_bytes=10 ** 6))
+    db["user:11"] = {"points": 0, "profile": {"weight_kg": 80, "preferences": {}}, "awards": {}, "_v": 1}
+
+    s = main.load_state(11)
+    s["profile"]["weight_kg"] = 75
+    s["awards"]["2026-10-16"] = {"log_food": True}
+    assert db["user:11"]["profile"]["weight_kg"] == 80 and db["user:11"]["awards"] == {}
+    # отпечатки при загрузке не совпадают с изменённым — конфликт будет виден
+    assert main._field_sigs(s)[0]["profile"] != s["_base"]["profile"]
+    db.close()
+
+
+def test_state_stays_dirty_when_version_conflicts_persist(tmp_path, monkeypatch):
+    db = LocalDB(str(tmp_path / "db.json"))
+    monkeypatch.setattr(main, "local_db", db)
+    monkeypatch.setattr(main, "db_cas", lambda k, expected, rec: False)
+    db["user:8"] = {"points": 0}
+    writer = main.StateWriteBehind()
+    writer._task = object()  # как при запущенном фоне: mark только копит
+    s = dict(db["user:8"])
+    main.add_points(s, 2)
+    writer.mark(8, s)
+
+    lost = main.state_metrics["lost_updates"]
+    writer.flush()
+    assert main.state_metrics["lost_updates"] == lost + 1
+    assert writer.get(8) is s and s["_ops"] == [("points", 2)]
+
+    monkeypatch.undo()
+    monkeypatch.setattr(main, "local_db", db)
+    writer.flush()
+    assert writer.get(8) is None and db["user:8"]["points"] == 2
+    db.close()
+
+
+def test_diary_store_partitions_by_month(tmp_path, monkeypatch):
+    db = LocalDB(str(tmp_path / "db.json"))
+    monkeypatch.setattr(main, "local_db", db)
+    store = main.DiaryStore()
+
+    st = {"diaries": {"food": [
+        {"ts": "2026-09-30 20:00:00", "text": "ужин", "kcal": 600},
+        {"ts": "2026-10-01 08:00:00", "text": "завтрак", "kcal": 300},
+    ], "train": [], "metrics": []}}
+    assert store.migrate_legacy(1, st) and "diaries" not in st
+    store.append(1, "food", {"ts": "2026-10-02 13:00:00", "text": "обед", "kcal": 700, "p": 30})
+    store.append(1, "train", {"ts": "2026-10-02 18:00:00", "text": "бег", "kcal": 400})
+
+    assert store.months(1, "food") == ["2026-09", "2026-10"]
+    assert store.count(1, ("food", "train")) == 4
+    day = store.rollup(1, "2026-10-02")
+    assert (day["kcal"], day["p"], day["train_kcal"], day["food_n"], day["train_n"]) == (700, 30, 400, 1, 1)
+    assert [d for d, _ in store.recent_days(1, 2)] == ["2026-10-02", "2026-10-01"]
+    assert [e["text"] for e in store.range(1, "food", "2026-10-01", "2026-10-31")] == ["завтрак", "обед"]
+
+    tail = store.tail(1, "food", 2)
+    assert [e["text"] for _, _, e in tail] == ["завтрак", "обед"]
+    month, pos, _ = tail[0]
+    assert store.remove(1, "food", month, pos)["text"] == "завтрак"
+    assert store.count(1) == 3
+    assert [d for d, _ in store.recent_days(1, 7)] == ["2026-10-02", "2026-09-30"]
+    assert [e["text"] for e in store.iter_recent(1, "food")] == ["обед", "ужин"]
+
+    assert len(store.clear(1, "food")) == 2
+    assert store.count(1, ("food",)) == 0 and store.tail(1, "food", 10) == []
+    assert store.rollup(1, "2026-10-02")["kcal"] == 0
+    assert store.rollup(1, "2026-10-02")["train_kcal"] == 400
+    db.close()
+
+
+def test_cas_update_applies_fn_once_per_attempt_on_conflict(monkeypatch):
+    db = main.MemoryDB()
+    monkeypatch.setattr(main, "local_db", db)
+    db["diary:1:food:2026-10"] = {"entries": [{"text": "завтрак"}], "_v": 1}
+    real_cas = main.db_cas
+    calls = []
+
+    def racing_cas(k, expected, v):
+        if not calls:
+            # другой обработчик успел записать раньше — тоже чтением и правкой записи из хранилища
+            other = db.get(k)
+            other["entries"].append({"text": "кофе"})
+            assert real_cas(k, 1, other)
+        calls.append(expected)
+        return real_cas(k, expected, v)
+
+    monkeypatch.setattr(main, "db_cas", racing_cas)
+    main._cas_update("diary:1:food:2026-10", lambda rec: rec.setdefault("entries", []).append({"text": "обед"}))
+
+    assert calls == [1, 2]
+    assert [e["text"] for e in db["diary:1:food:2026-10"]["entries"]] == ["завтрак", "кофе", "обед"]
+
+
+def test_diary_store_repairs_index_after_crash_between_writes(tmp_path, monkeypatch):
+    import pytest
+
+    db = LocalDB(str(tmp_path / "db.json"))
+    monkeypatch.setattr(main, "local_db", db)
+    store = main.DiaryStore()
+    store.append(1, "food", {"ts": "2026-09-30 20:00:00", "text": "ужин", "kcal": 600})
+    store.append(1, "food", {"ts": "2026-10-01 08:00:00", "text": "завтрак", "kcal": 300})
+
+    def crash(*args):
+        raise OSError("killed")
+
+    with monkeypatch.context() as m:
+        m.setattr(store, "_bump", crash)
+        with pytest.raises(OSError):
+            store.append(1, "food", {"ts": "2026-11-02 09:00:00", "text": "каша", "kcal": 250})
+        with pytest.raises(OSError):
+            store.append(1, "food", {"ts": "2026-09-30 22:00:00", "text": "кефир", "kcal": 100})
+    assert db["diary:1:index"]["food"]["2026-09"] == 1  # кефир в партиции, но не в индексе
+
+    # новый процесс: первый же запрос индекса сверяет его с партициями
+    store = main.DiaryStore()
+    assert store.months(1, "food") == ["2026-09", "2026-10", "2026-11"]
+    assert store.count(1, ("food",)) == 4
+    assert db["diary:1:index"]["food"] == {"2026-09": 2, "2026-10": 1, "2026-11": 1}
+
+    # индекс пропал целиком
+    del db["diary:1:index"]
+    store = main.DiaryStore()
+    assert store.count(1, ("food",)) == 4
+    assert store.hot_months(1) == ["2026-09", "2026-10", "2026-11"]
+    db.close()
+
+
+def test_diary_store_migrates_daily_energy(tmp_path, monkeypatch):
+    db = LocalDB(str(tmp_path / "db.json"))
+    monkeypatch.setattr(main, "local_db", db)
+    store = main.DiaryStore()
+
+    st = {
+        "diaries": {"food": [{"ts": "2026-10-01 08:00:00", "text": "каша", "kcal": 300}]},
+        "daily_energy": {"2026-10-01": {"in": 300, "out": 0}, "2026-09-15": {"in": 1800, "out": 250}},
+    }
+    assert store.migrate_legacy(2, st) and st == {}
+    assert store.rollup(2, "2026-10-01")["kcal"] == 300  # не задвоилось
+    legacy_day = store.rollup(2, "2026-09-15")
+    assert (legacy_day["kcal"], legacy_day["train_kcal"], legacy_day["food_n"]) == (1800, 250, 0)
+    db.close()
+
+
+def test_retention_archives_old_months_and_awards(tmp_path, monkeypatch):
+    path = str(tmp_path / "db.json")
+    db = LocalDB(path)
+    monkeypatch.setattr(main, "local_db", db)
+    monkeypatch.setattr(main, "diary_store", main.DiaryStore())
+    store = main.diary_store
+    today = main.today_key()
+
+    db[main.state_key(77)] = {"points": 3, "awards": {"2025-01-05": {"log_food": True}, today: {"log_food": True}}}
+    store.extend(77, "food", [{"ts": "2025-01-05 08:00:00", "text": "каша", "kcal": 300},
+                              {"ts": "2025-02-01 09:00:00", "text": "омлет", "kcal": 250}])
+    store.append(77, "food", {"ts": f"{today} 12:00:00", "text": "обед", "kcal": 700})
+
+    engine = main.RetentionEngine(days=90, batch=10, max_months=1)
+    assert engine.step() == 2  # день наград + один месяц за тик
+    assert engine.step() == 1 and engine.archived_months == 2
+    assert not db.keys_prefix("diary:77:food:2025") and not db.keys_prefix("diary:77:days:2025")
+
+    st = db[main.state_key(77)]
+    assert list(st["awards"]) == [today] and st["archive"]["awards"] == {"log_food": 1}
+    assert store.awards(77, "2025-01") == {"2025-01-05": {"log_food": True}}
+    # чтение истории подгружает архив лениво, счётчики не меняются
+    assert store.count(77) == 3 and store.months(77, "food") == ["2025-01", "2025-02", today[:7]]
+    assert [e["text"] for e in store.iter_recent(77, "food")] == ["обед", "омлет", "каша"]
+    assert store.rollup(77, "2025-01-05")["kcal"] == 300
+    assert store.cold_months(77)["2025-01"]["sum"]["kcal"] == 300
+
+    # запись в архивный месяц сначала возвращает его в горячие партиции
+    store.append(77, "food", {"ts": "2025-01-06 08:00:00", "text": "творог", "kcal": 200})
+    assert "2025-01" not in store.cold_months(77)
+    assert [e["text"] for e in store.partition(77, "food", "2025-01")] == ["каша", "творог"]
+    assert store.rollup(77, "2025-01-06")["kcal"] == 200 and store.count(77) == 4
+    db.close()
+
+    # удаления переживают перезапуск
+    db = LocalDB(path)
+    assert db["diary:77:food:2025-02"] is None and db["diary:77:cold:2025-02"]
+    db.close()
+
+
+def test_snapshot_and_restore_local_db_and_sqlite(tmp_path, monkeypatch):
+    import snapshots
+
+    path = str(tmp_path / "db.json")
+    db = LocalDB(path, compact_bytes=10**9)
+    db["user:1"] = {"points": 1}
+    db.compact()
+    db["user:1"] = {"points": 2, "name": "Аня"}
+    db["user:2"] = {"points": 5}
+    del db["user:2"]
+
+    cache = str(tmp_path / "cache.db")
+    con = sqlite3.connect(cache)
+    con.execute("CREATE TABLE t (k TEXT)")
+    con.execute("INSERT INTO t VALUES ('x')")
+    con.commit()
+    monkeypatch.setattr(main, "local_db", db)
+    monkeypatch.setattr(main, "CACHE_DB_PATH", cache)
+
+    snap, files = main.take_snapshot(str(tmp_path / "snaps"))
+    assert set(files) == {"state.json.gz", "state.journal.gz", "cache.db.gz"}
+    assert snapshots.verify(snap) == []
+
+    # после снапшота всё меняется — restore возвращает точку снапшота
+    db["user:1"] = {"points": 99}
+    db.close()
+    con.execute("DELETE FROM t")
+    con.commit()
+    con.close()
+    assert sorted(snapshots.restore(snap)) == sorted([path, f"{path}.journal", cache])
+
+    db = LocalDB(path)
+    assert db["user:1"] == {"points": 2, "name": "Аня"} and db["user:2"] is None
+    db.close()
+    assert sqlite3.connect(cache).execute("SELECT k FROM t").fetchall() == [("x",)]
+
+    sdb = main.SQLiteStateDB(str(tmp_path / "state.db"))
+    sdb["user:7"] = {"points": 7}
+    files = sdb.snapshot(str(tmp_path))
+    sdb.close()
+    assert files["state.db.gz"]["target"] == str(tmp_path / "state.db")
+
+    corrupt = Path(snap) / "state.json.gz"
+    corrupt.write_bytes(corrupt.read_bytes()[:-8])
+    assert snapshots.verify(snap)
+
+
+def test_storage_backends_share_interface(tmp_path):
+    import asyncio
+    import pytest
+    import storage
+
+    async def exercise(db):
+        await db.put_many({"user:1": {"points": 1}, "user:2": {"points": 2}, "lb:1": 1})
+        assert await db.get_many(["user:1", "user:2", "user:9"]) == {"user:1": {"points": 1}, "user:2": {"points": 2}}
+        assert await db.scan_prefix("user:") == ["user:1", "user:2"]
+        rec = {"points": 5}
+        assert await db.put_if_version("user:3", 0, rec) and rec["_v"] == 1
+        assert not await db.put_if_version("user:3", 0, {"points": 6})
+        await db.delete("user:2")
+        await db.flush()
+        assert await db.get("user:2") is None and await db.scan_prefix("user:") == ["user:1", "user:3"]
+        assert (await db.get("user:3"))["points"] == 5
+
+    for kind in ("memory", "json", "sqlite"):
+        store = storage.open_store(kind, json_path=str(tmp_path / f"{kind}.json"), sqlite_path=str(tmp_path / "s.db"))
+        try:
+            asyncio.run(exercise(storage.AsyncStorage(store)))
+        finally:
+            store.close()
+    with pytest.raises(ValueError):
+        storage.open_store("redis")
+    with pytest.raises(ValueError):
+        storage.open_store("replit")
+
+
+def test_session_scratch_is_not_persisted(monkeypatch):
+    db = main.MemoryDB()
+    monkeypatch.setattr(main, "local_db", db)
+    monkeypatch.setattr(main, "state_cache", main.StateCache(1 << 20))
+    monkeypatch.setattr(main, "sessions", main.SessionStore(ttl=60))
+    db["user:7"] = {"points": 1, "awaiting": "recipe_number",
+                    "tmp": {"category_recipes": [{"steps": ["..."] * 50}], "menu_day_counter": 4}}
+
+    st = main.load_state(7)
+    assert st["tmp"] == {} and st["awaiting"] is None  # шаг без черновика не продолжить
+    assert st["menu_day_counter"] == 4 and "tmp" not in db["user:7"]
+
+    st["tmp"]["last_menu"] = "x" * 1000
+    st["awaiting"] = "confirm_save_menu"
+    main.save_state(7, st)
+    assert "tmp" not in db["user:7"] and db["user:7"]["awaiting"] == "confirm_save_menu"
+    assert main.load_state(7)["tmp"]["last_menu"] == "x" * 1000
+
+    # рестарт: кэш и сессии пусты, запись та же
+    monkeypatch.setattr(main, "state_cache", main.StateCache(1 << 20))
+    monkeypatch.setattr(main, "sessions", main.SessionStore(ttl=60))
+    st = main.load_state(7)
+    assert st["tmp"] == {} and st["awaiting"] is None
+    st["awaiting"] = "onb_age"
+    main.save_state(7, st)
+    main.sessions.sweep(now=main.time.monotonic() + 120)
+    assert len(main.sessions) == 0
+    assert main.load_state(7)["awaiting"] == "onb_age"  # самодостаточный шаг переживает истечение